@@ -0,0 +1,73 @@
+import os
+import tempfile
+import time
+from typing import List
+
+import numpy as np
+import pandas as pd
+
+from data_compilation_methods.compiling_datasets import _compilation_engines, compile_hits
+
+
+def _random_hit_dfs(n_sources: int, n_hits: int, n_names: int, seed: int = 0) -> List[pd.DataFrame]:
+    from wcvpy.wcvp_download import wcvp_accepted_columns
+
+    rng = np.random.default_rng(seed)
+    dfs = []
+    for s in range(n_sources):
+        name_ids = rng.integers(0, n_names, n_hits)
+        dfs.append(pd.DataFrame({
+            wcvp_accepted_columns['name']: ['Genus species' + str(i // 2) for i in name_ids],
+            wcvp_accepted_columns['name_w_author']: ['Genus species' + str(i // 2) + ' Author' + str(i % 2) for i in
+                                                     name_ids],
+            wcvp_accepted_columns['ipni_id']: [str(i) + '-1' for i in name_ids],
+            wcvp_accepted_columns['rank']: 'Species',
+            wcvp_accepted_columns['family']: ['Family' + str(i % 50) for i in name_ids],
+            'Source': 'Source' + str(s),
+            'Source' + str(s) + '_snippet': 'snippet',
+        }))
+    return dfs
+
+
+def benchmark_compile_hits(n_sources_to_test: List[int], n_hits: int = 10 ** 5, n_names: int = 10 ** 5,
+                           engines: List[str] = None) -> pd.DataFrame:
+    """
+    Time each compilation engine on synthetic hits from each number of sources and check the output files are the
+    same.
+    :param n_sources_to_test: numbers of source dataframes to compile
+    :param n_hits: number of hits in each source
+    :param n_names: number of accepted names the hits are drawn from
+    :param engines: engines to compare, defaults to all
+    :return: dataframe of timings
+    """
+    if engines is None:
+        engines = list(_compilation_engines.keys())
+
+    out_dict = {'n_sources': [], 'engine': [], 'seconds': []}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for n_sources in n_sources_to_test:
+            dfs = _random_hit_dfs(n_sources, n_hits, n_names)
+            outputs = []
+            for engine in engines:
+                output_csv = os.path.join(tmpdir, engine + '.csv')
+                start = time.perf_counter()
+                compile_hits(dfs, output_csv, engine=engine)
+                out_dict['n_sources'].append(n_sources)
+                out_dict['engine'].append(engine)
+                out_dict['seconds'].append(time.perf_counter() - start)
+                with open(output_csv) as f:
+                    outputs.append(f.read())
+            for other in outputs[1:]:
+                if other != outputs[0]:
+                    raise ValueError(f'Engines disagree for {n_sources} sources')
+
+    return pd.DataFrame(out_dict)
+
+
+def _main():
+    timings = benchmark_compile_hits([2, 5, 10, 20, 40])
+    print(timings.pivot(index='n_sources', columns='engine', values='seconds'))
+
+
+if __name__ == '__main__':
+    _main()
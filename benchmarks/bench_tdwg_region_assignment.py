@@ -0,0 +1,112 @@
+import time
+from typing import List
+
+import numpy as np
+import pandas as pd
+
+from clean_plant_occurrences.clean_by_tdwg_region import _region_assignment_engines, _assign_regions_in_parallel
+from clean_plant_occurrences.region_raster import get_region_raster
+from clean_plant_occurrences.tdwg_shapefiles import get_tdwg_region_geometries
+
+
+def _random_coordinates(n: int, seed: int = 0):
+    rng = np.random.default_rng(seed)
+    # Roughly the extent of land with plant occurrences
+    longitudes = rng.uniform(-180, 180, n)
+    latitudes = rng.uniform(-60, 80, n)
+    return longitudes, latitudes
+
+
+def _random_points(n: int, seed: int = 0):
+    import geopandas
+    return geopandas.points_from_xy(*_random_coordinates(n, seed))
+
+
+def benchmark_region_assignment(sizes: List[int], engines: List[str] = None,
+                                max_loop_points: int = 10 ** 5) -> pd.DataFrame:
+    """
+    Time each region assignment engine on uniformly random points and check the engines agree.
+    The 'loop' engine is very slow, so above max_loop_points it is timed on the first max_loop_points points and its
+    time is extrapolated linearly, as it tests every point against each region in turn. These rows are marked in
+    the 'extrapolated' column and the engines are checked to agree on the sampled points.
+    :param sizes: numbers of points to test
+    :param engines: engines to compare, defaults to all
+    :param max_loop_points: number of points above which the time of the 'loop' engine is extrapolated
+    :return: dataframe of timings
+    """
+    if engines is None:
+        engines = list(_region_assignment_engines.keys())
+    map_df = get_tdwg_region_geometries(3)
+    if 'raster' in engines:
+        # Build the raster outside of the timings
+        get_region_raster(map_df)
+
+    out_dict = {'n_points': [], 'engine': [], 'seconds': [], 'extrapolated': []}
+    for n in sizes:
+        points = _random_points(n)
+        results = {}
+        for engine in engines:
+            engine_points = points
+            if engine == 'loop' and n > max_loop_points:
+                engine_points = points[:max_loop_points]
+            start = time.perf_counter()
+            results[engine] = _region_assignment_engines[engine](engine_points, map_df, 'LEVEL3_COD')
+            seconds = time.perf_counter() - start
+            out_dict['n_points'].append(n)
+            out_dict['engine'].append(engine)
+            out_dict['seconds'].append(seconds * n / len(engine_points))
+            out_dict['extrapolated'].append(len(engine_points) < n)
+        engine_outputs = list(results.values())
+        n_compared = min(len(r) for r in engine_outputs)
+        for other in engine_outputs[1:]:
+            if not np.array_equal(engine_outputs[0][:n_compared], other[:n_compared]):
+                raise ValueError(f'Engines disagree for {n} points')
+
+    return pd.DataFrame(out_dict)
+
+
+def benchmark_parallel_region_assignment(n_points: int, n_jobs_to_test: List[int], engine: str = 'strtree',
+                                         shapefile_cache_dir: str = None) -> pd.DataFrame:
+    """
+    Time region assignment with different numbers of processes and check the outputs are the same.
+    :param n_points: number of random points to assign
+    :param n_jobs_to_test: numbers of processes to test, 1 runs in the current process
+    :param engine:
+    :param shapefile_cache_dir: directory of the GeoParquet cache which workers load the geometries from
+    :return: dataframe of timings and speedups relative to a single process
+    """
+    longitudes, latitudes = _random_coordinates(n_points)
+    map_df = get_tdwg_region_geometries(3, cache_dir=shapefile_cache_dir)
+
+    out_dict = {'n_jobs': [], 'seconds': []}
+    single_process_regions = None
+    for n_jobs in n_jobs_to_test:
+        start = time.perf_counter()
+        if n_jobs == 1:
+            regions = _region_assignment_engines[engine](_random_points(n_points), map_df, 'LEVEL3_COD')
+            single_process_regions = regions
+        else:
+            regions = _assign_regions_in_parallel(longitudes, latitudes, engine, 3, shapefile_cache_dir, n_jobs)
+        out_dict['n_jobs'].append(n_jobs)
+        out_dict['seconds'].append(time.perf_counter() - start)
+        if single_process_regions is not None and not np.array_equal(single_process_regions, regions):
+            raise ValueError(f'Output with {n_jobs} processes differs from single process')
+
+    timings = pd.DataFrame(out_dict)
+    timings['speedup'] = timings.loc[timings['n_jobs'] == min(n_jobs_to_test), 'seconds'].values[0] / timings[
+        'seconds']
+    return timings
+
+
+def _main():
+    timings = benchmark_region_assignment([10 ** 4, 10 ** 5, 10 ** 6, 10 ** 7])
+    print(timings.pivot(index='n_points', columns='engine', values='seconds'))
+    print('Timings extrapolated from a sample of points:')
+    print(timings[timings['extrapolated']])
+
+    scaling = benchmark_parallel_region_assignment(10 ** 7, [1, 2, 4, 8, 16, 32])
+    print(scaling)
+
+
+if __name__ == '__main__':
+    _main()
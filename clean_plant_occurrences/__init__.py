@@ -1 +1,5 @@
-from .clean_by_tdwg_region import *
\ No newline at end of file
+from .clean_by_tdwg_region import *
+from .deduplication import *
+from .distribution_lookup import *
+from .region_raster import *
+from .tdwg_shapefiles import *
@@ -1,54 +1,231 @@
 import os
+from typing import Union, Iterable, List
 
 import numpy as np
 import pandas as pd
 from tqdm import tqdm
 
-# Add progress bar to apply method
-tqdm.pandas()
+from clean_plant_occurrences.deduplication import OccurrenceDeduplicationIndex
+from clean_plant_occurrences.distribution_lookup import _region_codes_in_value, get_taxon_distribution_lookup
+from clean_plant_occurrences.region_raster import BOUNDARY_CELL, get_region_raster, lookup_region_raster
+from clean_plant_occurrences.tdwg_shapefiles import tdwg3_shpfile, tdwg_region_code_columns, \
+    get_tdwg_region_geometries
 
-from pkg_resources import resource_filename
 
-_inputs_path = resource_filename(__name__, 'inputs')
-# Shapefile from https://github.com/tdwg/wgsrpd
-tdwg3_shpfile = os.path.join(_inputs_path, 'wgsrpd-master', 'level3', 'level3.shp')
+def _assign_regions_by_looping(points, map_df: pd.DataFrame, region_code_col: str) -> np.ndarray:
+    """
+    Reference engine. Tests every occurrence against each region polygon in turn, so where points lie in more than
+    one polygon the last polygon in the shapefile wins.
+    :param points: array of shapely points
+    :param map_df: GeoDataFrame of region polygons
+    :param region_code_col: column of map_df containing the region codes
+    :return: array of region codes, with '' for points not within any region
+    """
+    import geopandas
+
+    points = geopandas.GeoSeries(points)
+    regions = np.full(len(points), '', dtype=object)
+    for idx in tqdm(range(map_df.shape[0]), desc="Getting tdwg regions for each occurrence…", ascii=False,
+                    ncols=82):
+        # For every location, find if they reside within a region
+        pip = points.within(map_df['geometry'].iloc[idx]).values
+        if pip.sum() > 0:  # we found where some of the addresses reside at map_df.loc[idx]
+            regions[pip] = map_df[region_code_col].iloc[idx]
+    return regions
+
+
+def _assign_regions_with_spatial_index(points, map_df: pd.DataFrame, region_code_col: str) -> np.ndarray:
+    """
+    Bulk query of the points against an STRtree of the region polygons. Candidate polygons are found from their
+    bounding boxes and the exact 'within' test is then run against prepared geometries.
+    Ties are broken in the same way as _assign_regions_by_looping i.e. the last matching polygon wins.
+    :param points: array of shapely points
+    :param map_df: GeoDataFrame of region polygons
+    :param region_code_col: column of map_df containing the region codes
+    :return: array of region codes, with '' for points not within any region
+    """
+    import geopandas
+
+    points = geopandas.GeoSeries(points)
+    regions = np.full(len(points), '', dtype=object)
+    point_idx, region_idx = map_df.sindex.query(points.values, predicate='within')
+    if len(point_idx) > 0:
+        # Sort by point then by region, and keep the last region for each point
+        order = np.lexsort((region_idx, point_idx))
+        point_idx = point_idx[order]
+        region_idx = region_idx[order]
+        last_for_point = np.append(point_idx[1:] != point_idx[:-1], True)
+        regions[point_idx[last_for_point]] = map_df[region_code_col].values[region_idx[last_for_point]]
+    return regions
+
+
+def _assign_regions_with_raster(points, map_df: pd.DataFrame, region_code_col: str, resolution: float = 0.05,
+                                cache_dir: str = None) -> np.ndarray:
+    """
+    Look up points in a precomputed raster of the regions, see build_region_raster. Only points in cells which
+    touch a region boundary are checked with _assign_regions_with_spatial_index, so the output is the same as the
+    exact engines.
+    :param points: array of shapely points
+    :param map_df: GeoDataFrame of region polygons
+    :param region_code_col: column of map_df containing the region codes
+    :param resolution: size of raster cells in degrees
+    :param cache_dir: directory to cache rasters in
+    :return: array of region codes, with '' for points not within any region
+    """
+    import shapely
+
+    points = np.asarray(points)
+    raster = get_region_raster(map_df, resolution, cache_dir=cache_dir)
+    labels = lookup_region_raster(raster, resolution, shapely.get_x(points), shapely.get_y(points))
+
+    regions = np.full(len(points), '', dtype=object)
+    in_region = labels >= 0
+    regions[in_region] = map_df[region_code_col].values[labels[in_region]]
+    boundary = labels == BOUNDARY_CELL
+    if boundary.any():
+        regions[boundary] = _assign_regions_with_spatial_index(points[boundary], map_df, region_code_col)
+    return regions
+
+
+_region_assignment_engines = {'loop': _assign_regions_by_looping,
+                              'strtree': _assign_regions_with_spatial_index,
+                              'raster': _assign_regions_with_raster}
+
+
+def _region_engine_kwargs(engine: str, raster_resolution: float, shapefile_cache_dir: str) -> dict:
+    if engine == 'raster':
+        return {'resolution': raster_resolution, 'cache_dir': shapefile_cache_dir}
+    return {}
+
+
+def _init_region_assignment_worker(tdwg_level: int, shapefile_cache_dir: str, engine_kwargs: dict):
+    # Load the geometries (and raster) once in each worker from the caches written by the parent process, these are
+    # then kept for the life of the process
+    map_df = get_tdwg_region_geometries(tdwg_level, cache_dir=shapefile_cache_dir)
+    if 'resolution' in engine_kwargs:
+        get_region_raster(map_df, engine_kwargs['resolution'], cache_dir=engine_kwargs['cache_dir'])
+
+
+def _assign_regions_to_coordinates(engine: str, tdwg_level: int, shapefile_cache_dir: str, engine_kwargs: dict,
+                                   longitudes: np.ndarray, latitudes: np.ndarray) -> np.ndarray:
+    import geopandas
+    map_df = get_tdwg_region_geometries(tdwg_level, cache_dir=shapefile_cache_dir)
+    return _region_assignment_engines[engine](geopandas.points_from_xy(longitudes, latitudes), map_df,
+                                              tdwg_region_code_columns[tdwg_level], **engine_kwargs)
+
+
+def _assign_regions_in_parallel(longitudes: np.ndarray, latitudes: np.ndarray, engine: str, tdwg_level: int,
+                                shapefile_cache_dir: str, n_jobs: int, raster_resolution: float = 0.05) -> np.ndarray:
+    """
+    Split the coordinates into row blocks and assign regions to each block in a process pool. Only the coordinate
+    arrays are sent to the workers. The region geometries (and the raster for the 'raster' engine) are saved to the
+    cache once in this process, and each worker loads them from the cache once, memory mapped. When
+    shapefile_cache_dir isn't given a temporary cache is used. Blocks are returned in order so the output is the
+    same as assigning all the points at once.
+    """
+    import tempfile
+    from concurrent.futures import ProcessPoolExecutor
+    from functools import partial
+
+    with tempfile.TemporaryDirectory() as tmp_cache_dir:
+        if shapefile_cache_dir is None:
+            shapefile_cache_dir = tmp_cache_dir
+        engine_kwargs = _region_engine_kwargs(engine, raster_resolution, shapefile_cache_dir)
+        map_df = get_tdwg_region_geometries(tdwg_level, cache_dir=shapefile_cache_dir)
+        if engine == 'raster':
+            get_region_raster(map_df, raster_resolution, cache_dir=shapefile_cache_dir)
 
+        # Use a few blocks per worker to balance load
+        n_blocks = min(len(longitudes), n_jobs * 4)
+        longitude_blocks = np.array_split(longitudes, n_blocks)
+        latitude_blocks = np.array_split(latitudes, n_blocks)
+        with ProcessPoolExecutor(max_workers=n_jobs, initializer=_init_region_assignment_worker,
+                                 initargs=(tdwg_level, shapefile_cache_dir, engine_kwargs)) as executor:
+            region_blocks = list(tqdm(executor.map(partial(_assign_regions_to_coordinates, engine, tdwg_level,
+                                                           shapefile_cache_dir, engine_kwargs),
+                                                   longitude_blocks, latitude_blocks),
+                                      total=n_blocks, desc="Getting tdwg regions for each block…", ascii=False,
+                                      ncols=82))
+    return np.concatenate(region_blocks)
 
-def get_tdwg_regions_for_occurrences(occ_df: pd.DataFrame) -> pd.DataFrame:
+
+def get_tdwg_regions_for_occurrences(occ_df: pd.DataFrame, engine: str = 'strtree', tdwg_level: int = 3,
+                                     shapefile_cache_dir: str = None, n_jobs: int = 1,
+                                     raster_resolution: float = 0.05) -> pd.DataFrame:
     """
     GET TDWG regions for occurrences
     :param occ_df:
+    :param engine: method used to assign points to regions, one of 'strtree' (spatial index), 'raster' (lookup in
+    a precomputed grid, with exact tests only near region boundaries) or 'loop' (tests each region in turn).
+    All give the same output.
+    :param tdwg_level: TDWG level of regions to find, regions are added to a 'tdwg[tdwg_level]_region' column
+    :param shapefile_cache_dir: directory to cache parsed shapefiles in, see get_tdwg_region_geometries. When
+    n_jobs > 1 workers load the geometries from this cache, or from a temporary cache if not given.
+    :param n_jobs: number of processes to use to assign regions
+    :param raster_resolution: size of grid cells in degrees when using the 'raster' engine. The grid is built the
+    first time it is used and saved to shapefile_cache_dir if given.
     :return:
     """
     import geopandas
 
+    if engine not in _region_assignment_engines:
+        raise ValueError(f'engine must be one of {list(_region_assignment_engines.keys())}')
+
     print('Creating geometries from longitude and latitude')
     # changing to a GeoDataFrame to create geometry series
     occ_gp = geopandas.GeoDataFrame(occ_df,
                                     geometry=geopandas.points_from_xy(occ_df['decimalLongitude'],
                                                                       occ_df['decimalLatitude']))
 
-    ## Add shapefile
-    # set the filepath and load in a shapefile
-    map_df = geopandas.read_file(tdwg3_shpfile)
+    if n_jobs > 1 and len(occ_gp.index) > 0:
+        occ_gp['tdwg' + str(tdwg_level) + '_region'] = _assign_regions_in_parallel(
+            occ_gp['decimalLongitude'].values, occ_gp['decimalLatitude'].values, engine, tdwg_level,
+            shapefile_cache_dir, n_jobs, raster_resolution)
+    else:
+        ## Add shapefile
+        map_df = get_tdwg_region_geometries(tdwg_level, cache_dir=shapefile_cache_dir)
 
-    occ_gp['tdwg3_region'] = ''
-    for idx in tqdm(range(map_df.shape[0]), desc="Getting tdwg regions for each occurrence…", ascii=False,
-                    ncols=82):
-        # For every location, find if they reside within a region
-        pip = occ_gp.within(map_df.loc[idx, 'geometry'])
-        if pip.sum() > 0:  # we found where some of the addresses reside at map_df.loc[idx]
-            occ_gp.loc[pip, 'tdwg3_region'] = map_df.loc[idx, 'LEVEL3_COD']
+        occ_gp['tdwg' + str(tdwg_level) + '_region'] = _region_assignment_engines[engine](
+            occ_gp.geometry.values, map_df, tdwg_region_code_columns[tdwg_level],
+            **_region_engine_kwargs(engine, raster_resolution, shapefile_cache_dir))
 
     print(occ_gp)
     return occ_gp
 
 
+def _occurrences_in_region_lists(df: pd.DataFrame, taxon_col: str, region_col: str,
+                                 region_list_col: str) -> pd.Series:
+    """
+    Whether the region of each occurrence is in the list of regions for its taxon. Distributions are exploded into
+    a set of (taxon, region) keys once and occurrences are looked up in this set, so codes are matched exactly
+    rather than as substrings.
+    :return: Series of 1/0, or nan where the taxon has no regions given
+    """
+    taxon_ids, _ = pd.factorize(df[taxon_col], use_na_sentinel=False)
+    no_regions = df[region_list_col].isna().values
+
+    # Distribution values are the same for every occurrence of a taxon, so only parse them once per taxon
+    _, first_rows = np.unique(taxon_ids, return_index=True)
+    first_rows = first_rows[~no_regions[first_rows]]
+    taxon_regions = pd.Series([_region_codes_in_value(v) for v in df[region_list_col].values[first_rows]],
+                              index=taxon_ids[first_rows], dtype=object).explode().dropna()
+    taxon_region_keys = pd.MultiIndex.from_arrays([taxon_regions.index, taxon_regions.values])
+
+    occurrence_keys = pd.MultiIndex.from_arrays([taxon_ids, df[region_col].values])
+    within = occurrence_keys.isin(taxon_region_keys).astype('float64')
+    within[no_regions] = np.nan
+    within = pd.Series(within, index=df.index)
+    if not no_regions.any():
+        within = within.astype('int64')
+    return within
+
+
 def _find_whether_occurrences_in_native_or_introduced_regions(
         occ_df_with_acc_info_and_tdwg_regions: pd.DataFrame,
         output_csv: str = None,
         tdwg3_region_col_name: str = 'tdwg3_region', include_doubtful: bool = False,
-        include_extinct: bool = False):
+        include_extinct: bool = False, use_distribution_lookup: bool = False, wcvp_version: str = None,
+        distribution_cache_dir: str = None):
     """
     Use occurrence data with tdwg regions to find whether each occurrence is from a native or introduced region.
     Adds 'within_native' and 'within_introduced' columns to dataframe which are binary variables.
@@ -56,51 +233,48 @@ def _find_whether_occurrences_in_native_or_introduced_regions(
     :param distributions_csv:
     :param output_csv:
     :param tdwg3_region_col_name:
+    :param use_distribution_lookup: bool whether to use a cached TaxonDistributionLookup rather than merging
+    distributions onto the occurrences. In this case the distribution columns aren't added to the output.
+    :param wcvp_version: version of WCVP used to key the distribution lookup
+    :param distribution_cache_dir: directory to save distribution lookups to
     :return:
     """
     from wcvpy.wcvp_download import get_distributions_for_accepted_taxa, native_code_column, \
         introduced_code_column, wcvp_accepted_columns
     print('Getting native/introduced data for taxa')
-    ### Match taxa to WCVP regions
-    merged = get_distributions_for_accepted_taxa(occ_df_with_acc_info_and_tdwg_regions,
-                                                 wcvp_accepted_columns['name'],
-                                                 include_doubtful, include_extinct)
-    merged['within_native'] = merged.progress_apply(
-        lambda x: np.nan if x[native_code_column] is np.nan else (
-            1 if x[tdwg3_region_col_name] in x[native_code_column] else 0), axis=1)
-
-    merged['within_introduced'] = merged.progress_apply(
-        lambda x: np.nan if x[introduced_code_column] is np.nan else (
-            1 if x[tdwg3_region_col_name] in x[introduced_code_column] else 0), axis=1)
+    if use_distribution_lookup:
+        lookup = get_taxon_distribution_lookup(
+            occ_df_with_acc_info_and_tdwg_regions[wcvp_accepted_columns['name']].unique(), include_doubtful,
+            include_extinct, wcvp_version=wcvp_version, cache_dir=distribution_cache_dir)
+        taxon_ids = lookup.taxon_ids(occ_df_with_acc_info_and_tdwg_regions[wcvp_accepted_columns['name']].values)
+        region_ids = lookup.region_ids(occ_df_with_acc_info_and_tdwg_regions[tdwg3_region_col_name].values)
+        merged = occ_df_with_acc_info_and_tdwg_regions.copy(deep=False)
+        merged['within_native'] = lookup.within_native(taxon_ids, region_ids)
+        merged['within_introduced'] = lookup.within_introduced(taxon_ids, region_ids)
+
+    else:
+        ### Match taxa to WCVP regions
+        merged = get_distributions_for_accepted_taxa(occ_df_with_acc_info_and_tdwg_regions,
+                                                     wcvp_accepted_columns['name'],
+                                                     include_doubtful, include_extinct)
+        # The distributions are merged on with one row per occurrence, so keep the labels of the occurrences as in
+        # the lookup mode. Otherwise the index restarts for each chunk in clean_occurrences_by_tdwg_regions_in_chunks
+        merged.index = occ_df_with_acc_info_and_tdwg_regions.index
+        merged['within_native'] = _occurrences_in_region_lists(merged, wcvp_accepted_columns['name'],
+                                                               tdwg3_region_col_name, native_code_column)
+
+        merged['within_introduced'] = _occurrences_in_region_lists(merged, wcvp_accepted_columns['name'],
+                                                                   tdwg3_region_col_name, introduced_code_column)
 
     if output_csv is not None:
         merged.to_csv(output_csv)
     return merged
 
 
-def clean_occurrences_by_tdwg_regions(occ_df: pd.DataFrame, name_column: str = 'scientificName',
-                                      clean_by: str = 'native',
-                                      output_csv: str = None, remove_duplicate_records: bool = True,
-                                      remove_duplicated_lat_long_at_rank: str = None,
-                                      include_doubtful: bool = False,
-                                      include_extinct: bool = False, **kwargs):
-    """
-    Use distribution data to remove occurrences outside of native/introduced based on given priority.
-    Distritbution data must be supplied for your families, which can be generated by wcvp_distributions
-    :param include_extinct: bool whether to include extinct regions in distributions
-    :param include_doubtful: bool whether to include doubtful regions in distributions
-    :param remove_duplicated_lat_long_at_rank: string specifying removal of duplicates for given rank
-    :param remove_duplicate_records: bool specifying whether to remove duplicate gbif records
-    :param occ_df: dataframe of gbif occurrences
-    :param clean_by: whether to include introduced regions in cleaning one of 'native' or 'both'
-    :param output_csv:
-    :return:
-    """
+def _remove_duplicate_occurrences(occ_with_acc_info: pd.DataFrame, remove_duplicate_records: bool,
+                                  remove_duplicated_lat_long_at_rank: str = None) -> pd.DataFrame:
     from wcvpy.wcvp_download import wcvp_accepted_columns
-    from wcvpy.wcvp_name_matching import get_accepted_info_from_names_in_column
 
-    occ_with_acc_info = get_accepted_info_from_names_in_column(occ_df, name_column, **kwargs)
-    occ_with_acc_info = occ_with_acc_info.dropna(subset=wcvp_accepted_columns['name'])
     if remove_duplicate_records:
         print('Removing duplicate Gbif IDs')
         occ_with_acc_info = occ_with_acc_info.drop_duplicates(subset=['gbifID'], keep='first')
@@ -116,12 +290,40 @@ def clean_occurrences_by_tdwg_regions(occ_df: pd.DataFrame, name_column: str = '
         elif remove_duplicated_lat_long_at_rank.lower() == 'precise':
             occ_with_acc_info = occ_with_acc_info.drop_duplicates(
                 subset=[wcvp_accepted_columns['name'], 'decimalLatitude', 'decimalLongitude'], keep='first')
+    return occ_with_acc_info
+
+
+def _get_deduplication_indices(remove_duplicate_records: bool, remove_duplicated_lat_long_at_rank: str = None,
+                               index_dir: str = None) -> List[OccurrenceDeduplicationIndex]:
+    """
+    Indices to apply (in order) which match the duplicate removal in _remove_duplicate_occurrences
+    """
+    from wcvpy.wcvp_download import wcvp_accepted_columns
+
+    def _index_file(name):
+        if index_dir is None:
+            return None
+        if not os.path.isdir(index_dir):
+            os.mkdir(index_dir)
+        return os.path.join(index_dir, name + '_index.npy')
+
+    indices = []
+    if remove_duplicate_records:
+        indices.append(OccurrenceDeduplicationIndex(['gbifID'], _index_file('gbifID')))
+    if remove_duplicated_lat_long_at_rank is not None:
+        rank = remove_duplicated_lat_long_at_rank.lower()
+        if rank == 'species':
+            indices.append(OccurrenceDeduplicationIndex(
+                [wcvp_accepted_columns['species'], 'decimalLatitude', 'decimalLongitude'],
+                _index_file('species_lat_long')))
+        elif rank == 'precise':
+            indices.append(OccurrenceDeduplicationIndex(
+                [wcvp_accepted_columns['name'], 'decimalLatitude', 'decimalLongitude'],
+                _index_file('precise_lat_long')))
+    return indices
 
-    occ_with_tdwg = get_tdwg_regions_for_occurrences(occ_with_acc_info)
-    matched_tdwg_info = _find_whether_occurrences_in_native_or_introduced_regions(occ_with_tdwg,
-                                                                                  include_doubtful=include_doubtful,
-                                                                                  include_extinct=include_extinct)
 
+def _filter_occurrences_by_native_or_introduced(matched_tdwg_info: pd.DataFrame, clean_by: str) -> pd.DataFrame:
     if clean_by == 'both':
         print('Allowing both native and introduced')
         out_occ_df = matched_tdwg_info[
@@ -135,8 +337,160 @@ def clean_occurrences_by_tdwg_regions(occ_df: pd.DataFrame, name_column: str = '
 
     else:
         raise ValueError("clean_by must be one of 'native', 'both'")
+    return out_occ_df
+
+
+def clean_occurrences_by_tdwg_regions(occ_df: pd.DataFrame, name_column: str = 'scientificName',
+                                      clean_by: str = 'native',
+                                      output_csv: str = None, remove_duplicate_records: bool = True,
+                                      remove_duplicated_lat_long_at_rank: str = None,
+                                      include_doubtful: bool = False,
+                                      include_extinct: bool = False, use_distribution_lookup: bool = False,
+                                      distribution_cache_dir: str = None, wcvp_cache_dir: str = None,
+                                      engine: str = 'strtree', n_jobs: int = 1, shapefile_cache_dir: str = None,
+                                      raster_resolution: float = 0.05, **kwargs):
+    """
+    Use distribution data to remove occurrences outside of native/introduced based on given priority.
+    Distritbution data must be supplied for your families, which can be generated by wcvp_distributions
+    :param include_extinct: bool whether to include extinct regions in distributions
+    :param include_doubtful: bool whether to include doubtful regions in distributions
+    :param remove_duplicated_lat_long_at_rank: string specifying removal of duplicates for given rank
+    :param remove_duplicate_records: bool specifying whether to remove duplicate gbif records
+    :param occ_df: dataframe of gbif occurrences
+    :param clean_by: whether to include introduced regions in cleaning one of 'native' or 'both'
+    :param output_csv:
+    :param use_distribution_lookup: bool whether to use a cached lookup of taxon distributions, see
+    get_taxon_distribution_lookup
+    :param distribution_cache_dir: directory to save distribution lookups to
+    :param wcvp_cache_dir: directory to save the WCVP taxa table used for name matching to, see get_wcvp_taxa
+    :param engine: method used to assign occurrences to regions, see get_tdwg_regions_for_occurrences
+    :param n_jobs: number of processes to use to assign regions
+    :param shapefile_cache_dir: directory to cache parsed shapefiles in, see get_tdwg_region_geometries
+    :param raster_resolution: size of grid cells in degrees when using the 'raster' engine
+    :return:
+    """
+    from wcvpy.wcvp_download import wcvp_accepted_columns
+    from wcvpy.wcvp_name_matching import get_accepted_info_from_names_in_column
+    from data_compilation_methods import get_wcvp_taxa
+
+    if 'all_taxa' not in kwargs:
+        kwargs['all_taxa'] = get_wcvp_taxa(kwargs.get('wcvp_version'), wcvp_cache_dir)
+    occ_with_acc_info = get_accepted_info_from_names_in_column(occ_df, name_column, **kwargs)
+    occ_with_acc_info = occ_with_acc_info.dropna(subset=wcvp_accepted_columns['name'])
+    occ_with_acc_info = _remove_duplicate_occurrences(occ_with_acc_info, remove_duplicate_records,
+                                                      remove_duplicated_lat_long_at_rank)
+
+    occ_with_tdwg = get_tdwg_regions_for_occurrences(occ_with_acc_info, engine=engine, n_jobs=n_jobs,
+                                                     shapefile_cache_dir=shapefile_cache_dir,
+                                                     raster_resolution=raster_resolution)
+    matched_tdwg_info = _find_whether_occurrences_in_native_or_introduced_regions(
+        occ_with_tdwg, include_doubtful=include_doubtful, include_extinct=include_extinct,
+        use_distribution_lookup=use_distribution_lookup, wcvp_version=kwargs.get('wcvp_version'),
+        distribution_cache_dir=distribution_cache_dir)
+
+    out_occ_df = _filter_occurrences_by_native_or_introduced(matched_tdwg_info, clean_by)
 
     if output_csv is not None:
         out_occ_df.to_csv(output_csv)
 
     return out_occ_df
+
+
+def clean_occurrences_by_tdwg_regions_in_chunks(occurrences: Union[str, Iterable[pd.DataFrame]], output_csv: str,
+                                                name_column: str = 'scientificName',
+                                                clean_by: str = 'native', chunksize: int = 100000,
+                                                remove_duplicate_records: bool = True,
+                                                remove_duplicated_lat_long_at_rank: str = None,
+                                                include_doubtful: bool = False,
+                                                include_extinct: bool = False, read_csv_kwargs: dict = None,
+                                                deduplication_index_dir: str = None,
+                                                use_distribution_lookup: bool = False,
+                                                distribution_cache_dir: str = None, wcvp_cache_dir: str = None,
+                                                engine: str = 'strtree', n_jobs: int = 1,
+                                                shapefile_cache_dir: str = None, raster_resolution: float = 0.05,
+                                                **kwargs) -> int:
+    """
+    Streaming version of clean_occurrences_by_tdwg_regions for occurrence data which is too large to fit in memory.
+    Name matching, region assignment and native/introduced filtering are done one chunk at a time and the cleaned
+    occurrences are appended to output_csv as each chunk is finished, so memory use depends on the chunk size
+    rather than the size of the input.
+    Duplicates are removed across chunks using an OccurrenceDeduplicationIndex, keeping the first record seen. If
+    deduplication_index_dir is given the indices are saved there after each chunk so that later runs also exclude
+    records which have already been output. Later runs with saved indices then append to output_csv, so an
+    interrupted run can be resumed. Otherwise output_csv is replaced.
+    :param occurrences: path to a csv of gbif occurrences, or an iterable of dataframes of occurrences
+    :param output_csv: file to write cleaned occurrences to
+    :param name_column:
+    :param clean_by: whether to include introduced regions in cleaning one of 'native' or 'both'
+    :param chunksize: number of rows to read at a time when occurrences is a path
+    :param remove_duplicate_records: bool specifying whether to remove duplicate gbif records
+    :param remove_duplicated_lat_long_at_rank: string specifying removal of duplicates for given rank
+    :param include_doubtful: bool whether to include doubtful regions in distributions
+    :param include_extinct: bool whether to include extinct regions in distributions
+    :param read_csv_kwargs: kwargs to pass to pd.read_csv when occurrences is a path e.g. {'sep': '\\t'} for
+    gbif downloads
+    :param deduplication_index_dir: directory to load/save indices of records seen
+    :param use_distribution_lookup: bool whether to use a cached lookup of taxon distributions, see
+    get_taxon_distribution_lookup
+    :param distribution_cache_dir: directory to save distribution lookups to
+    :param wcvp_cache_dir: directory to save the WCVP taxa table used for name matching to, see get_wcvp_taxa
+    :param engine: method used to assign occurrences to regions, see get_tdwg_regions_for_occurrences
+    :param n_jobs: number of processes to use to assign regions
+    :param shapefile_cache_dir: directory to cache parsed shapefiles in, see get_tdwg_region_geometries
+    :param raster_resolution: size of grid cells in degrees when using the 'raster' engine
+    :return: number of cleaned occurrences written in this run
+    """
+    from wcvpy.wcvp_download import wcvp_accepted_columns
+    from wcvpy.wcvp_name_matching import get_accepted_info_from_names_in_column
+    from data_compilation_methods import get_wcvp_taxa
+
+    if clean_by not in ['native', 'both']:
+        raise ValueError("clean_by must be one of 'native', 'both'")
+
+    if isinstance(occurrences, str):
+        if read_csv_kwargs is None:
+            read_csv_kwargs = {}
+        occurrences = pd.read_csv(occurrences, chunksize=chunksize, **read_csv_kwargs)
+
+    dedup_indices = _get_deduplication_indices(remove_duplicate_records, remove_duplicated_lat_long_at_rank,
+                                               deduplication_index_dir)
+
+    # Load the checklist once rather than for each chunk
+    if 'all_taxa' not in kwargs:
+        kwargs['all_taxa'] = get_wcvp_taxa(kwargs.get('wcvp_version'), wcvp_cache_dir)
+
+    # When resuming with saved indices, records already output are excluded from this run so the output is appended
+    # to. Otherwise any earlier output is replaced, even if no records are written
+    resuming = any(len(dedup_index) > 0 for dedup_index in dedup_indices) and os.path.isfile(output_csv)
+    if not resuming:
+        open(output_csv, 'w').close()
+
+    number_written = 0
+    for chunk in occurrences:
+        occ_with_acc_info = get_accepted_info_from_names_in_column(chunk, name_column, **kwargs)
+        occ_with_acc_info = occ_with_acc_info.dropna(subset=wcvp_accepted_columns['name'])
+        for dedup_index in dedup_indices:
+            occ_with_acc_info = dedup_index.filter_first_seen(occ_with_acc_info)
+        if len(occ_with_acc_info.index) == 0:
+            continue
+
+        occ_with_tdwg = get_tdwg_regions_for_occurrences(occ_with_acc_info, engine=engine, n_jobs=n_jobs,
+                                                         shapefile_cache_dir=shapefile_cache_dir,
+                                                         raster_resolution=raster_resolution)
+        matched_tdwg_info = _find_whether_occurrences_in_native_or_introduced_regions(
+            occ_with_tdwg, include_doubtful=include_doubtful, include_extinct=include_extinct,
+            use_distribution_lookup=use_distribution_lookup, wcvp_version=kwargs.get('wcvp_version'),
+            distribution_cache_dir=distribution_cache_dir)
+        out_occ_df = _filter_occurrences_by_native_or_introduced(matched_tdwg_info, clean_by)
+
+        # Write the header with the first chunk and append afterwards
+        out_occ_df.to_csv(output_csv, mode='a', header=os.path.getsize(output_csv) == 0)
+        number_written += len(out_occ_df.index)
+
+        # Save the indices once the records of the chunk are written, so that an interrupted run can be resumed
+        # without losing records
+        if deduplication_index_dir is not None:
+            for dedup_index in dedup_indices:
+                dedup_index.save()
+
+    return number_written
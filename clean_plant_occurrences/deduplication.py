@@ -0,0 +1,90 @@
+import os
+from typing import List
+
+import numpy as np
+import pandas as pd
+
+
+def _hash_keys(df: pd.DataFrame, key_columns: List[str]) -> np.ndarray:
+    """
+    Hash the given columns of each row to a uint64. Numeric columns are cast to float so that e.g. ids read as
+    ints in one chunk and floats in another (when the chunk contains missing values) give the same hash.
+    """
+    keys = df[key_columns].copy()
+    for c in key_columns:
+        if pd.api.types.is_numeric_dtype(keys[c]):
+            # Adding 0.0 also maps -0.0 to 0.0
+            keys[c] = keys[c].astype('float64') + 0.0
+    return pd.util.hash_pandas_object(keys, index=False).values
+
+
+class OccurrenceDeduplicationIndex:
+    """
+    Records which keys have been seen across chunks (and optionally across runs) so that duplicates can be removed
+    from data which can't be loaded in one go.
+    Keys are stored as sorted runs of uint64 hashes, which is much more compact than a dataframe of the keys.
+    Runs are merged as they are added so that there are never more than ~log2(n) runs to search.
+    Note as keys are hashed there is a very small chance (~n^2/2^65) of a false duplicate.
+    """
+
+    def __init__(self, key_columns: List[str], index_file: str = None):
+        """
+        :param key_columns: columns which together identify a duplicate
+        :param index_file: .npy file to load previously seen keys from and save to
+        """
+        self.key_columns = key_columns
+        self.index_file = index_file
+        self._runs = []
+        if index_file is not None and os.path.isfile(index_file):
+            self._runs.append(np.load(index_file, mmap_mode='r'))
+
+    def __len__(self):
+        return sum(len(r) for r in self._runs)
+
+    def _seen(self, hashes: np.ndarray) -> np.ndarray:
+        seen = np.zeros(len(hashes), dtype=bool)
+        for run in self._runs:
+            if len(run) == 0:
+                continue
+            positions = np.searchsorted(run, hashes)
+            in_run = positions < len(run)
+            seen[in_run] |= run[positions[in_run]] == hashes[in_run]
+        return seen
+
+    def _add(self, hashes: np.ndarray):
+        if len(hashes) == 0:
+            return
+        self._runs.append(np.unique(hashes))
+        # Merge runs while the newest is at least as large as the one before it
+        while len(self._runs) > 1 and len(self._runs[-1]) >= len(self._runs[-2]):
+            newest = self._runs.pop()
+            self._runs[-1] = np.union1d(self._runs[-1], newest)
+
+    def filter_first_seen(self, df: pd.DataFrame) -> pd.DataFrame:
+        """
+        Remove rows whose keys have already been seen, either earlier in df or in previously filtered data, and
+        record the keys of the remaining rows.
+        :param df:
+        :return: df without duplicates, equivalent to drop_duplicates(subset=key_columns, keep='first') over all
+        data given to the index
+        """
+        hashes = _hash_keys(df, self.key_columns)
+        keep = ~(pd.Series(hashes).duplicated(keep='first').values | self._seen(hashes))
+        self._add(hashes[keep])
+        return df[keep]
+
+    def save(self):
+        """
+        Write all keys seen to index_file as a single sorted array.
+        """
+        if self.index_file is None:
+            raise ValueError('No index_file given to save to')
+        if len(self._runs) == 0:
+            all_hashes = np.array([], dtype=np.uint64)
+        else:
+            all_hashes = np.unique(np.concatenate(self._runs))
+        # Write to a temporary file first in case the existing index is memory mapped
+        temp_file = self.index_file + '.tmp.npy'
+        np.save(temp_file, all_hashes)
+        self._runs = [all_hashes]
+        os.replace(temp_file, self.index_file)
@@ -0,0 +1,212 @@
+import os
+import re
+from typing import Iterable, List
+
+import numpy as np
+import pandas as pd
+
+# Lookups already loaded/built in this process, keyed by (wcvp_version, include_doubtful, include_extinct)
+_loaded_lookups = {}
+
+
+def _region_codes_in_value(value) -> List[str]:
+    """
+    Region codes from a distribution value, which may be a list of codes or a string representation of one
+    e.g. "['ABC', 'DEF']"
+    """
+    if isinstance(value, str):
+        return [c for c in re.split(r"[\s,;|\[\]'\"]+", value) if c != '']
+    return list(value)
+
+
+def _is_missing(value) -> bool:
+    return value is None or (isinstance(value, float) and np.isnan(value))
+
+
+def _region_bitsets(region_lists: Iterable, region_index: dict, n_words: int) -> np.ndarray:
+    bits = np.zeros((len(region_lists), n_words), dtype=np.uint64)
+    for i, regions in enumerate(region_lists):
+        for r in regions:
+            rid = region_index[r]
+            bits[i, rid // 64] |= np.uint64(1) << np.uint64(rid % 64)
+    return bits
+
+
+class TaxonDistributionLookup:
+    """
+    Native and introduced regions of accepted taxa, stored as one bitset of region ids per taxon.
+    Occurrences then only need a taxon id and a region id and membership is a bit test, rather than merging the
+    distribution strings onto every occurrence.
+    """
+
+    def __init__(self):
+        self.taxa = []
+        self.regions = []
+        self._taxon_index = {}
+        self._region_index = {}
+        # pd.Index of taxa and regions for vectorised lookups, rebuilt when taxa are added
+        self._taxon_labels = None
+        self._region_labels = None
+        self.native_bits = np.zeros((0, 1), dtype=np.uint64)
+        self.introduced_bits = np.zeros((0, 1), dtype=np.uint64)
+        # Whether any native/introduced regions are given for each taxon
+        self.has_native = np.zeros(0, dtype=bool)
+        self.has_introduced = np.zeros(0, dtype=bool)
+
+    def __contains__(self, taxon):
+        return taxon in self._taxon_index
+
+    def taxon_ids(self, taxa: Iterable) -> np.ndarray:
+        """
+        :return: id of each taxon in the lookup, or -1 for taxa not in the lookup
+        """
+        if self._taxon_labels is None:
+            self._taxon_labels = pd.Index(self.taxa, dtype=object)
+        return self._taxon_labels.get_indexer(pd.Index(taxa, dtype=object)).astype(np.int64)
+
+    def region_ids(self, regions: Iterable) -> np.ndarray:
+        """
+        :return: id of each region in the lookup, or -1 for regions not in the lookup
+        """
+        if self._region_labels is None:
+            self._region_labels = pd.Index(self.regions, dtype=object)
+        return self._region_labels.get_indexer(pd.Index(regions, dtype=object)).astype(np.int64)
+
+    def add_taxa(self, distributions_df: pd.DataFrame, taxon_col: str, native_col: str, introduced_col: str):
+        """
+        Add taxa to the lookup from a dataframe with one row per taxon. Taxa already in the lookup are ignored.
+        """
+        new_taxa = distributions_df[~distributions_df[taxon_col].isin(self._taxon_index.keys())]
+        new_taxa = new_taxa.drop_duplicates(subset=[taxon_col])
+        if len(new_taxa.index) == 0:
+            return
+
+        native_lists = [[] if _is_missing(v) else _region_codes_in_value(v) for v in new_taxa[native_col].values]
+        introduced_lists = [[] if _is_missing(v) else _region_codes_in_value(v) for v in
+                            new_taxa[introduced_col].values]
+
+        for region_list in native_lists + introduced_lists:
+            for r in region_list:
+                if r not in self._region_index:
+                    self._region_index[r] = len(self.regions)
+                    self.regions.append(r)
+
+        n_words = max(1, -(-len(self.regions) // 64))
+        if n_words > self.native_bits.shape[1]:
+            extra_words = ((0, 0), (0, n_words - self.native_bits.shape[1]))
+            self.native_bits = np.pad(self.native_bits, extra_words)
+            self.introduced_bits = np.pad(self.introduced_bits, extra_words)
+
+        self.native_bits = np.vstack(
+            [self.native_bits, _region_bitsets(native_lists, self._region_index, n_words)])
+        self.introduced_bits = np.vstack(
+            [self.introduced_bits, _region_bitsets(introduced_lists, self._region_index, n_words)])
+        self.has_native = np.append(self.has_native, new_taxa[native_col].notna().values)
+        self.has_introduced = np.append(self.has_introduced, new_taxa[introduced_col].notna().values)
+
+        for t in new_taxa[taxon_col].values:
+            self._taxon_index[t] = len(self.taxa)
+            self.taxa.append(t)
+        self._taxon_labels = None
+        self._region_labels = None
+
+    def _within(self, bits: np.ndarray, has_regions: np.ndarray, taxon_ids: np.ndarray,
+                region_ids: np.ndarray) -> np.ndarray:
+        within = np.full(len(taxon_ids), np.nan)
+        known_taxa = taxon_ids >= 0
+        known_taxa[known_taxa] = has_regions[taxon_ids[known_taxa]]
+        within[known_taxa] = 0
+
+        to_test = known_taxa & (region_ids >= 0)
+        rids = region_ids[to_test]
+        words = bits[taxon_ids[to_test], rids // 64]
+        within[to_test] = (words >> (rids % 64).astype(np.uint64)) & np.uint64(1)
+        # As in _occurrences_in_region_lists, values are integers unless some are missing
+        if not np.isnan(within).any():
+            within = within.astype(np.int64)
+        return within
+
+    def within_native(self, taxon_ids: np.ndarray, region_ids: np.ndarray) -> np.ndarray:
+        """
+        :return: 1/0 whether each region is native for the taxon, nan where the taxon has no native regions. The
+        dtype is int64 when there are no nans
+        """
+        return self._within(self.native_bits, self.has_native, taxon_ids, region_ids)
+
+    def within_introduced(self, taxon_ids: np.ndarray, region_ids: np.ndarray) -> np.ndarray:
+        """
+        :return: 1/0 whether each region is introduced for the taxon, nan where the taxon has no introduced regions.
+        The dtype is int64 when there are no nans
+        """
+        return self._within(self.introduced_bits, self.has_introduced, taxon_ids, region_ids)
+
+    def save(self, npz_file: str):
+        np.savez(npz_file, taxa=np.array(self.taxa, dtype=str), regions=np.array(self.regions, dtype=str),
+                 native_bits=self.native_bits, introduced_bits=self.introduced_bits,
+                 has_native=self.has_native, has_introduced=self.has_introduced)
+
+    @classmethod
+    def load(cls, npz_file: str):
+        lookup = cls()
+        with np.load(npz_file) as data:
+            lookup.taxa = data['taxa'].tolist()
+            lookup.regions = data['regions'].tolist()
+            lookup.native_bits = data['native_bits']
+            lookup.introduced_bits = data['introduced_bits']
+            lookup.has_native = data['has_native']
+            lookup.has_introduced = data['has_introduced']
+        lookup._taxon_index = {t: i for i, t in enumerate(lookup.taxa)}
+        lookup._region_index = {r: i for i, r in enumerate(lookup.regions)}
+        return lookup
+
+
+def _lookup_file(cache_dir: str, wcvp_version: str, include_doubtful: bool, include_extinct: bool) -> str:
+    return os.path.join(cache_dir, '_'.join(
+        ['distributions', wcvp_version, 'doubtful' if include_doubtful else 'nodoubtful',
+         'extinct' if include_extinct else 'noextinct']) + '.npz')
+
+
+def get_taxon_distribution_lookup(taxa: Iterable[str], include_doubtful: bool = False,
+                                  include_extinct: bool = False, wcvp_version: str = None,
+                                  cache_dir: str = None) -> TaxonDistributionLookup:
+    """
+    Get a TaxonDistributionLookup containing the given accepted taxa. Lookups are kept for the rest of the process
+    and, when both wcvp_version and cache_dir are given, saved to disk so distributions only need to be found once for
+    each taxon.
+    :param taxa: accepted names of taxa to include
+    :param include_doubtful: bool whether to include doubtful regions in distributions
+    :param include_extinct: bool whether to include extinct regions in distributions
+    :param wcvp_version:
+    :param cache_dir: directory to save lookups to
+    :return:
+    """
+    from wcvpy.wcvp_download import get_distributions_for_accepted_taxa, native_code_column, \
+        introduced_code_column, wcvp_accepted_columns
+
+    key = (wcvp_version, include_doubtful, include_extinct)
+    # Lookups for an unspecified version aren't saved as they will go out of date
+    lookup_file = None
+    if cache_dir is not None and wcvp_version is not None:
+        lookup_file = _lookup_file(cache_dir, wcvp_version, include_doubtful, include_extinct)
+
+    if key not in _loaded_lookups:
+        if lookup_file is not None and os.path.isfile(lookup_file):
+            _loaded_lookups[key] = TaxonDistributionLookup.load(lookup_file)
+        else:
+            _loaded_lookups[key] = TaxonDistributionLookup()
+    lookup = _loaded_lookups[key]
+
+    missing_taxa = [t for t in pd.unique(pd.Series(list(taxa), dtype=object).dropna()) if t not in lookup]
+    if len(missing_taxa) > 0:
+        print(f'Getting distributions for {len(missing_taxa)} taxa')
+        taxa_df = pd.DataFrame({wcvp_accepted_columns['name']: missing_taxa})
+        version_kwargs = {} if wcvp_version is None else {'wcvp_version': wcvp_version}
+        distributions = get_distributions_for_accepted_taxa(taxa_df, wcvp_accepted_columns['name'],
+                                                            include_doubtful, include_extinct, **version_kwargs)
+        lookup.add_taxa(distributions, wcvp_accepted_columns['name'], native_code_column, introduced_code_column)
+        if lookup_file is not None:
+            if not os.path.isdir(cache_dir):
+                os.mkdir(cache_dir)
+            lookup.save(lookup_file)
+
+    return lookup
@@ -0,0 +1,112 @@
+import os
+
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+
+# Cell labels which aren't region indices
+EMPTY_CELL = -1
+BOUNDARY_CELL = -2
+
+# Cells are expanded by this many degrees when labelling so that points placed in a cell despite floating point
+# error in computing the cell index are still inside the labelled area
+_cell_margin = 1e-9
+
+# Rasters already loaded/built in this process, keyed by (level, shapefile fingerprint, resolution)
+_loaded_region_rasters = {}
+
+
+def _raster_shape(resolution: float):
+    return int(np.ceil(180 / resolution)), int(np.ceil(360 / resolution))
+
+
+def build_region_raster(map_df: pd.DataFrame, resolution: float = 0.05) -> np.ndarray:
+    """
+    Label each cell of a global longitude/latitude grid with the index of the region polygon which contains the
+    whole cell, EMPTY_CELL where no region touches the cell, or BOUNDARY_CELL otherwise. Cells are only given a
+    region where that region is the only one touching the cell and properly contains it, so every point in the cell
+    is within that region and no other.
+    :param map_df: GeoDataFrame of region polygons
+    :param resolution: size of cells in degrees
+    :return: array of shape (latitude cells, longitude cells), with row 0 starting at -90 and column 0 at -180
+    """
+    import shapely
+
+    n_rows, n_cols = _raster_shape(resolution)
+    raster = np.full((n_rows, n_cols), EMPTY_CELL, dtype=np.int16)
+    polygons = np.asarray(map_df.geometry.values)
+    shapely.prepare(polygons)
+
+    min_x = -180 + np.arange(n_cols) * resolution - _cell_margin
+    max_x = -180 + (np.arange(n_cols) + 1) * resolution + _cell_margin
+    _, bounds_min_y, _, bounds_max_y = map_df.total_bounds
+    for row in tqdm(range(n_rows), desc="Building region raster…", ascii=False, ncols=82):
+        min_y = -90 + row * resolution - _cell_margin
+        max_y = -90 + (row + 1) * resolution + _cell_margin
+        if max_y < bounds_min_y or min_y > bounds_max_y:
+            continue
+        cells = shapely.box(min_x, min_y, max_x, max_y)
+        cell_idx, region_idx = map_df.sindex.query(cells, predicate='intersects')
+        if len(cell_idx) == 0:
+            continue
+        regions_touching = np.bincount(cell_idx, minlength=n_cols)
+        raster[row, regions_touching > 1] = BOUNDARY_CELL
+
+        single = regions_touching[cell_idx] == 1
+        single_cells = cell_idx[single]
+        single_regions = region_idx[single]
+        contained = shapely.contains_properly(polygons[single_regions], cells[single_cells])
+        raster[row, single_cells[contained]] = single_regions[contained]
+        raster[row, single_cells[~contained]] = BOUNDARY_CELL
+
+    return raster
+
+
+def get_region_raster(map_df: pd.DataFrame, resolution: float = 0.05, cache_dir: str = None) -> np.ndarray:
+    """
+    Get the raster from build_region_raster for the given regions. When map_df comes from get_tdwg_region_geometries
+    rasters are cached for the rest of the process and, if cache_dir is given, saved there and memory mapped on later
+    loads.
+    :param map_df:
+    :param resolution: size of cells in degrees
+    :param cache_dir: directory to save rasters to
+    :return:
+    """
+    if 'shapefile_fingerprint' not in map_df.attrs:
+        return build_region_raster(map_df, resolution)
+
+    key = (map_df.attrs['tdwg_level'], map_df.attrs['shapefile_fingerprint'], resolution)
+    raster_file = None
+    if cache_dir is not None:
+        raster_file = os.path.join(cache_dir, '_'.join(['tdwg' + str(key[0]), key[1], 'raster', str(resolution)])
+                                   + '.npy')
+    if key not in _loaded_region_rasters:
+        if raster_file is not None and os.path.isfile(raster_file):
+            _loaded_region_rasters[key] = np.load(raster_file, mmap_mode='r')
+        else:
+            _loaded_region_rasters[key] = build_region_raster(map_df, resolution)
+
+    # Rasters built before without a cache_dir are also saved, so that other processes can load them
+    if raster_file is not None and not os.path.isfile(raster_file):
+        os.makedirs(cache_dir, exist_ok=True)
+        # As for the geometries, write to a temporary file so that a partly written raster is never loaded
+        tmp_file = raster_file + '.' + str(os.getpid()) + '.tmp.npy'
+        np.save(tmp_file, _loaded_region_rasters[key])
+        os.replace(tmp_file, raster_file)
+    return _loaded_region_rasters[key]
+
+
+def lookup_region_raster(raster: np.ndarray, resolution: float, longitudes: np.ndarray,
+                         latitudes: np.ndarray) -> np.ndarray:
+    """
+    Cell labels for the given coordinates. Coordinates which are missing or outside the grid are labelled
+    BOUNDARY_CELL so that they are checked exactly.
+    """
+    n_rows, n_cols = raster.shape
+    with np.errstate(invalid='ignore'):
+        cols = np.floor((longitudes + 180) / resolution)
+        rows = np.floor((latitudes + 90) / resolution)
+    in_grid = (cols >= 0) & (cols < n_cols) & (rows >= 0) & (rows < n_rows)
+    labels = np.full(len(longitudes), BOUNDARY_CELL, dtype=np.int16)
+    labels[in_grid] = raster[rows[in_grid].astype(np.int64), cols[in_grid].astype(np.int64)]
+    return labels
@@ -0,0 +1,86 @@
+import hashlib
+import os
+
+import numpy as np
+import pandas as pd
+from pkg_resources import resource_filename
+
+_inputs_path = resource_filename(__name__, 'inputs')
+
+
+def get_tdwg_shpfile(level: int) -> str:
+    # Shapefiles from https://github.com/tdwg/wgsrpd
+    return os.path.join(_inputs_path, 'wgsrpd-master', 'level' + str(level), 'level' + str(level) + '.shp')
+
+
+tdwg3_shpfile = get_tdwg_shpfile(3)
+
+# Column containing the region codes in the shapefile for each level
+tdwg_region_code_columns = {1: 'LEVEL1_COD', 2: 'LEVEL2_COD', 3: 'LEVEL3_COD', 4: 'Level4_cod'}
+
+# Geometries already loaded in this process, keyed by (level, shapefile fingerprint)
+_loaded_region_geometries = {}
+
+
+def _shapefile_fingerprint(shpfile: str) -> str:
+    """
+    Fingerprint from the modification times and sizes of the shapefile and its sidecar files, so that caches are
+    invalidated when the shapefile changes.
+    """
+    stats = []
+    for ext in ['.shp', '.shx', '.dbf', '.prj']:
+        component = os.path.splitext(shpfile)[0] + ext
+        if os.path.isfile(component):
+            stat = os.stat(component)
+            stats.append((ext, stat.st_mtime_ns, stat.st_size))
+    return hashlib.md5(str(stats).encode()).hexdigest()
+
+
+def get_tdwg_region_geometries(level: int = 3, cache_dir: str = None) -> pd.DataFrame:
+    """
+    Get a GeoDataFrame of TDWG regions at the given level with prepared geometries and a built spatial index.
+    Geometries are cached for the rest of the process. If cache_dir is given they are also saved there as GeoParquet
+    and later loads are memory mapped from this file rather than parsing the shapefile.
+    Note that the returned dataframe is shared between calls so should not be modified.
+    :param level: TDWG level, one of 1, 2, 3 or 4. Only the level 3 shapefile is packaged, for other levels add the
+    shapefile from https://github.com/tdwg/wgsrpd to the inputs/wgsrpd-master folder
+    :param cache_dir: directory to save GeoParquet files to (requires pyarrow)
+    :return:
+    """
+    import geopandas
+    import shapely
+
+    if level not in tdwg_region_code_columns:
+        raise ValueError(f'level must be one of {list(tdwg_region_code_columns.keys())}')
+    shpfile = get_tdwg_shpfile(level)
+    if not os.path.isfile(shpfile):
+        raise FileNotFoundError(f'No shapefile found for TDWG level {level} at {shpfile}')
+
+    fingerprint = _shapefile_fingerprint(shpfile)
+    key = (level, fingerprint)
+    parquet_file = None
+    if cache_dir is not None:
+        parquet_file = os.path.join(cache_dir, 'tdwg' + str(level) + '_' + fingerprint + '.parquet')
+
+    if key not in _loaded_region_geometries:
+        if parquet_file is not None and os.path.isfile(parquet_file):
+            map_df = geopandas.read_parquet(parquet_file, memory_map=True)
+        else:
+            map_df = geopandas.read_file(shpfile)
+
+        map_df.attrs['tdwg_level'] = level
+        map_df.attrs['shapefile_fingerprint'] = fingerprint
+        shapely.prepare(np.asarray(map_df.geometry.values))
+        # Accessing sindex builds the spatial index so it is cached with the geometries
+        map_df.sindex
+        _loaded_region_geometries[key] = map_df
+
+    # Geometries loaded before without a cache_dir are also saved, so that other processes can load them
+    if parquet_file is not None and not os.path.isfile(parquet_file):
+        os.makedirs(cache_dir, exist_ok=True)
+        # Write to a temporary file first so that other processes never read a partly written cache
+        tmp_file = parquet_file + '.' + str(os.getpid()) + '.tmp'
+        _loaded_region_geometries[key].to_parquet(tmp_file)
+        os.replace(tmp_file, parquet_file)
+
+    return _loaded_region_geometries[key]
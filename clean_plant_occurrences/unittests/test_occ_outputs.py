@@ -1,13 +1,17 @@
 import os
+import tempfile
 import unittest
 
 import pandas as pd
 from wcvpy.wcvp_name_matching import get_accepted_info_from_names_in_column
 from pkg_resources import resource_filename
 
-from clean_plant_occurrences import clean_occurrences_by_tdwg_regions
+from clean_plant_occurrences import clean_occurrences_by_tdwg_regions, OccurrenceDeduplicationIndex, \
+    clean_occurrences_by_tdwg_regions_in_chunks, TaxonDistributionLookup
 from clean_plant_occurrences.clean_by_tdwg_region import \
-    _find_whether_occurrences_in_native_or_introduced_regions, get_tdwg_regions_for_occurrences
+    _find_whether_occurrences_in_native_or_introduced_regions, get_tdwg_regions_for_occurrences, \
+    _occurrences_in_region_lists
+from clean_plant_occurrences.tdwg_shapefiles import get_tdwg_region_geometries, _loaded_region_geometries
 
 input_test_dir = resource_filename(__name__, 'test_inputs')
 test_output_dir = resource_filename(__name__, 'test_outputs')
@@ -56,6 +60,50 @@ class MyTestCase(unittest.TestCase):
         self.assertListEqual(dist_records_with_tdwg['known_region'].tolist(),
                              dist_records_with_tdwg['tdwg3_region'].tolist())
 
+    def test_region_engines_agree(self):
+        dist_records = pd.read_csv(os.path.join(input_test_dir, 'occ_region_test.csv'))
+        strtree_regions = get_tdwg_regions_for_occurrences(dist_records, engine='strtree')
+        loop_regions = get_tdwg_regions_for_occurrences(dist_records, engine='loop')
+        self.assertListEqual(loop_regions['tdwg3_region'].tolist(), strtree_regions['tdwg3_region'].tolist())
+        raster_regions = get_tdwg_regions_for_occurrences(dist_records, engine='raster', raster_resolution=0.5)
+        self.assertListEqual(raster_regions['tdwg3_region'].tolist(), strtree_regions['tdwg3_region'].tolist())
+
+    def test_region_assignment_in_parallel(self):
+        dist_records = pd.read_csv(os.path.join(input_test_dir, 'occ_region_test.csv'))
+        single_process_regions = get_tdwg_regions_for_occurrences(dist_records)
+        for engine in ['strtree', 'raster']:
+            parallel_regions = get_tdwg_regions_for_occurrences(dist_records, engine=engine, n_jobs=2,
+                                                                raster_resolution=0.5)
+            self.assertListEqual(single_process_regions['tdwg3_region'].tolist(),
+                                 parallel_regions['tdwg3_region'].tolist())
+
+    def test_shapefile_cache(self):
+        dist_records = pd.read_csv(os.path.join(input_test_dir, 'occ_region_test.csv'))
+        with tempfile.TemporaryDirectory() as cache_dir:
+            _loaded_region_geometries.clear()
+            parsed = get_tdwg_region_geometries(3, cache_dir=cache_dir)
+            self.assertEqual(len([f for f in os.listdir(cache_dir) if f.endswith('.parquet')]), 1)
+
+            # Load again from the GeoParquet file rather than the geometries kept in this process
+            _loaded_region_geometries.clear()
+            cached = get_tdwg_region_geometries(3, cache_dir=cache_dir)
+            self.assertIsNot(parsed, cached)
+            self.assertListEqual(parsed['LEVEL3_COD'].tolist(), cached['LEVEL3_COD'].tolist())
+            self.assertTrue(parsed.geometry.geom_equals(cached.geometry).all())
+
+            dist_records_with_tdwg = get_tdwg_regions_for_occurrences(dist_records, shapefile_cache_dir=cache_dir)
+            self.assertListEqual(dist_records_with_tdwg['known_region'].tolist(),
+                                 dist_records_with_tdwg['tdwg3_region'].tolist())
+            _loaded_region_geometries.clear()
+
+    def test_region_codes_match_exactly(self):
+        occurrences = pd.DataFrame({'taxon': ['A', 'A', 'A', 'B'], 'region': ['AB', 'ABC', 'BC', 'AB'],
+                                    'native': ["['ABC', 'DEF']", "['ABC', 'DEF']", "['ABC', 'DEF']", None]})
+        within = _occurrences_in_region_lists(occurrences, 'taxon', 'region', 'native')
+        # Codes which are substrings of a native code aren't native
+        self.assertEqual(within.iloc[:3].tolist(), [0, 1, 0])
+        self.assertTrue(pd.isna(within.iloc[3]))
+
     def test_native_introduced_matching(self):
         dist_records = pd.read_csv(os.path.join(input_test_dir, 'occ_region_test.csv'))
         dist_records_wiht_acc_info = get_accepted_info_from_names_in_column(dist_records, 'fullname',
@@ -86,6 +134,78 @@ class MyTestCase(unittest.TestCase):
         bad_records = native_cleaned[native_cleaned['gbifID'].isin([9991, 9992])]
         self.assertEqual(len(bad_records), 0)
 
+    def test_deduplication_index_across_chunks(self):
+        good_native_records = pd.read_csv(os.path.join(input_test_dir, 'native_ok.csv'))
+        key_columns = ['fullname', 'decimalLatitude', 'decimalLongitude']
+        dedup_index = OccurrenceDeduplicationIndex(key_columns)
+        chunks = [good_native_records.iloc[i:i + 3] for i in range(0, len(good_native_records.index), 3)]
+        deduplicated = pd.concat([dedup_index.filter_first_seen(c) for c in chunks])
+
+        expected = good_native_records.drop_duplicates(subset=key_columns, keep='first')
+        pd.testing.assert_frame_equal(expected, deduplicated)
+
+    def test_distribution_lookup_matches_region_lists(self):
+        distributions = pd.DataFrame({'taxon': ['A', 'B', 'C', 'D'],
+                                      'native': ["['ABC', 'DEF']", "['AB']", None, "['ABC']"],
+                                      'introduced': ["['GHI']", None, "['AB', 'XYZ']", "['DEF']"]})
+        lookup = TaxonDistributionLookup()
+        lookup.add_taxa(distributions, 'taxon', 'native', 'introduced')
+
+        occurrences = pd.DataFrame({'taxon': ['A', 'A', 'B', 'B', 'C', 'D', 'E', 'A'],
+                                    'region': ['ABC', 'AB', 'ABC', 'AB', 'XYZ', 'DEF', 'ABC', '']},
+                                   index=[5, 3, 8, 1, 0, 2, 7, 4])
+        occurrences = occurrences.merge(distributions, on='taxon', how='left').set_index(occurrences.index)
+        taxon_ids = lookup.taxon_ids(occurrences['taxon'].values)
+        region_ids = lookup.region_ids(occurrences['region'].values)
+        for region_list_col, lookup_within in [('native', lookup.within_native),
+                                               ('introduced', lookup.within_introduced)]:
+            expected = _occurrences_in_region_lists(occurrences, 'taxon', 'region', region_list_col)
+            pd.testing.assert_series_equal(expected, pd.Series(lookup_within(taxon_ids, region_ids),
+                                                               index=occurrences.index))
+
+        # Without missing distributions both give integers
+        known = occurrences[occurrences['taxon'].isin(['A', 'D'])]
+        expected = _occurrences_in_region_lists(known, 'taxon', 'region', 'native')
+        within = lookup.within_native(lookup.taxon_ids(known['taxon'].values),
+                                      lookup.region_ids(known['region'].values))
+        self.assertEqual(expected.dtype, 'int64')
+        pd.testing.assert_series_equal(expected, pd.Series(within, index=known.index))
+
+    def test_chunked_cleaning_matches_in_memory(self):
+        good_native_records = pd.read_csv(os.path.join(input_test_dir, 'native_ok.csv'))
+        for use_distribution_lookup in [False, True]:
+            clean_occurrences_by_tdwg_regions(good_native_records, name_column='fullname', clean_by='both',
+                                              output_csv=os.path.join(test_output_dir, 'in_memory_cleaned.csv'),
+                                              remove_duplicated_lat_long_at_rank='species',
+                                              use_distribution_lookup=use_distribution_lookup)
+            clean_occurrences_by_tdwg_regions_in_chunks(os.path.join(input_test_dir, 'native_ok.csv'),
+                                                        os.path.join(test_output_dir, 'chunked_cleaned.csv'),
+                                                        name_column='fullname', clean_by='both', chunksize=3,
+                                                        remove_duplicated_lat_long_at_rank='species',
+                                                        use_distribution_lookup=use_distribution_lookup)
+            in_memory = pd.read_csv(os.path.join(test_output_dir, 'in_memory_cleaned.csv'), index_col=0)
+            chunked = pd.read_csv(os.path.join(test_output_dir, 'chunked_cleaned.csv'), index_col=0)
+            self.assertFalse(chunked.index.duplicated().any())
+            pd.testing.assert_frame_equal(in_memory, chunked, check_dtype=False)
+
+    def test_chunked_cleaning_resumes_with_deduplication_index(self):
+        good_native_records = pd.read_csv(os.path.join(input_test_dir, 'native_ok.csv'))
+        chunks = [good_native_records.iloc[i:i + 3] for i in range(0, len(good_native_records.index), 3)]
+        clean_occurrences_by_tdwg_regions_in_chunks(chunks, os.path.join(test_output_dir, 'chunked_cleaned.csv'),
+                                                    name_column='fullname', clean_by='both')
+        with tempfile.TemporaryDirectory() as index_dir:
+            resumed_csv = os.path.join(test_output_dir, 'resumed_cleaned.csv')
+            # Earlier output is replaced by a new run, even if it writes nothing
+            clean_occurrences_by_tdwg_regions_in_chunks([], resumed_csv, name_column='fullname', clean_by='both')
+            self.assertEqual(os.path.getsize(resumed_csv), 0)
+            # Rerunning over all the chunks after an interrupted run only adds the records not yet written
+            for run_chunks in [chunks[:2], chunks]:
+                clean_occurrences_by_tdwg_regions_in_chunks(run_chunks, resumed_csv, name_column='fullname',
+                                                            clean_by='both', deduplication_index_dir=index_dir)
+        chunked = pd.read_csv(os.path.join(test_output_dir, 'chunked_cleaned.csv'), index_col=0)
+        resumed = pd.read_csv(resumed_csv, index_col=0)
+        pd.testing.assert_frame_equal(chunked, resumed, check_dtype=False)
+
 
 if __name__ == '__main__':
     unittest.main()
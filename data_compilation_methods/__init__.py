@@ -1,3 +1,6 @@
 from .compiling_datasets import *
+from .incremental_compiling import *
+from .out_of_core_compiling import *
 from .preparing_datasets import *
-from .source_breakdown import *
\ No newline at end of file
+from .source_breakdown import *
+from .wcvp_taxa import *
@@ -1,6 +1,7 @@
 import os
-from typing import List
+from typing import List, Tuple
 
+import numpy as np
 import pandas as pd
 
 single_source_col = 'Source'
@@ -27,44 +28,282 @@ def _aggregate_data_on_accepted_names(in_df: pd.DataFrame) -> pd.DataFrame:
     return df
 
 
-def compile_hits(all_dfs: List[pd.DataFrame], output_csv: str) -> pd.DataFrame:
-    '''
-    Dataframes should contain the following headings 'Source', '[sourcename]_snippet', 'Accepted_Name',
-    'Accepted_Species', 'Accepted_Rank' and 'Accepted_ID'
-    :param all_dfs: List of dataframes to merge together
-    :param output_csv: Output file
+def _source_codes(sources) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Categorical codes of sources, with the categories sorted so that sorting codes sorts the sources. Missing sources
+    are given the last code, as they are sorted last.
+    :return: codes and categories
+    """
+    codes, categories = pd.factorize(sources, sort=True)
+    categories = np.asarray(categories, dtype=object)
+    if (codes == -1).any():
+        codes = np.where(codes == -1, len(categories), codes)
+        categories = np.append(categories, np.nan)
+    return codes, categories
+
+
+def _aggregate_data_on_accepted_names_by_hashing(in_df: pd.DataFrame) -> pd.DataFrame:
+    """
+    As _aggregate_data_on_accepted_names, but collecting the sources of each name from the unique (name, source) pairs
+    of categorical codes rather than applying a function to each group.
+    """
+    from wcvpy.wcvp_download import wcvp_accepted_columns
+
+    name_col = wcvp_accepted_columns['name_w_author']
+    # Names are coded in order of first appearance, which is the order of rows after dropping duplicate names
+    name_codes, names = pd.factorize(in_df[name_col])
+    source_codes, source_categories = _source_codes(in_df[single_source_col])
+    n_categories = max(len(source_categories), 1)
+    pairs = np.unique(name_codes.astype(np.int64) * n_categories + source_codes)
+    pair_sources = pairs % n_categories
+    offsets = np.searchsorted(pairs // n_categories, np.arange(len(names) + 1))
+
+    df = in_df.drop_duplicates(subset=[name_col]).drop(columns=[single_source_col])
+    df[compiled_sources_col] = [source_categories[pair_sources[offsets[i]:offsets[i + 1]]].tolist() for i in
+                                range(len(names))]
+    return df
+
+
+def _remove_repeated_hits_by_merging(dfs: List[pd.DataFrame]) -> List[pd.DataFrame]:
+    """
+    Remove hits from each dataframe whose name and source are in an earlier dataframe, by merging each dataframe with
+    every earlier one. Dataframes left empty are dropped.
+    """
+    from wcvpy.wcvp_download import wcvp_accepted_columns
+
+    cleaned_dfs = []
+    for df in dfs:
+        # Remove repeated entries across dataframes
+        for clean_df in cleaned_dfs:
+            df = pd.merge(df, clean_df[[wcvp_accepted_columns['name_w_author'], single_source_col]],
+                          on=[wcvp_accepted_columns['name_w_author'], single_source_col], how="outer",
+                          indicator=True)
+            df = df.loc[df["_merge"] == "left_only"].drop("_merge", axis=1)
+
+        if len(df) > 0:
+            cleaned_dfs.append(df)
+    return cleaned_dfs
+
+
+def _hit_key_codes(dfs: List[pd.DataFrame]) -> np.ndarray:
+    """
+    Codes of the (name, source) keys of the hits in each dataframe in turn, with equal keys given equal codes.
+    """
+    from wcvpy.wcvp_download import wcvp_accepted_columns
+
+    key_cols = [wcvp_accepted_columns['name_w_author'], single_source_col]
+    all_keys = pd.concat([df[key_cols] for df in dfs], ignore_index=True)
+    name_codes, _ = pd.factorize(all_keys[key_cols[0]])
+    source_codes, source_uniques = pd.factorize(all_keys[key_cols[1]])
+    # Missing sources have code -1, and are matched with each other as in a merge
+    pair_codes = name_codes.astype(np.int64) * (len(source_uniques) + 1) + (source_codes + 1)
+    key_codes, _ = pd.factorize(pair_codes)
+    return key_codes
+
+
+def _upcast_as_merged(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Upcast integer and boolean columns, other than the key columns, as an outer merge adding rows with missing values
+    would.
+    """
+    from wcvpy.wcvp_download import wcvp_accepted_columns
+
+    key_cols = [wcvp_accepted_columns['name_w_author'], single_source_col]
+    return df.astype({c: (float if df[c].dtype.kind in 'iu' else object) for c in df.columns if
+                      c not in key_cols and isinstance(df[c].dtype, np.dtype) and df[c].dtype.kind in 'iub'})
+
+
+def _order_first_hits(first_hits: dict, dtype_proxies: dict, upcast: set,
+                      first_source_with_hits: int) -> pd.DataFrame:
+    """
+    Concatenate the first hit of each name, given for each source by its position, in the order and with the dtypes
+    they would have after removing repeated hits and concatenating the sources. The hits of the first source with
+    hits are in the order of their index, and the hits of later sources are in name order, as those sources are
+    sorted when repeated hits are removed.
+    :param first_hits: first hits of each name, for each source with any
+    :param dtype_proxies: a single row with the dtypes of each source after removing repeated hits, for each source
+    with hits left, see _dtype_proxy
+    :param upcast: positions of sources which are upcast when repeated hits are removed, see _upcast_as_merged
+    :param first_source_with_hits: position of the first source with hits
     :return:
-    '''
+    """
     from wcvpy.wcvp_download import wcvp_accepted_columns
 
-    OUTPUT_COL_NAMES = [wcvp_accepted_columns['name'], wcvp_accepted_columns['name_w_author'],
-                        wcvp_accepted_columns['ipni_id'],
-                        wcvp_accepted_columns['rank'],
-                        wcvp_accepted_columns['species'],
-                        wcvp_accepted_columns['species_w_author'],
-                        wcvp_accepted_columns['species_ipni_id'],
-                        wcvp_accepted_columns['family'],
-                        compiled_sources_col]
-    # Put name columns at begining
-    start_cols = OUTPUT_COL_NAMES[:]
-    start_cols.remove(compiled_sources_col)
+    ordered_first_hits = []
+    ordered_dtype_proxies = []
+    for k in sorted(dtype_proxies):
+        proxy = dtype_proxies[k]
+        ordered_dtype_proxies.append(_upcast_as_merged(proxy) if k in upcast else proxy)
+        if k not in first_hits or len(first_hits[k]) == 0:
+            continue
+        if k > first_source_with_hits:
+            ordered_first_hits.append(first_hits[k].sort_values(by=wcvp_accepted_columns['name_w_author'],
+                                                                kind='mergesort'))
+        else:
+            ordered_first_hits.append(first_hits[k].sort_index())
 
-    if len(all_dfs) == 0 or all(len(x.index) == 0 for x in all_dfs):
-        out_dfs = pd.DataFrame(columns=start_cols + [compiled_sources_col])
-        out_dfs.to_csv(output_csv)
+    dtypes = pd.concat(ordered_dtype_proxies).dtypes
+    return pd.concat(ordered_first_hits).reindex(columns=dtypes.index).astype(dtypes)
+
+
+def _remove_hits_with_seen_keys(df: pd.DataFrame, df_key_codes: np.ndarray, seen: np.ndarray,
+                                n_seen: int) -> pd.DataFrame:
+    """
+    Remove hits whose key codes are seen in earlier dataframes, as merging with each earlier dataframe would.
+    The side effects of the outer merges are reproduced so that the compiled output is unchanged: the dataframe is
+    sorted by key, and its integer and boolean columns are upcast when the earlier dataframes have keys which it
+    doesn't.
+    :param df:
+    :param df_key_codes: see _hit_key_codes
+    :param seen: whether each key code is in an earlier dataframe
+    :param n_seen: number of keys in earlier dataframes
+    :return:
+    """
+    from wcvpy.wcvp_download import wcvp_accepted_columns
+
+    key_cols = [wcvp_accepted_columns['name_w_author'], single_source_col]
+    if seen[pd.unique(df_key_codes)].sum() < n_seen:
+        df = _upcast_as_merged(df)
+    df = df[~seen[df_key_codes]]
+    return df.sort_values(by=key_cols, kind='mergesort')
+
+
+def _remove_repeated_hits_by_hashing(dfs: List[pd.DataFrame]) -> List[pd.DataFrame]:
+    """
+    Gives the same dataframes as _remove_repeated_hits_by_merging in a single pass over the hits, by hashing the
+    (name, source) key of every hit once and keeping track of the keys seen in earlier dataframes.
+    """
+    key_codes = _hit_key_codes(dfs)
+
+    seen = np.zeros(key_codes.max() + 1 if len(key_codes) > 0 else 0, dtype=bool)
+    n_seen = 0
+    cleaned_dfs = []
+    start = 0
+    for df in dfs:
+        df_key_codes = key_codes[start:start + len(df)]
+        start += len(df)
+        if len(cleaned_dfs) > 0:
+            df = _remove_hits_with_seen_keys(df, df_key_codes, seen, n_seen)
+
+        new_key_codes = pd.unique(df_key_codes)
+        new_key_codes = new_key_codes[~seen[new_key_codes]]
+        seen[new_key_codes] = True
+        n_seen += len(new_key_codes)
+
+        if len(df) > 0:
+            cleaned_dfs.append(df)
+    return cleaned_dfs
+
+
+def _compiled_sources_to_arrow(compiled_sources: pd.Series):
+    """
+    Lists of sources as an arrow list array of dictionary encoded sources.
+    """
+    import pyarrow as pa
+
+    lengths = compiled_sources.str.len().fillna(0).astype(np.int64).values
+    offsets = np.concatenate([[0], np.cumsum(lengths)])
+    sources = compiled_sources.explode().dropna() if len(compiled_sources) > 0 else compiled_sources
+    codes, categories = pd.factorize(sources, sort=True)
+    values = pa.DictionaryArray.from_arrays(pa.array(codes, type=pa.int32()),
+                                            pa.array(np.asarray(categories, dtype=object), type=pa.string()))
+    return pa.ListArray.from_arrays(pa.array(offsets, type=pa.int32()), values)
 
-        return out_dfs
 
-    # First remove extraneous columns
+def write_compiled_hits_to_parquet(compiled_df: pd.DataFrame, output_parquet: str):
+    """
+    Write compiled hits to parquet (requires pyarrow), with compiled_sources_col stored as a list of dictionary
+    encoded sources rather than as text.
+    :param compiled_df: output of compile_hits
+    :param output_parquet:
+    :return:
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    table = pa.Table.from_pandas(compiled_df.drop(columns=[compiled_sources_col]), preserve_index=False)
+    table = table.append_column(compiled_sources_col, _compiled_sources_to_arrow(compiled_df[compiled_sources_col]))
+    pq.write_table(table, output_parquet)
+
+
+def _read_compiled_source_codes(sources_column) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Categorical codes of the sources in an arrow column written by write_compiled_hits_to_parquet, without
+    converting the sources to python objects.
+    :return: number of sources in each row, codes of the sources of every row in turn and the source categories
+    """
+    categories = pd.Index([], dtype=object)
+    lengths = []
+    codes = []
+    for chunk in sources_column.chunks:
+        lengths.append(chunk.value_lengths().fill_null(0).to_numpy())
+        values = chunk.flatten()
+        if len(values) == 0:
+            continue
+        if not hasattr(values, 'indices'):
+            values = values.dictionary_encode()
+        # Chunks may have different dictionaries, so their codes are mapped to a shared set of categories
+        chunk_categories = pd.Index(values.dictionary.to_pylist(), dtype=object)
+        categories = categories.append(chunk_categories.difference(categories, sort=False))
+        codes.append(categories.get_indexer(chunk_categories)[values.indices.to_numpy()])
+    return (np.concatenate(lengths) if lengths else np.array([], dtype=np.int64),
+            np.concatenate(codes) if codes else np.array([], dtype=np.int64),
+            np.asarray(categories, dtype=object))
+
+
+def read_compiled_hits(input_file: str) -> pd.DataFrame:
+    """
+    Read compiled hits output by compile_hits, as csv or parquet, with compiled_sources_col as lists of sources.
+    Sources in parquet files are read without any text parsing.
+    :param input_file:
+    :return:
+    """
+    if input_file.endswith('.parquet'):
+        df = pd.read_parquet(input_file)
+        df[compiled_sources_col] = df[compiled_sources_col].apply(list)
+    else:
+        import ast
+        df = pd.read_csv(input_file, index_col=0)
+        df[compiled_sources_col] = df[compiled_sources_col].apply(ast.literal_eval)
+    return df
+
+
+def _output_compiled_hits(compiled_df: pd.DataFrame, output_csv: str = None, output_parquet: str = None):
+    if output_csv is not None:
+        compiled_df.to_csv(output_csv)
+    if output_parquet is not None:
+        write_compiled_hits_to_parquet(compiled_df, output_parquet)
+
+
+_compilation_engines = {'merge': (_remove_repeated_hits_by_merging, _aggregate_data_on_accepted_names),
+                        'hash': (_remove_repeated_hits_by_hashing, _aggregate_data_on_accepted_names_by_hashing)}
+
+
+def _output_col_names() -> List[str]:
+    from wcvpy.wcvp_download import wcvp_accepted_columns
+
+    return [wcvp_accepted_columns['name'], wcvp_accepted_columns['name_w_author'],
+            wcvp_accepted_columns['ipni_id'],
+            wcvp_accepted_columns['rank'],
+            wcvp_accepted_columns['species'],
+            wcvp_accepted_columns['species_w_author'],
+            wcvp_accepted_columns['species_ipni_id'],
+            wcvp_accepted_columns['family'],
+            compiled_sources_col]
+
+
+def _trim_hit_dfs(all_dfs: List[pd.DataFrame]) -> List[pd.DataFrame]:
+    """
+    Remove extraneous columns and hits without names from each dataframe.
+    """
+    from wcvpy.wcvp_download import wcvp_accepted_columns
+
     sources_cols = []
-    snippet_cols = []
     for df in all_dfs:
         [sources_cols.append(c) for c in df.columns.tolist() if 'source' in c.lower()]
-        [snippet_cols.append(c) for c in df.columns.tolist() if 'snippet' in c.lower()]
-    cols_to_keep = OUTPUT_COL_NAMES + sources_cols
+    cols_to_keep = _output_col_names() + sources_cols
 
-    # Do some cleaning
-    cleaned_dfs = []
+    trimmed_dfs = []
     for df in all_dfs:
         if single_source_col not in df.columns:
             raise ValueError(f'No source given in dataframe: {df}')
@@ -72,24 +311,37 @@ def compile_hits(all_dfs: List[pd.DataFrame], output_csv: str) -> pd.DataFrame:
                         c not in cols_to_keep]
         df = df.drop(columns=cols_to_drop)
         df = df.dropna(subset=[wcvp_accepted_columns['name_w_author']])
+        trimmed_dfs.append(df)
+    return trimmed_dfs
 
-        # Remove repeated entries across dataframes
-        sources = []
-        for clean_df in cleaned_dfs:
-            for s in clean_df[single_source_col].unique().tolist():
-                if s not in sources:
-                    sources.append(s)
 
-            df = pd.merge(df, clean_df[[wcvp_accepted_columns['name_w_author'], single_source_col]],
-                          on=[wcvp_accepted_columns['name_w_author'], single_source_col], how="outer",
-                          indicator=True)
-            df = df.loc[df["_merge"] == "left_only"].drop("_merge", axis=1)
+def _output_empty_compiled_hits(output_csv: str, output_parquet: str = None) -> pd.DataFrame:
+    out_dfs = pd.DataFrame(columns=_output_col_names())
+    _output_compiled_hits(out_dfs, output_csv, output_parquet)
 
-        if len(df) > 0:
-            cleaned_dfs.append(df)
+    return out_dfs
 
+
+def _compile_cleaned_hits(cleaned_dfs: List[pd.DataFrame], aggregate_data_on_accepted_names, output_csv: str,
+                          output_parquet: str = None) -> pd.DataFrame:
+    """
+    Aggregate hits with repeated entries removed and output them, see compile_hits.
+    """
     concatted_dfs = pd.concat(cleaned_dfs)
-    outdfs = _aggregate_data_on_accepted_names(concatted_dfs)
+    outdfs = aggregate_data_on_accepted_names(concatted_dfs)
+
+    return _output_aggregated_hits(outdfs, output_csv, output_parquet)
+
+
+def _output_aggregated_hits(outdfs: pd.DataFrame, output_csv: str, output_parquet: str = None) -> pd.DataFrame:
+    """
+    Order the columns and rows of hits aggregated on accepted names, check for duplicates and output them.
+    """
+    from wcvpy.wcvp_download import wcvp_accepted_columns
+
+    # Put name columns at begining
+    start_cols = _output_col_names()
+    start_cols.remove(compiled_sources_col)
 
     out_dfs = outdfs[[c for c in start_cols if c in outdfs]
                      + [c for c in outdfs if c not in start_cols]]
@@ -99,13 +351,42 @@ def compile_hits(all_dfs: List[pd.DataFrame], output_csv: str) -> pd.DataFrame:
 
     out_dfs = out_dfs.sort_values(by=wcvp_accepted_columns['name']).reset_index(drop=True)
 
-    duplicate_hits_output = os.path.join(os.path.dirname(output_csv), 'duplicate_hits.csv')
+    duplicate_hits_output = os.path.join(os.path.dirname(output_csv if output_csv is not None else output_parquet),
+                                         'duplicate_hits.csv')
     dup_hits_df = out_dfs[out_dfs.duplicated(subset=[wcvp_accepted_columns['name_w_author']], keep=False)]
     if len(dup_hits_df) > 0:
         dup_hits_df.to_csv(duplicate_hits_output)
         raise ValueError(
             f'Duplicate hits found these should have been merged. Output to {duplicate_hits_output}')
 
-    out_dfs.to_csv(output_csv)
+    _output_compiled_hits(out_dfs, output_csv, output_parquet)
 
     return out_dfs
+
+
+def compile_hits(all_dfs: List[pd.DataFrame], output_csv: str, engine: str = 'hash',
+                 output_parquet: str = None) -> pd.DataFrame:
+    '''
+    Dataframes should contain the following headings 'Source', '[sourcename]_snippet', 'Accepted_Name',
+    'Accepted_Species', 'Accepted_Rank' and 'Accepted_ID'
+    :param all_dfs: List of dataframes to merge together
+    :param output_csv: Output file, or None to only output to output_parquet
+    :param engine: 'hash' to remove repeated hits and collect sources in a single pass over the hits, or 'merge' to
+    merge each dataframe with every earlier one. Both give the same output, 'merge' is much slower with many sources.
+    :param output_parquet: Optional parquet output, see write_compiled_hits_to_parquet
+    :return:
+    '''
+    if engine not in _compilation_engines:
+        raise ValueError(f'Unknown engine: {engine}')
+    remove_repeated_hits, aggregate_data_on_accepted_names = _compilation_engines[engine]
+
+    if len(all_dfs) == 0 or all(len(x.index) == 0 for x in all_dfs):
+        return _output_empty_compiled_hits(output_csv, output_parquet)
+
+    # Do some cleaning
+    trimmed_dfs = _trim_hit_dfs(all_dfs)
+
+    # Remove repeated entries across dataframes
+    cleaned_dfs = remove_repeated_hits(trimmed_dfs)
+
+    return _compile_cleaned_hits(cleaned_dfs, aggregate_data_on_accepted_names, output_csv, output_parquet)
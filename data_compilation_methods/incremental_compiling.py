@@ -0,0 +1,480 @@
+import hashlib
+import json
+import os
+import uuid
+from typing import List, Union
+
+import numpy as np
+import pandas as pd
+
+from data_compilation_methods.compiling_datasets import single_source_col, compiled_sources_col, _trim_hit_dfs, \
+    _source_codes, _order_first_hits, _output_aggregated_hits, _output_empty_compiled_hits
+from data_compilation_methods.out_of_core_compiling import _is_kept_column
+
+_store_manifest_file = 'compiled_store.json'
+_store_version = 2
+# Columns added to the hits kept in the store
+_source_index_col = '_source_index'
+_row_col = '_row'
+_is_first_col = '_is_first'
+_is_min_source_col = '_is_min_source'
+_non_na_col = '_non_na'
+# List columns of the store of compiled names, with an entry for each (name, source) key of the name
+_sources_col = '_sources'
+_source_counts_col = '_source_counts'
+_first_sources_col = '_first_sources'
+_first_non_na_col = '_first_non_na'
+_key_list_cols = [_sources_col, _source_counts_col, _first_sources_col, _first_non_na_col]
+
+
+def _fingerprint_hits(df: pd.DataFrame) -> str:
+    """
+    Hash of the columns, dtypes and values of a dataframe, ignoring its index.
+    """
+    fingerprint = hashlib.sha256()
+    fingerprint.update(json.dumps([[str(c), str(df[c].dtype)] for c in df.columns]).encode())
+    fingerprint.update(pd.util.hash_pandas_object(df, index=False, categorize=False).values.tobytes())
+    return fingerprint.hexdigest()
+
+
+def _read_store_manifest(store_dir: str) -> dict:
+    manifest_file = os.path.join(store_dir, _store_manifest_file)
+    if not os.path.isfile(manifest_file):
+        return {}
+    with open(manifest_file, encoding='utf-8') as f:
+        manifest = json.load(f)
+    # Stores written by other versions are rebuilt
+    if manifest.get('version') != _store_version:
+        return {}
+    return manifest
+
+
+def _load_hits(source: Union[str, pd.DataFrame]):
+    """
+    Hits of a csv file or dataframe with extraneous columns and hits without names removed, and the number of rows
+    in the source.
+    """
+    if isinstance(source, (str, os.PathLike)):
+        source = pd.read_csv(source, usecols=_is_kept_column)
+    return _trim_hit_dfs([source])[0], len(source.index)
+
+
+def _column_info(hits: pd.DataFrame) -> List[list]:
+    """
+    Name, dtype and a value of each column of the hits of a source, from which the dtypes of the hits can be
+    restored after reading them from the store.
+    """
+    info = []
+    for c in hits.columns:
+        values = hits[c].dropna()
+        value = values.iloc[0] if len(values) > 0 else None
+        if isinstance(value, np.generic):
+            value = value.item()
+        info.append([c, str(hits[c].dtype), value])
+    return info
+
+
+def _hit_candidates(hits: pd.DataFrame, k: int) -> pd.DataFrame:
+    """
+    The hits of a source which may be the first hit of their name once repeated hits are removed: the first hit of
+    each name, which is first when the source is the first with hits, and the hit of each name with the first source,
+    which is first when the source is sorted.
+    """
+    from wcvpy.wcvp_download import wcvp_accepted_columns
+
+    key_cols = [wcvp_accepted_columns['name_w_author'], single_source_col]
+    name_codes, names = pd.factorize(hits[key_cols[0]])
+    is_first = ~pd.Series(name_codes).duplicated().values
+    # Sources are coded in sorted order, so the first hit of each name with its lowest source code is the first hit
+    # of the name once the hits are sorted
+    source_codes, _ = _source_codes(hits[key_cols[1]])
+    min_source_codes = np.full(len(names), np.iinfo(np.int64).max)
+    np.minimum.at(min_source_codes, name_codes, source_codes)
+    is_min_source = source_codes == min_source_codes[name_codes]
+    is_min_source[is_min_source] = ~pd.Series(name_codes[is_min_source]).duplicated().values
+    is_candidate = is_first | is_min_source
+    return hits[is_candidate].assign(**{_source_index_col: k, _row_col: np.flatnonzero(is_candidate),
+                                        _is_first_col: is_first[is_candidate],
+                                        _is_min_source_col: is_min_source[is_candidate]})
+
+
+def _hit_keys(hits: pd.DataFrame, k: int) -> pd.DataFrame:
+    """
+    The (name, source) keys of the hits of a source, with a bitmask of the columns in which the hits of each key
+    have values. Bits are set in an int64, so hits may have at most 63 columns.
+    """
+    from wcvpy.wcvp_download import wcvp_accepted_columns
+
+    if len(hits.columns) > 63:
+        raise ValueError(f'Hits with more than 63 columns can not be compiled incrementally, use compile_hits. '
+                         f'Columns: {hits.columns.tolist()}')
+    key_cols = [wcvp_accepted_columns['name_w_author'], single_source_col]
+    non_na = hits.notna().groupby([hits[c] for c in key_cols], dropna=False, sort=False).any()
+    keys = non_na.index.to_frame(index=False)
+    keys[_non_na_col] = non_na.values.astype(np.int64) @ (np.int64(1) << np.arange(len(hits.columns), dtype=np.int64))
+    keys[_source_index_col] = k
+    return keys
+
+
+def _source_category_codes(sources: pd.Series, source_categories: pd.Index):
+    """
+    Codes of sources in a list of source categories, adding any new sources to the categories.
+    :return: codes and categories
+    """
+    sources = sources.astype(object).where(sources.notna(), np.nan)
+    source_categories = source_categories.append(
+        pd.Index(pd.unique(sources.values), dtype=object).difference(source_categories, sort=False))
+    return source_categories.get_indexer(sources), source_categories
+
+
+def _first_rows_of_keys(key_ids: np.ndarray, sources: np.ndarray, n_keys: int):
+    """
+    The lowest source position of each key, and the row with that key and source, or -1 for keys without rows.
+    """
+    first_sources = np.full(n_keys, -1, dtype=np.int64)
+    first_rows = np.full(n_keys, -1, dtype=np.int64)
+    if len(key_ids) == 0:
+        return first_sources, first_rows
+    order = np.lexsort((sources, key_ids))
+    is_first = np.concatenate([[True], key_ids[order][1:] != key_ids[order][:-1]])
+    first_sources[key_ids[order][is_first]] = sources[order][is_first]
+    first_rows[key_ids[order][is_first]] = order[is_first]
+    return first_sources, first_rows
+
+
+def _count_non_na(sources: np.ndarray, non_na: np.ndarray, n_sources: int, n_cols: int) -> np.ndarray:
+    """
+    Number of keys of each source with values in each column, from bitmasks of the columns of each key.
+    """
+    counts = np.zeros((n_sources, n_cols), dtype=np.int64)
+    for i in range(n_cols):
+        counts[:, i] = np.bincount(sources, weights=(non_na >> i) & 1, minlength=n_sources)
+    return counts
+
+
+def _read_store_rows(store_dir: str, files: List[str], names) -> pd.DataFrame:
+    """
+    Rows of parquet files in the store with the given names, or None if there are none.
+    """
+    from wcvpy.wcvp_download import wcvp_accepted_columns
+
+    names = pd.unique(np.asarray(names, dtype=object)).tolist()
+    dfs = [pd.read_parquet(os.path.join(store_dir, f),
+                           filters=[(wcvp_accepted_columns['name_w_author'], 'in', names)]) for f in files]
+    dfs = [df for df in dfs if len(df) > 0]
+    return pd.concat(dfs, ignore_index=True) if len(dfs) > 0 else None
+
+
+def _write_store_file(store_dir: str, prefix: str, df) -> str:
+    """
+    Write a dataframe or arrow table to a new parquet file in the store.
+    :return: name of the file
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    store_file = prefix + '_' + uuid.uuid4().hex + '.parquet'
+    if isinstance(df, pd.DataFrame):
+        df = pa.Table.from_pandas(df, preserve_index=False)
+    pq.write_table(df, os.path.join(store_dir, store_file))
+    return store_file
+
+
+def compile_hits_incrementally(all_dfs: List[Union[str, pd.DataFrame]], output_csv: str, store_dir: str,
+                               output_parquet: str = None, fingerprints: List[str] = None) -> pd.DataFrame:
+    """
+    Compile hits as compile_hits, keeping a store of the compiled hits of each accepted name so that only the hits
+    added to and removed from sources since the previous compilation need to be applied. The output is the same as
+    from compile_hits.
+    The store is kept as parquet files (requires pyarrow) in store_dir: the first hit of each name with the (name,
+    source) keys of its hits, and for each source the keys of its hits and the hits which may be the first of their
+    name. Only names with hits in changed sources are compiled again, and the store of an unchanged source is only
+    read for names whose first hit or keys were in a changed source.
+    Sources are identified by their position in all_dfs. Csv files are fingerprinted by their size and modification
+    time, and are only read when they have changed. Dataframes are fingerprinted by a hash of their contents, unless
+    fingerprints are given.
+    Which columns of each (name, source) key have values is stored as a bitmask in a 64 bit integer, so each source
+    may have at most 63 of the columns which compile_hits keeps (see _is_kept_column), otherwise a ValueError is
+    raised. Use compile_hits for sources with more columns.
+    :param all_dfs: List of dataframes or csv files to merge together, see compile_hits
+    :param output_csv: Output file, or None to only output to output_parquet
+    :param store_dir: directory to store compiled hits in
+    :param output_parquet: Optional parquet output, see write_compiled_hits_to_parquet
+    :param fingerprints: Optional fingerprint of each source, e.g. a version, which changes when the source changes
+    :return:
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    from wcvpy.wcvp_download import wcvp_accepted_columns
+
+    name_col = wcvp_accepted_columns['name_w_author']
+    if fingerprints is not None and len(fingerprints) != len(all_dfs):
+        raise ValueError('A fingerprint must be given for each source')
+
+    os.makedirs(store_dir, exist_ok=True)
+    manifest = _read_store_manifest(store_dir)
+    stored_sources = manifest.get('sources', [])
+
+    # Find the sources which have changed since the store was updated
+    sources = []
+    changed_hits = {}
+    for k, source in enumerate(all_dfs):
+        hits = None
+        if fingerprints is not None:
+            fingerprint = str(fingerprints[k])
+        elif isinstance(source, (str, os.PathLike)):
+            stat = os.stat(source)
+            fingerprint = str(stat.st_size) + '_' + str(stat.st_mtime_ns)
+        else:
+            hits, n_rows = _load_hits(source)
+            fingerprint = _fingerprint_hits(hits)
+        if k < len(stored_sources) and stored_sources[k]['fingerprint'] == fingerprint:
+            sources.append(dict(stored_sources[k]))
+            continue
+        if hits is None:
+            hits, n_rows = _load_hits(source)
+        changed_hits[k] = hits
+        sources.append({'fingerprint': fingerprint, 'n_rows': n_rows, 'n_hits': len(hits),
+                        'columns': _column_info(hits)})
+    replaced = [k for k in range(len(stored_sources)) if k >= len(sources) or k in changed_hits]
+    print(f'Applying changes to {len(changed_hits)} of {len(sources)} sources, and removing '
+          f'{max(len(stored_sources) - len(sources), 0)} sources')
+
+    n_stored = max(len(sources), len(stored_sources))
+    n_cols = max([len(s['columns']) for s in sources + stored_sources] + [0])
+    is_replaced = np.zeros(n_stored + 1, dtype=bool)
+    is_replaced[replaced] = True
+    is_changed = np.zeros(n_stored + 1, dtype=bool)
+    is_changed[list(changed_hits)] = True
+    first_source_with_hits = next((k for k in range(len(sources)) if sources[k]['n_hits'] > 0), None)
+    stored_first_source_with_hits = manifest.get('first_source_with_hits')
+    source_categories = pd.Index(manifest.get('source_categories', []), dtype=object)
+
+    # Keys of the hits removed from and added to sources
+    new_candidates = [_hit_candidates(hits, k) for k, hits in changed_hits.items()]
+    added_keys = [_hit_keys(hits, k) for k, hits in changed_hits.items()]
+    added_keys = pd.concat(added_keys, ignore_index=True) if len(added_keys) > 0 else pd.DataFrame(
+        {name_col: [], single_source_col: [], _non_na_col: [], _source_index_col: []})
+    removed_keys = [pd.read_parquet(os.path.join(store_dir, stored_sources[k]['keys_file'])) for k in replaced]
+    removed_keys = pd.concat(removed_keys, ignore_index=True) if len(removed_keys) > 0 else added_keys.iloc[:0]
+
+    # Names whose first hit or sources may have changed, and their keys before the changes
+    # The compiled names are kept as an arrow table, as most of their columns are empty for hits of other sources
+    names_table = None
+    stored_names = pd.Series([], dtype=object)
+    stored_names_source_index = np.zeros(0, dtype=np.int64)
+    if manifest.get('names_file') is not None:
+        names_table = pq.read_table(os.path.join(store_dir, manifest['names_file']))
+        stored_names = names_table.column(name_col).to_pandas()
+        stored_names_source_index = names_table.column(_source_index_col).to_numpy()
+    changed_names = [removed_keys[name_col], added_keys[name_col]]
+    if stored_first_source_with_hits != first_source_with_hits:
+        # Which hit of a name is first depends on whether its source is the first with hits
+        changed_names.append(stored_names[np.isin(stored_names_source_index, [
+            k for k in [stored_first_source_with_hits, first_source_with_hits] if k is not None])])
+    changed_names = pd.Index(pd.unique(pd.concat(changed_names).values), dtype=object)
+    is_changed_name = stored_names.isin(changed_names).values
+    old_lists = {c: (names_table.column(c).filter(pa.array(is_changed_name, type=pa.bool_())).combine_chunks() if
+                     names_table is not None else pa.array([], type=pa.list_(pa.int64()))) for c in _key_list_cols}
+    old_keys = pd.DataFrame({name_col: np.repeat(stored_names.values[is_changed_name],
+                                                 old_lists[_sources_col].value_lengths().to_numpy(
+                                                     zero_copy_only=False).astype(np.int64))})
+    for c in _key_list_cols:
+        old_keys[c] = old_lists[c].flatten().to_numpy(zero_copy_only=False).astype(np.int64)
+
+    # Give each key of the changed names an id
+    removed_codes, source_categories = _source_category_codes(removed_keys[single_source_col], source_categories)
+    added_codes, source_categories = _source_category_codes(added_keys[single_source_col], source_categories)
+    n_codes = len(source_categories) + 1
+    name_codes, names = pd.factorize(
+        pd.concat([old_keys[name_col], removed_keys[name_col], added_keys[name_col]], ignore_index=True))
+    names = pd.Index(names, dtype=object)
+    key_ids, keys = pd.factorize(name_codes.astype(np.int64) * n_codes + np.concatenate(
+        [old_keys[_sources_col].values, removed_codes, added_codes]).astype(np.int64))
+    keys = pd.Index(keys)
+    n_old, n_removed, n_keys = len(old_keys), len(removed_keys), len(keys)
+    old_ids, removed_ids, added_ids = key_ids[:n_old], key_ids[n_old:n_old + n_removed], key_ids[n_old + n_removed:]
+    key_name_codes = keys.values // n_codes
+    key_sources = keys.values % n_codes
+
+    # Number of sources with each key, and the first source with each key and which columns it has values in there
+    old_counts = np.zeros(n_keys, dtype=np.int64)
+    old_counts[old_ids] = old_keys[_source_counts_col].values
+    old_counts -= np.bincount(removed_ids, minlength=n_keys)
+    counts = old_counts + np.bincount(added_ids, minlength=n_keys)
+    old_first_sources = np.full(n_keys, -1, dtype=np.int64)
+    old_first_sources[old_ids] = old_keys[_first_sources_col].values
+    old_first_non_na = np.zeros(n_keys, dtype=np.int64)
+    old_first_non_na[old_ids] = old_keys[_first_non_na_col].values
+    is_kept_first = (old_first_sources >= 0) & ~is_replaced[old_first_sources]
+    first_sources = np.where(is_kept_first, old_first_sources, n_stored)
+    first_non_na = np.where(is_kept_first, old_first_non_na, 0)
+    added_sources = added_keys[_source_index_col].values.astype(np.int64)
+    added_first_sources, added_first_rows = _first_rows_of_keys(added_ids, added_sources, n_keys)
+    is_added_first = (added_first_sources >= 0) & (added_first_sources < first_sources)
+    first_sources[is_added_first] = added_first_sources[is_added_first]
+    first_non_na[is_added_first] = added_keys[_non_na_col].values.astype(np.int64)[added_first_rows[is_added_first]]
+    # Keys whose first source was replaced but which are still in an unchanged source are looked up in the store
+    is_lost = (old_first_sources >= 0) & ~is_kept_first & (old_counts > 0)
+    if is_lost.any():
+        found_keys = _read_store_rows(store_dir, [sources[k]['keys_file'] for k in
+                                                  range(int(old_first_sources[is_lost].min()) + 1, len(sources)) if
+                                                  not is_changed[k] and sources[k]['n_hits'] > 0],
+                                      names[key_name_codes[is_lost]])
+        if found_keys is not None:
+            found_codes, _ = _source_category_codes(found_keys[single_source_col], source_categories)
+            found_ids = keys.get_indexer(names.get_indexer(found_keys[name_col]).astype(np.int64) * n_codes +
+                                         found_codes)
+            found_ids = np.where(found_ids >= 0, found_ids, n_keys)
+            found_first_sources, found_first_rows = _first_rows_of_keys(
+                found_ids, found_keys[_source_index_col].values.astype(np.int64), n_keys + 1)
+            found_first_sources, found_first_rows = found_first_sources[:n_keys], found_first_rows[:n_keys]
+            is_found_first = is_lost & (found_first_sources >= 0) & (found_first_sources < first_sources)
+            first_sources[is_found_first] = found_first_sources[is_found_first]
+            first_non_na[is_found_first] = found_keys[_non_na_col].values.astype(np.int64)[
+                found_first_rows[is_found_first]]
+
+    # Update the number of keys of each source, and of the keys first in each source with values in each column
+    n_source_keys = np.zeros(n_stored, dtype=np.int64)
+    n_new_keys = np.zeros(n_stored, dtype=np.int64)
+    n_non_na = np.zeros((n_stored, n_cols), dtype=np.int64)
+    for k, stored in enumerate(stored_sources):
+        n_source_keys[k] = stored['n_keys']
+        n_new_keys[k] = stored['n_new_keys']
+        n_non_na[k, :len(stored['n_non_na'])] = stored['n_non_na']
+    n_source_keys[is_replaced[:n_stored]] = 0
+    n_source_keys += np.bincount(added_sources, minlength=n_stored)
+    was_key = old_first_sources >= 0
+    is_key = counts > 0
+    n_new_keys -= np.bincount(old_first_sources[was_key], minlength=n_stored)
+    n_new_keys += np.bincount(first_sources[is_key], minlength=n_stored)
+    n_non_na -= _count_non_na(old_first_sources[was_key], old_first_non_na[was_key], n_stored, n_cols)
+    n_non_na += _count_non_na(first_sources[is_key], first_non_na[is_key], n_stored, n_cols)
+
+    # The first hit of each changed name is from the first source with the name. The stored hit is kept if that
+    # source and whether it's the first source with hits are unchanged, and otherwise is found in the changed sources
+    # or the store
+    compiled = pd.DataFrame({name_col: names})
+    compiled[_source_index_col] = pd.Series(first_sources[is_key]).groupby(key_name_codes[is_key]).min().reindex(
+        np.arange(len(names)), fill_value=n_stored).values
+    compiled = compiled[compiled[_source_index_col] < n_stored]
+    compiled_source_index = compiled[_source_index_col].values
+    stored_positions = pd.Index(stored_names).get_indexer(compiled[name_col])
+    stored_source_index = np.append(stored_names_source_index, -1)[stored_positions]
+    is_kept = (stored_source_index == compiled_source_index) & ~is_changed[compiled_source_index] & (
+            (stored_source_index == stored_first_source_with_hits) == (
+                compiled_source_index == first_source_with_hits))
+    # Kept hits are put first, and are taken from the stored names without converting them to a dataframe
+    compiled = pd.concat([compiled[is_kept], compiled[~is_kept]], ignore_index=True)
+    compiled_tables = []
+    if is_kept.any():
+        compiled_tables.append(names_table.take(pa.array(stored_positions[is_kept])).drop_columns(_key_list_cols))
+    first_hits = list(new_candidates)
+    for k in pd.unique(compiled_source_index[~is_kept & ~is_changed[compiled_source_index]]):
+        first_hits.append(_read_store_rows(store_dir, [sources[k]['candidates_file']],
+                                           compiled[name_col].values[is_kept.sum():][
+                                               compiled_source_index[~is_kept] == k]))
+    first_hits = [df for df in first_hits if df is not None and len(df) > 0]
+    if len(first_hits) > 0 and not is_kept.all():
+        first_hits = pd.concat(first_hits, ignore_index=True)
+        is_first_hit = (first_hits[_source_index_col].values == compiled.set_index(name_col)[
+            _source_index_col].reindex(first_hits[name_col]).values) & np.where(
+            first_hits[_source_index_col].values == first_source_with_hits, first_hits[_is_first_col].values,
+            first_hits[_is_min_source_col].values).astype(bool)
+        first_hits = first_hits[is_first_hit].drop(columns=[_is_first_col, _is_min_source_col])
+        compiled_tables.append(pa.Table.from_pandas(
+            first_hits.set_index(name_col).loc[compiled[name_col].values[is_kept.sum():]].reset_index(),
+            preserve_index=False).replace_schema_metadata(None))
+
+    # Lists of the keys of each changed name, ordered by source as compiled sources are
+    key_order = np.flatnonzero(is_key)
+    source_ranks, _ = _source_codes(np.asarray(source_categories, dtype=object))
+    source_ranks = np.append(source_ranks, len(source_ranks))
+    key_order = key_order[np.lexsort((source_ranks[key_sources[key_order]], key_name_codes[key_order]))]
+    offsets = np.searchsorted(key_name_codes[key_order], np.arange(len(names) + 1))
+    compiled_name_codes = pa.array(names.get_indexer(compiled[name_col]), type=pa.int64())
+    compiled_lists = {}
+    for c, values in [(_sources_col, key_sources), (_source_counts_col, counts),
+                      (_first_sources_col, first_sources), (_first_non_na_col, first_non_na)]:
+        compiled_lists[c] = pa.ListArray.from_arrays(pa.array(offsets, type=pa.int32()),
+                                                     pa.array(values[key_order], type=pa.int64())).take(
+            compiled_name_codes)
+
+    tables = []
+    lists = {c: [] for c in _key_list_cols}
+    if names_table is not None:
+        is_unchanged_name = pa.array(~is_changed_name, type=pa.bool_())
+        tables.append(names_table.filter(is_unchanged_name).drop_columns(_key_list_cols))
+        for c in _key_list_cols:
+            lists[c].extend(names_table.column(c).filter(is_unchanged_name).chunks)
+    tables.extend(compiled_tables)
+    names_table = pa.concat_tables(tables, promote_options='permissive') if len(tables) > 0 else pa.Table.from_pandas(
+        compiled.reindex(columns=[name_col, _source_index_col, _row_col]), preserve_index=False)
+    for c in _key_list_cols:
+        names_table = names_table.append_column(c, pa.chunked_array(lists[c] + [compiled_lists[c]],
+                                                                    type=pa.list_(pa.int64())))
+
+    # Write the changed files and then the manifest, so that an interrupted update leaves the old store
+    # or leave it unchanged when no sources have changed
+    if len(changed_hits) > 0 or len(replaced) > 0 or manifest.get('names_file') is None:
+        for k, candidates in zip(changed_hits, new_candidates):
+            sources[k]['keys_file'] = _write_store_file(store_dir, 'keys_' + str(k),
+                                                        added_keys[added_sources == k].reset_index(drop=True))
+            sources[k]['candidates_file'] = _write_store_file(store_dir, 'candidates_' + str(k), candidates)
+        for k, s in enumerate(sources):
+            s['n_keys'] = int(n_source_keys[k])
+            s['n_new_keys'] = int(n_new_keys[k])
+            s['n_non_na'] = n_non_na[k, :len(s['columns'])].tolist()
+        names_file = _write_store_file(store_dir, 'names', names_table)
+        manifest_file = os.path.join(store_dir, _store_manifest_file)
+        with open(manifest_file + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump({'version': _store_version, 'sources': sources, 'names_file': names_file,
+                       'first_source_with_hits': first_source_with_hits,
+                       'source_categories': source_categories.tolist()}, f, default=str)
+        os.replace(manifest_file + '.tmp', manifest_file)
+        store_files = set([names_file] + [s[f] for s in sources for f in ['keys_file', 'candidates_file']])
+        for old_file in [manifest.get('names_file')] + [s[f] for s in stored_sources for f in
+                                                         ['keys_file', 'candidates_file']]:
+            if old_file is not None and old_file not in store_files and os.path.isfile(
+                    os.path.join(store_dir, old_file)):
+                os.remove(os.path.join(store_dir, old_file))
+
+    if len(sources) == 0 or all(s['n_rows'] == 0 for s in sources):
+        return _output_empty_compiled_hits(output_csv, output_parquet)
+
+    # Restore the dtypes of the first hits of each source, and put them in the order they would be in after
+    # concatenating the sources
+    first_hits = {}
+    dtype_proxies = {}
+    names_source_index = names_table.column(_source_index_col).to_numpy()
+    for k, s in enumerate(sources):
+        if n_new_keys[k] == 0:
+            continue
+        dtypes = {c: dtype for c, dtype, _ in s['columns']}
+        dtype_proxies[k] = pd.DataFrame(
+            {c: pd.Series([value if n_non_na[k, i] > 0 else np.nan], dtype=object).astype(dtype) for
+             i, (c, dtype, value) in enumerate(s['columns'])})
+        is_first_hit_of_source = names_source_index == k
+        if not is_first_hit_of_source.any():
+            # The new keys of this source are all of names seen earlier, so it only affects the dtypes. The store
+            # then may not have its columns
+            continue
+        first_hits[k] = names_table.filter(pa.array(is_first_hit_of_source)).select(
+            list(dtypes) + [_row_col]).to_pandas().set_index(_row_col).astype(dtypes)
+    n_seen_keys = np.concatenate([[0], np.cumsum(n_new_keys)[:-1]])
+    n_earlier_keys = n_source_keys - n_new_keys
+    upcast = set(k for k in range(len(sources)) if
+                 k > first_source_with_hits and n_earlier_keys[k] < n_seen_keys[k])
+    outdfs = _order_first_hits(first_hits, dtype_proxies, upcast, first_source_with_hits)
+    outdfs = outdfs.drop(columns=[single_source_col])
+
+    names_sources = names_table.column(_sources_col).combine_chunks()
+    offsets = names_sources.offsets.to_numpy()
+    codes = names_sources.flatten().to_numpy()
+    categories = np.asarray(source_categories, dtype=object)
+    sources_of_names = pd.Series([categories[codes[offsets[i]:offsets[i + 1]]].tolist() for i in
+                                  range(len(names_table))], index=names_table.column(name_col).to_numpy(
+        zero_copy_only=False), dtype=object)
+    outdfs[compiled_sources_col] = outdfs[name_col].map(sources_of_names)
+
+    return _output_aggregated_hits(outdfs, output_csv, output_parquet)
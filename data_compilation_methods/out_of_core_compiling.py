@@ -0,0 +1,169 @@
+import os
+import pickle
+import tempfile
+from typing import Iterable, List, Union
+
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+
+from data_compilation_methods.compiling_datasets import single_source_col, compiled_sources_col, _output_col_names, \
+    _hit_key_codes, _order_first_hits, _aggregate_data_on_accepted_names_by_hashing, _output_aggregated_hits, \
+    _output_empty_compiled_hits
+
+
+def _is_kept_column(column: str) -> bool:
+    """
+    Whether compile_hits keeps a column of the hits.
+    """
+    return column in _output_col_names() or 'source' in column.lower()
+
+
+def _iter_source_chunks(source, chunksize: int):
+    """
+    Chunks of hits from a csv file, dataframe or iterable of dataframes, with only the columns which compile_hits
+    keeps. Columns of csv files are pruned as they are read.
+    """
+    if isinstance(source, (str, os.PathLike)):
+        yield from pd.read_csv(source, usecols=_is_kept_column, chunksize=chunksize)
+    else:
+        if isinstance(source, pd.DataFrame):
+            source = [source]
+        for chunk in source:
+            yield chunk[[c for c in chunk.columns if _is_kept_column(c)]]
+
+
+def _read_partition(partition_file: str) -> dict:
+    """
+    Hits of each source written to a partition by _partition_hits, indexed by their position in the source.
+    """
+    chunks = {}
+    if not os.path.isfile(partition_file):
+        return chunks
+    with open(partition_file, 'rb') as f:
+        while True:
+            try:
+                k, chunk = pickle.load(f)
+            except EOFError:
+                break
+            chunks.setdefault(k, []).append(chunk)
+    return {k: pd.concat(chunks[k]) for k in sorted(chunks)}
+
+
+def _partition_hits(sources: List, partition_files: List[str], chunksize: int):
+    """
+    Stream the hits of each source into partition files, assigning hits to partitions by a hash of their accepted
+    name so that all hits of a name are in the same partition.
+    :return: the number of hits with names in each source
+    """
+    from wcvpy.wcvp_download import wcvp_accepted_columns
+
+    name_col = wcvp_accepted_columns['name_w_author']
+    n_hits = []
+    for k, source in enumerate(tqdm(sources, desc="Partitioning hits…", ascii=False, ncols=72)):
+        n = 0
+        for chunk in _iter_source_chunks(source, chunksize):
+            if single_source_col not in chunk.columns:
+                raise ValueError(f'No source given in: {source}')
+            chunk = chunk.dropna(subset=[name_col])
+            # Positions of the hits in the source, which give their order after partitioning
+            chunk.index = pd.RangeIndex(n, n + len(chunk))
+            n += len(chunk)
+            partitions = pd.util.hash_array(chunk[name_col].values.astype(object)) % len(partition_files)
+            for p in np.unique(partitions):
+                with open(partition_files[p], 'ab') as f:
+                    pickle.dump((k, chunk[partitions == p]), f)
+        n_hits.append(n)
+    return n_hits
+
+
+def _dtype_proxy(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    A single row with the dtypes of the columns of a dataframe, and a value from each column which has any. The dtypes
+    of a concatenation of dataframes are the same as those of a concatenation of their proxies.
+    """
+    return pd.DataFrame({c: df[c].dropna().iloc[:1].reset_index(drop=True).reindex([0]) for c in df.columns})
+
+
+def compile_hits_out_of_core(sources: List[Union[str, pd.DataFrame, Iterable[pd.DataFrame]]], output_csv: str,
+                             n_partitions: int = 64, chunksize: int = 10 ** 5, partition_dir: str = None,
+                             output_parquet: str = None) -> pd.DataFrame:
+    """
+    Compile hits as compile_hits without loading every source at once. Sources are read in chunks, keeping only the
+    columns which compile_hits keeps, and their hits are written to partitions on disk by accepted name. Repeated
+    hits are then removed from each partition in turn, as every hit of a name is in the same partition.
+    Memory use is bounded by the size of a chunk, the largest partition and the compiled output, rather than the
+    total number of hits. The output is the same as compile_hits gives for the loaded sources.
+    :param sources: list of csv files, dataframes or iterables of dataframes (e.g. from pd.read_csv with chunksize)
+    :param output_csv: Output file, or None to only output to output_parquet
+    :param n_partitions: number of partitions to split the hits into
+    :param chunksize: number of rows to read from csv files at once
+    :param partition_dir: directory to write partitions to, a temporary directory by default
+    :param output_parquet: Optional parquet output, see write_compiled_hits_to_parquet
+    :return:
+    """
+    from wcvpy.wcvp_download import wcvp_accepted_columns
+
+    name_col = wcvp_accepted_columns['name_w_author']
+    key_cols = [name_col, single_source_col]
+    n_sources = len(sources)
+    # Hits from each source which are the first with their name, and the sources of each name
+    first_hits = [[] for _ in range(n_sources)]
+    dtype_proxies = [[] for _ in range(n_sources)]
+    compiled_sources = []
+    # Number of keys of each source which are new, and which are in an earlier source
+    n_new_keys = np.zeros(n_sources, dtype=np.int64)
+    n_earlier_keys = np.zeros(n_sources, dtype=np.int64)
+    n_cleaned_hits = np.zeros(n_sources, dtype=np.int64)
+
+    with tempfile.TemporaryDirectory(dir=partition_dir) as tmpdir:
+        partition_files = [os.path.join(tmpdir, 'partition_' + str(p) + '.pkl') for p in range(n_partitions)]
+        n_hits = _partition_hits(sources, partition_files, chunksize)
+        if sum(n_hits) == 0:
+            return _output_empty_compiled_hits(output_csv, output_parquet)
+        # Hits of later sources are compared with the hits of this source and those before it
+        first_source_with_hits = next(k for k in range(n_sources) if n_hits[k] > 0)
+
+        for partition_file in tqdm(partition_files, desc="Compiling partitions…", ascii=False, ncols=72):
+            partition = _read_partition(partition_file)
+            if len(partition) == 0:
+                continue
+            key_codes = _hit_key_codes(list(partition.values()))
+            seen = np.zeros(key_codes.max() + 1, dtype=bool)
+            start = 0
+            for k, df in partition.items():
+                df_key_codes = key_codes[start:start + len(df)]
+                start += len(df)
+                df_unique_key_codes = pd.unique(df_key_codes)
+                n_earlier = seen[df_unique_key_codes].sum()
+                n_earlier_keys[k] += n_earlier
+                n_new_keys[k] += len(df_unique_key_codes) - n_earlier
+                if k > first_source_with_hits:
+                    df = df[~seen[df_key_codes]].sort_values(by=key_cols, kind='mergesort')
+                seen[df_unique_key_codes] = True
+                n_cleaned_hits[k] += len(df)
+                if len(df) > 0:
+                    dtype_proxies[k].append(_dtype_proxy(df))
+                partition[k] = df
+
+            cleaned_hits = pd.concat([df[key_cols] for df in partition.values()])
+            is_first_hit = ~cleaned_hits[name_col].duplicated().values
+            start = 0
+            for k, df in partition.items():
+                first_hits[k].append(df[is_first_hit[start:start + len(df)]])
+                start += len(df)
+            compiled_sources.append(_aggregate_data_on_accepted_names_by_hashing(cleaned_hits))
+
+    # Put the first hits of each name in the order they would be in after concatenating the sources, with the dtypes
+    # they would have
+    n_seen_keys = np.concatenate([[0], np.cumsum(n_new_keys)[:-1]])
+    upcast = set(k for k in range(n_sources) if k > first_source_with_hits and n_earlier_keys[k] < n_seen_keys[k])
+    outdfs = _order_first_hits({k: pd.concat([df for df in first_hits[k] if len(df) > 0]) for k in range(n_sources)
+                                if sum(len(df) for df in first_hits[k]) > 0},
+                               {k: pd.concat(dtype_proxies[k]) for k in range(n_sources) if n_cleaned_hits[k] > 0},
+                               upcast, first_source_with_hits)
+    outdfs = outdfs.drop(columns=[single_source_col])
+    sources_of_names = pd.concat(compiled_sources).set_index(name_col)[compiled_sources_col]
+    outdfs[compiled_sources_col] = outdfs[name_col].map(sources_of_names)
+
+    return _output_aggregated_hits(outdfs, output_csv, output_parquet)
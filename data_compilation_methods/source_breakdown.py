@@ -1,20 +1,121 @@
 import ast
 import os
-from typing import List
+from typing import List, Tuple
 
+import numpy as np
 import pandas as pd
 
+from data_compilation_methods.compiling_datasets import compiled_sources_col, _read_compiled_source_codes
+
+
+def _read_hits_and_source_codes(input_file: str) -> Tuple[pd.DataFrame, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Read compiled hits with the sources of each hit as categorical codes, see _read_compiled_source_codes.
+    """
+    if input_file.endswith('.parquet'):
+        import pyarrow.parquet as pq
+        table = pq.read_table(input_file)
+        lengths, codes, categories = _read_compiled_source_codes(table.column(compiled_sources_col))
+        hits_df = table.select([c for c in table.column_names if c != compiled_sources_col]).to_pandas()
+        return hits_df, lengths, codes, categories
+
+    hits_df = pd.read_csv(input_file)
+    lengths, codes, categories = _split_sources_strs(hits_df[compiled_sources_col].values)
+    return hits_df, lengths, codes, categories
+
+
+def _split_sources_strs(sources_strs: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Categorical codes of the sources in stringified lists of sources. Each distinct string is only parsed once, as
+    many hits have the same sources.
+    :return: number of sources in each list, codes of the sources of every list in turn and the source categories
+    """
+    str_codes, unique_strs = pd.factorize(sources_strs, use_na_sentinel=False)
+    split_sources = [ast.literal_eval(sources_str) for sources_str in unique_strs]
+    unique_lengths = np.array([len(x) for x in split_sources], dtype=np.int64)
+    unique_codes, categories = pd.factorize(pd.Series([s for x in split_sources for s in x], dtype=object))
+
+    # Expand the codes of the distinct lists to every list
+    lengths = unique_lengths[str_codes]
+    unique_starts = np.cumsum(unique_lengths) - unique_lengths
+    starts = np.cumsum(lengths) - lengths
+    codes = unique_codes[np.repeat(unique_starts[str_codes] - starts, lengths) + np.arange(lengths.sum())]
+    return lengths, codes, np.asarray(categories, dtype=object)
+
+
+def _count_source_codes(lengths: np.ndarray, codes: np.ndarray, categories: np.ndarray,
+                        rows: np.ndarray) -> Tuple[dict, dict]:
+    """
+    Count the hits from each source and the hits from only one source in the given rows. Sources are added to the
+    counts in order of first appearance.
+    """
+    row_of_code = np.repeat(np.arange(len(lengths)), lengths)
+    in_rows = np.zeros(len(lengths), dtype=bool)
+    in_rows[rows] = True
+
+    def _counts_in_order(codes_to_count):
+        counts = {}
+        code_counts = np.bincount(codes_to_count, minlength=len(categories))
+        found_codes, first_positions = np.unique(codes_to_count, return_index=True)
+        for code in found_codes[np.argsort(first_positions)]:
+            counts[categories[code]] = int(code_counts[code])
+        return counts
+
+    source_counts = {'Total': len(rows)}
+    source_unique_counts = {'Total': len(rows)}
+    for counts, codes_to_count in [(source_counts, codes[in_rows[row_of_code]]),
+                                   (source_unique_counts,
+                                    codes[(np.cumsum(lengths) - lengths)[in_rows & (lengths == 1)]])]:
+        for s, count in _counts_in_order(codes_to_count).items():
+            counts[s] = counts.get(s, 0) + count
+    return source_counts, source_unique_counts
+
+
+def _translate_source_counts(source_counts: dict, source_unique_counts: dict, source_translations: dict):
+    """
+    Add the counts of sources containing each translated string to the count of its translation, and remove them.
+    The translations matching each source are found once for both sets of counts.
+    """
+    for key in source_translations.keys():
+        source_counts[key] = 0
+        source_unique_counts[key] = 0
+
+    matching_translations = {key: [source for source in source_translations.keys() if
+                                   source_translations[source] in key] for key in source_counts.keys()}
+    keys_to_remove = {}
+    for counts in [source_counts, source_unique_counts]:
+        for key in counts.keys():
+            for source in matching_translations[key]:
+                counts[source] += counts[key]
+                keys_to_remove[key] = None
+
+    for k in keys_to_remove:
+        if k in source_counts.keys():
+            del source_counts[k]
+        if k in source_unique_counts.keys():
+            del source_unique_counts[k]
+
 
 def output_summary_of_hit_csv(input_csv: str, output_csv_stub: str, families: List[str] = None,
                               ranks: List[str] = None,
                               source_translations: dict = None, check_duplicates=True):
+    """
+    Count the hits from each source in compiled hits.
+    :param input_csv: compiled hits csv, or parquet output by compile_hits whose sources are read without parsing
+    :param output_csv_stub:
+    :param families:
+    :param ranks:
+    :param source_translations:
+    :param check_duplicates:
+    :return:
+    """
     from wcvpy.wcvp_download import wcvp_accepted_columns
 
     if not os.path.isdir(os.path.dirname(output_csv_stub)):
         os.mkdir(os.path.dirname(output_csv_stub))
 
     from matplotlib import pyplot as plt
-    out_df = pd.read_csv(input_csv)
+    out_df, source_lengths, source_codes, source_categories = _read_hits_and_source_codes(input_csv)
 
     dup_hits_df = out_df[out_df.duplicated(subset=wcvp_accepted_columns['name'])]
     if len(dup_hits_df) > 0:
@@ -30,70 +131,15 @@ def output_summary_of_hit_csv(input_csv: str, output_csv_stub: str, families: Li
     if families is not None:
         out_df = out_df[out_df[wcvp_accepted_columns['family']].isin(families)]
 
-    source_counts = dict()
-    source_unique_counts = dict()
-
-    source_counts['Total'] = len(out_df['Compiled_Sources'].values)
-    total = len(out_df['Compiled_Sources'].values)
-    source_unique_counts['Total'] = total
-
-    for sources_str in out_df['Compiled_Sources'].values:
-
-        split_sources = ast.literal_eval(sources_str)
-
-        for s in split_sources:
-            if s not in source_counts.keys():
-                source_counts[s] = 1
-            else:
-                source_counts[s] += 1
-
-        if len(split_sources) == 1:
-            s = split_sources[0]
-            if s not in source_unique_counts.keys():
-                source_unique_counts[s] = 1
-            else:
-                source_unique_counts[s] += 1
+    source_counts, source_unique_counts = _count_source_codes(source_lengths, source_codes, source_categories,
+                                                              out_df.index.values)
 
     # Compress sources
     if source_translations is not None:
-        for key in source_translations.keys():
-            source_counts[key] = 0
-            source_unique_counts[key] = 0
-
-        keys_to_remove = []
-        for key in source_counts.keys():
-            for source in source_translations.keys():
-                if source_translations[source] in key:
-                    source_counts[source] += (source_counts[key])
-                    if key not in keys_to_remove:
-                        keys_to_remove.append(key)
-
-        for key in source_unique_counts.keys():
-            for source in source_translations.keys():
-                if source_translations[source] in key:
-                    source_unique_counts[source] += (source_unique_counts[key])
-                    if key not in keys_to_remove:
-                        keys_to_remove.append(key)
-
-        for k in keys_to_remove:
-            if k in source_counts.keys():
-                del source_counts[k]
-            if k in source_unique_counts.keys():
-                del source_unique_counts[k]
-
-    new_keys_to_remove = []
-    for k in source_counts:
-        if source_counts[k] == 0:
-            new_keys_to_remove.append(k)
-    for k in new_keys_to_remove:
-        del source_counts[k]
-
-    new_keys_to_remove = []
-    for k in source_unique_counts:
-        if source_unique_counts[k] == 0:
-            new_keys_to_remove.append(k)
-    for k in new_keys_to_remove:
-        del source_unique_counts[k]
+        _translate_source_counts(source_counts, source_unique_counts, source_translations)
+
+    source_counts = {k: v for k, v in source_counts.items() if v != 0}
+    source_unique_counts = {k: v for k, v in source_unique_counts.items() if v != 0}
 
     source_count_df = pd.DataFrame.from_dict(source_counts, orient='index', columns=['Count'])
     source_unique_counts_df = pd.DataFrame.from_dict(source_unique_counts, orient='index', columns=['Count'])
@@ -5,7 +5,8 @@ import pandas as pd
 from pkg_resources import resource_filename
 from wcvpy.wcvp_download import wcvp_accepted_columns
 
-from data_compilation_methods import compile_hits, compiled_sources_col
+from data_compilation_methods import compile_hits, compiled_sources_col, read_compiled_hits, \
+    compile_hits_incrementally, compile_hits_out_of_core
 
 _inputs_path = resource_filename(__name__, 'test_inputs')
 _outputs_path = resource_filename(__name__, 'test_outputs')
@@ -80,6 +81,94 @@ class MyTestCase(unittest.TestCase):
         merged_df = merged_df.sort_values(by=wcvp_accepted_columns['name']).reset_index(drop=True)
         pd.testing.assert_frame_equal(merged_df[merged_df.columns], automerged[merged_df.columns])
 
+    def test_engines_agree(self):
+        cornell_hits = pd.read_csv(os.path.join(_inputs_path, 'cornell_accepted.csv'))
+        wiki_hits = pd.read_csv(os.path.join(_inputs_path, 'wiki_poisons_accepted.csv'))
+        powo_hits = pd.read_csv(os.path.join(_inputs_path, 'powo_poisons_accepted.csv'))
+
+        for engine in ['merge', 'hash']:
+            compile_hits([powo_hits, wiki_hits, cornell_hits, wiki_hits],
+                         os.path.join(_outputs_path, 'output_poisons_compiled_' + engine + '.csv'), engine=engine)
+        with open(os.path.join(_outputs_path, 'output_poisons_compiled_merge.csv')) as merge_output, \
+                open(os.path.join(_outputs_path, 'output_poisons_compiled_hash.csv')) as hash_output:
+            self.assertEqual(merge_output.read(), hash_output.read())
+
+    def test_parquet_output(self):
+        cornell_hits = pd.read_csv(os.path.join(_inputs_path, 'cornell_accepted.csv'))
+        wiki_hits = pd.read_csv(os.path.join(_inputs_path, 'wiki_poisons_accepted.csv'))
+
+        compile_hits([wiki_hits, cornell_hits], os.path.join(_outputs_path, 'output_poisons_compiled.csv'),
+                     output_parquet=os.path.join(_outputs_path, 'output_poisons_compiled.parquet'))
+        csv_hits = read_compiled_hits(os.path.join(_outputs_path, 'output_poisons_compiled.csv'))
+        parquet_hits = read_compiled_hits(os.path.join(_outputs_path, 'output_poisons_compiled.parquet'))
+
+        self.assertEqual(csv_hits[compiled_sources_col].tolist(), parquet_hits[compiled_sources_col].tolist())
+        self.assertEqual(csv_hits[wcvp_accepted_columns['name_w_author']].tolist(),
+                         parquet_hits[wcvp_accepted_columns['name_w_author']].tolist())
+
+    def test_incremental_compilation(self):
+        cornell_hits = pd.read_csv(os.path.join(_inputs_path, 'cornell_accepted.csv'))
+        wiki_hits = pd.read_csv(os.path.join(_inputs_path, 'wiki_poisons_accepted.csv'))
+        powo_hits = pd.read_csv(os.path.join(_inputs_path, 'powo_poisons_accepted.csv'))
+        store_dir = os.path.join(_outputs_path, 'compiled_store')
+
+        for dfs in [[powo_hits, wiki_hits, cornell_hits], [powo_hits, wiki_hits.head(50), cornell_hits],
+                    [powo_hits, wiki_hits.head(50), cornell_hits, wiki_hits]]:
+            compile_hits(dfs, os.path.join(_outputs_path, 'output_poisons_compiled.csv'))
+            compile_hits_incrementally(dfs, os.path.join(_outputs_path, 'output_poisons_compiled_incremental.csv'),
+                                       store_dir)
+            with open(os.path.join(_outputs_path, 'output_poisons_compiled.csv')) as full_output, \
+                    open(os.path.join(_outputs_path, 'output_poisons_compiled_incremental.csv')) as incremental_output:
+                self.assertEqual(full_output.read(), incremental_output.read())
+
+    def test_incremental_compilation_from_files(self):
+        input_csvs = [os.path.join(_inputs_path, f) for f in
+                      ['powo_poisons_accepted.csv', 'wiki_poisons_accepted.csv', 'cornell_accepted.csv']]
+        store_dir = os.path.join(_outputs_path, 'compiled_store_from_files')
+
+        compile_hits([pd.read_csv(f) for f in input_csvs], os.path.join(_outputs_path, 'output_poisons_compiled.csv'))
+        for csvs in [input_csvs[:2], input_csvs, input_csvs]:
+            compile_hits_incrementally(csvs, os.path.join(_outputs_path, 'output_poisons_compiled_incremental.csv'),
+                                       store_dir)
+        with open(os.path.join(_outputs_path, 'output_poisons_compiled.csv')) as full_output, \
+                open(os.path.join(_outputs_path, 'output_poisons_compiled_incremental.csv')) as incremental_output:
+            self.assertEqual(full_output.read(), incremental_output.read())
+
+    def test_incremental_compilation_of_new_source_of_seen_names(self):
+        powo_hits = pd.read_csv(os.path.join(_inputs_path, 'powo_poisons_accepted.csv'))
+        # A new source with a new column, whose names are all in the first source
+        new_source_hits = powo_hits.head(20).copy()
+        new_source_hits['Source'] = 'New source'
+        new_source_hits['Source_count'] = 1
+        store_dir = os.path.join(_outputs_path, 'compiled_store_new_source')
+
+        for dfs in [[powo_hits], [powo_hits, new_source_hits]]:
+            compile_hits_incrementally(dfs, os.path.join(_outputs_path, 'output_poisons_compiled_incremental.csv'),
+                                       store_dir)
+        compile_hits([powo_hits, new_source_hits], os.path.join(_outputs_path, 'output_poisons_compiled.csv'),
+                     engine='merge')
+        with open(os.path.join(_outputs_path, 'output_poisons_compiled.csv')) as full_output, \
+                open(os.path.join(_outputs_path, 'output_poisons_compiled_incremental.csv')) as incremental_output:
+            self.assertEqual(full_output.read(), incremental_output.read())
+
+    def test_incremental_compilation_column_limit(self):
+        powo_hits = pd.read_csv(os.path.join(_inputs_path, 'powo_poisons_accepted.csv'))
+        wide_hits = powo_hits.assign(**{'extra_source_' + str(i): 1 for i in range(63)})
+        with self.assertRaises(ValueError):
+            compile_hits_incrementally([wide_hits], None, os.path.join(_outputs_path, 'compiled_store_wide'),
+                                       output_parquet=os.path.join(_outputs_path, 'wide.parquet'))
+
+    def test_out_of_core_compilation(self):
+        input_csvs = [os.path.join(_inputs_path, f) for f in
+                      ['powo_poisons_accepted.csv', 'wiki_poisons_accepted.csv', 'cornell_accepted.csv']]
+
+        compile_hits([pd.read_csv(f) for f in input_csvs], os.path.join(_outputs_path, 'output_poisons_compiled.csv'))
+        compile_hits_out_of_core(input_csvs, os.path.join(_outputs_path, 'output_poisons_compiled_out_of_core.csv'),
+                                 n_partitions=4, chunksize=100)
+        with open(os.path.join(_outputs_path, 'output_poisons_compiled.csv')) as full_output, \
+                open(os.path.join(_outputs_path, 'output_poisons_compiled_out_of_core.csv')) as out_of_core_output:
+            self.assertEqual(full_output.read(), out_of_core_output.read())
+
 
 if __name__ == '__main__':
     unittest.main()
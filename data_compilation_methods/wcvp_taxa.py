@@ -0,0 +1,78 @@
+import os
+
+import pandas as pd
+
+# WCVP taxa tables already loaded in this process, keyed by version
+_loaded_wcvp_taxa = {}
+# Index of the ipni ids of each loaded taxa table, keyed by version
+_loaded_ipni_id_indices = {}
+
+
+def get_wcvp_taxa(wcvp_version: str = None, cache_dir: str = None) -> pd.DataFrame:
+    """
+    Get the WCVP taxa table from wcvpy's get_all_taxa. Tables are kept for the rest of the process and, when both
+    wcvp_version and cache_dir are given, saved there as parquet so later processes load this rather than the
+    checklist.
+    Note that the returned dataframe is shared between calls so should not be modified.
+    :param wcvp_version:
+    :param cache_dir: directory to save tables to (requires pyarrow)
+    :return:
+    """
+    from wcvpy.wcvp_download import get_all_taxa
+
+    if wcvp_version not in _loaded_wcvp_taxa:
+        # Tables for an unspecified version aren't saved as they will go out of date
+        parquet_file = None
+        if cache_dir is not None and wcvp_version is not None:
+            parquet_file = os.path.join(cache_dir, 'wcvp_taxa_' + wcvp_version + '.parquet')
+
+        if parquet_file is not None and os.path.isfile(parquet_file):
+            all_taxa = pd.read_parquet(parquet_file, memory_map=True)
+        else:
+            all_taxa = get_all_taxa(version=wcvp_version)
+            if parquet_file is not None:
+                os.makedirs(cache_dir, exist_ok=True)
+                # Write to a temporary file first so that other processes never read a partly written cache
+                tmp_file = parquet_file + '.' + str(os.getpid()) + '.tmp'
+                all_taxa.to_parquet(tmp_file)
+                os.replace(tmp_file, parquet_file)
+        _loaded_wcvp_taxa[wcvp_version] = all_taxa
+
+    return _loaded_wcvp_taxa[wcvp_version]
+
+
+def get_wcvp_taxa_with_ipni_ids(ipni_ids, wcvp_version: str = None, cache_dir: str = None) -> pd.DataFrame:
+    """
+    Rows of the WCVP taxa table (see get_wcvp_taxa) with the given ipni ids, found from an index of ipni ids built
+    once for each version.
+    :param ipni_ids:
+    :param wcvp_version:
+    :param cache_dir:
+    :return:
+    """
+    all_taxa = get_wcvp_taxa(wcvp_version, cache_dir)
+    if wcvp_version not in _loaded_ipni_id_indices:
+        _loaded_ipni_id_indices[wcvp_version] = pd.Index(all_taxa['ipni_id'].values)
+    ipni_id_index = _loaded_ipni_id_indices[wcvp_version]
+
+    ids = pd.unique(pd.Series(list(ipni_ids), dtype=object).dropna())
+    positions = ipni_id_index.get_indexer_for(ids)
+    return all_taxa.iloc[sorted(positions[positions >= 0])]
+
+
+def resolve_ipni_ids_in_column(df: pd.DataFrame, id_col: str, wcvp_version: str = None,
+                               cache_dir: str = None) -> pd.DataFrame:
+    """
+    Add accepted WCVP info for the ipni ids in a column with wcvpy's get_accepted_wcvp_info_from_ipni_ids_in_column,
+    using the taxa table loaded once by get_wcvp_taxa rather than loading the checklist for each call. The whole
+    table is passed as the accepted names of synonyms are looked up in it.
+    :param df:
+    :param id_col:
+    :param wcvp_version:
+    :param cache_dir: see get_wcvp_taxa
+    :return:
+    """
+    from wcvpy.wcvp_name_matching import get_accepted_wcvp_info_from_ipni_ids_in_column
+
+    all_taxa = get_wcvp_taxa(wcvp_version, cache_dir)
+    return get_accepted_wcvp_info_from_ipni_ids_in_column(df, id_col, all_taxa)
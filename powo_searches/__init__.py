@@ -1 +1,2 @@
-from .powo_searches import *
\ No newline at end of file
+from .powo_searches import *
+from .powo_api import *
@@ -0,0 +1,295 @@
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import List, Tuple
+
+from tqdm import tqdm
+
+# Base url of the POWO api, as used by pykew. Can be changed to point to a local server in tests
+powo_api_url = 'http://www.plantsoftheworldonline.org/api/2'
+
+# Number of results in each page of search results
+powo_results_per_page = 500
+
+# Default rate limit for POWO requests. Searches used to make requests back to back, pausing only between search
+# terms and characteristics, which gave roughly this rate
+powo_requests_per_second = 5
+
+
+def _term_value(term) -> str:
+    # Terms may be given as pykew enums or as their string values
+    return term.value if hasattr(term, 'value') else term
+
+
+def format_powo_query(query: dict) -> str:
+    return ','.join([_term_value(k) + ':' + v for k, v in query.items()])
+
+
+def format_powo_filters(filters) -> str:
+    if isinstance(filters, list):
+        return ','.join([_term_value(f) for f in filters])
+    return _term_value(filters)
+
+
+def _get_powo_search_page(query: dict, filters: List, cursor: str, session, api_url: str = None) -> dict:
+    if api_url is None:
+        api_url = powo_api_url
+    params = {'perPage': powo_results_per_page, 'cursor': cursor}
+    if query:
+        params['q'] = format_powo_query(query)
+    if filters:
+        params['f'] = format_powo_filters(filters)
+    response = session.get(api_url + '/search', params=params)
+    # Rate limiting and server errors which are left after retries would otherwise be read as a page without results
+    response.raise_for_status()
+    return response.json()
+
+
+def get_powo_search_results(query: dict, filters: List = None, session=None, api_url: str = None,
+                            first_page: dict = None) -> List[dict]:
+    """
+    All results of a POWO search, requesting the same pages as iterating over pykew.powo.search(query, filters).
+    Requests go through a RateLimitedSession so that they can be cached with a ResponseCache.
+    :param query: dict of pykew powo_terms to search values
+    :param filters: list of pykew powo_terms.Filters
+    :param session: RateLimitedSession, a new one limited to powo_requests_per_second is created if not given
+    :param api_url: base url of the api, see powo_api_url
+    :param first_page: the response to the first request for this search, if it has already been made
+    :return:
+    """
+    from web_request_methods import RateLimitedSession
+
+    if session is None:
+        session = RateLimitedSession(requests_per_second=powo_requests_per_second)
+
+    results = []
+    cursor = '*'
+    response_json = first_page
+    while True:
+        if response_json is None:
+            response_json = _get_powo_search_page(query, filters, cursor, session, api_url)
+        # As in pykew, paging stops at the first response without any results
+        page_results = response_json.get('results', [])
+        if len(page_results) == 0:
+            break
+        results.extend(page_results)
+        if 'cursor' not in response_json or response_json['cursor'] == cursor:
+            break
+        cursor = response_json['cursor']
+        response_json = None
+    return results
+
+
+def plan_powo_queries(search_terms: List[str], characteristics: List, families: List[str] = None) -> List[dict]:
+    """
+    Queries to run for each search term in each characteristic, restricted to each family if given.
+    :param search_terms:
+    :param characteristics: pykew powo_terms.Characteristic values
+    :param families:
+    :return: list of query dicts, in the order results are output by search_powo
+    """
+    queries = []
+    for st in search_terms:
+        for charac in characteristics:
+            if families is not None:
+                for fam in families:
+                    # 'family' is the value of pykew's powo_terms.Name.family
+                    queries.append({charac: st, 'family': fam})
+            else:
+                queries.append({charac: st})
+    return queries
+
+
+def _query_key(query: dict, filters: List = None) -> Tuple[str, str]:
+    return format_powo_query(query), '' if not filters else format_powo_filters(filters)
+
+
+def _read_query_journal(journal_file: str) -> dict:
+    """
+    Read results appended by _append_to_query_journal.
+    :return: dict of query key to results
+    """
+    journal = {}
+    if journal_file is None or not os.path.isfile(journal_file):
+        return journal
+    with open(journal_file, encoding='utf-8') as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                # Lines which were only partly written when a run was interrupted
+                continue
+            journal[(entry['query'], entry['filters'])] = entry['results']
+    return journal
+
+
+def _append_to_query_journal(journal_file: str, key: Tuple[str, str], results: List[dict]):
+    with open(journal_file, 'a', encoding='utf-8') as f:
+        f.write(json.dumps({'query': key[0], 'filters': key[1], 'results': results}) + '\n')
+
+
+def run_powo_queries(queries: List[dict], filters: List = None, session=None, api_url: str = None,
+                     max_workers: int = 4, journal_file: str = None, first_pages: dict = None) -> List[List[dict]]:
+    """
+    Get the results of each query, see get_powo_search_results. Identical queries are only run once and different
+    queries are run concurrently, with requests rate limited by the session. Pages of each query are fetched in turn
+    as each page gives the cursor for the next.
+    If a journal_file is given, the raw results of each query are appended to it as the query completes and queries
+    already in the journal aren't run again, so an interrupted or failed run can be resumed.
+    :param queries: list of query dicts
+    :param filters: list of pykew powo_terms.Filters applied to every query
+    :param session: RateLimitedSession, a new one limited to powo_requests_per_second is created if not given
+    :param api_url: base url of the api, see powo_api_url
+    :param max_workers: number of queries to run at once
+    :param journal_file: file to store the results of completed queries in
+    :param first_pages: dict of query key to the first page of results, for queries where this has already been
+    requested
+    :return: list of the results of each query, in the order of queries
+    """
+    from web_request_methods import RateLimitedSession
+
+    if session is None:
+        session = RateLimitedSession(requests_per_second=powo_requests_per_second)
+    if first_pages is None:
+        first_pages = {}
+    unique_queries = {}
+    for query in queries:
+        unique_queries.setdefault(_query_key(query, filters), query)
+
+    results = _read_query_journal(journal_file)
+    queries_to_run = [key for key in unique_queries if key not in results]
+    if len(results) > 0 and len(queries_to_run) < len(unique_queries):
+        print(f'Using journalled results for {len(unique_queries) - len(queries_to_run)} POWO queries')
+
+    failed_queries = []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(get_powo_search_results, unique_queries[key], filters, session=session,
+                                   api_url=api_url, first_page=first_pages.get(key)): key for key in queries_to_run}
+        for future in tqdm(as_completed(futures), total=len(futures), desc="Searching POWO…", ascii=False,
+                           ncols=72):
+            key = futures[future]
+            try:
+                results[key] = future.result()
+            except Exception as e:
+                print(f'Warning: POWO query {key} failed: {e}')
+                failed_queries.append(key)
+                continue
+            if journal_file is not None:
+                _append_to_query_journal(journal_file, key, results[key])
+
+    if len(failed_queries) > 0:
+        rerun_message = ' Rerun to retry them.' if journal_file is not None else ''
+        raise ValueError(f'{len(failed_queries)} POWO queries failed.{rerun_message}')
+    return [results[_query_key(query, filters)] for query in queries]
+
+
+def _count_requests(n_results: int) -> int:
+    # Pages are requested until one has no results
+    if n_results == 0:
+        return 1
+    return -(-n_results // powo_results_per_page) + 1
+
+
+def choose_queries_to_fuse(queries: List[dict], families: List[str], filters: List = None, session=None,
+                           api_url: str = None, max_workers: int = 4, journal_file: str = None) -> Tuple[
+    List[bool], dict]:
+    """
+    Decide for each query whether to run it once without a family restriction and filter the results by family
+    locally (fusing the family queries), or to run it restricted to each family.
+    A query is fused where it needs no more requests than the family queries, which need at least one request each.
+    The number of results of each query is found from its first page of results, which is returned to be reused when
+    running the query. Queries already in the journal are fused as they need no requests.
+    :param queries: list of query dicts without a family restriction
+    :param families:
+    :param filters:
+    :param session: RateLimitedSession
+    :param api_url: base url of the api, see powo_api_url
+    :param max_workers: number of first pages to request at once
+    :param journal_file: see run_powo_queries
+    :return: list of whether to fuse each query, and dict of query key to first page of results
+    """
+    journal = _read_query_journal(journal_file)
+    keys = [_query_key(query, filters) for query in queries]
+    keys_to_probe = list(dict.fromkeys(key for key in keys if key not in journal))
+    queries_by_key = dict(zip(keys, queries))
+
+    def _probe(key):
+        return key, _get_powo_search_page(queries_by_key[key], filters, '*', session, api_url)
+
+    first_pages = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for key, first_page in tqdm(executor.map(_probe, keys_to_probe), total=len(keys_to_probe),
+                                    desc="Counting POWO results…", ascii=False, ncols=72):
+            first_pages[key] = first_page
+
+    fuse = []
+    fused_requests = 0
+    for key in keys:
+        if key in journal:
+            fuse.append(True)
+            continue
+        first_page = first_pages[key]
+        n_results = first_page.get('totalResults', len(first_page.get('results', [])))
+        fuse.append(_count_requests(n_results) <= len(families))
+        fused_requests += min(_count_requests(n_results), len(families))
+
+    print(f'Fusing family queries for {sum(fuse)} of {len(queries)} POWO queries. Estimated {fused_requests} '
+          f'requests, rather than at least {len(queries) * len(families)} without fusing')
+    return fuse, first_pages
+
+
+def run_family_powo_queries(search_terms: List[str], characteristics: List, families: List[str],
+                            filters: List = None, plan: str = 'auto', session=None, api_url: str = None,
+                            max_workers: int = 4, journal_file: str = None) -> List[dict]:
+    """
+    Results of searching each term in each characteristic restricted to each family, as from running the queries of
+    plan_powo_queries(search_terms, characteristics, families).
+    :param search_terms:
+    :param characteristics:
+    :param families:
+    :param filters:
+    :param plan: 'per_family' to run a query for each family, 'fused' to run each query once without a family
+    restriction and keep results whose family field is one of the families, or 'auto' to choose for each query
+    with choose_queries_to_fuse
+    :param session: RateLimitedSession, a new one limited to powo_requests_per_second is created if not given
+    :param api_url: base url of the api, see powo_api_url
+    :param max_workers: number of queries to run at once
+    :param journal_file: see run_powo_queries
+    :return: list of results, ordered by term, characteristic and then family
+    """
+    from web_request_methods import RateLimitedSession
+
+    if plan not in ['per_family', 'fused', 'auto']:
+        raise ValueError(f'Unknown plan: {plan}')
+    if session is None:
+        session = RateLimitedSession(requests_per_second=powo_requests_per_second)
+
+    unrestricted_queries = plan_powo_queries(search_terms, characteristics)
+    first_pages = {}
+    if plan == 'auto':
+        fuse, first_pages = choose_queries_to_fuse(unrestricted_queries, families, filters, session=session,
+                                                   api_url=api_url, max_workers=max_workers,
+                                                   journal_file=journal_file)
+    else:
+        fuse = [plan == 'fused'] * len(unrestricted_queries)
+
+    queries = []
+    for query, fuse_query in zip(unrestricted_queries, fuse):
+        if fuse_query:
+            queries.append(query)
+        else:
+            queries.extend(dict(query, family=fam) for fam in families)
+    query_results = iter(run_powo_queries(queries, filters, session=session, api_url=api_url,
+                                          max_workers=max_workers, journal_file=journal_file,
+                                          first_pages=first_pages))
+
+    all_results = []
+    for fuse_query in fuse:
+        if fuse_query:
+            fused_results = next(query_results)
+            for fam in families:
+                all_results.extend(r for r in fused_results if r.get('family') == fam)
+        else:
+            for fam in families:
+                all_results.extend(next(query_results))
+    return all_results
@@ -4,11 +4,16 @@ from typing import List, Tuple
 import numpy as np
 import pandas as pd
 
-from data_compilation_methods import single_source_col
+from data_compilation_methods import single_source_col, resolve_ipni_ids_in_column
+from powo_searches.powo_api import plan_powo_queries, run_powo_queries, run_family_powo_queries, \
+    powo_requests_per_second
 
 
 def search_powo(search_terms: List[str], accepted_output_file: str, filters: List[str] = None,
-                characteristics_to_search: List[str] = None, families_of_interest: List[str] = None, wcvp_version: str = None):
+                characteristics_to_search: List[str] = None, families_of_interest: List[str] = None, wcvp_version: str = None,
+                session=None, api_url: str = None, max_workers: int = 4,
+                requests_per_second: float = powo_requests_per_second,
+                journal_file: str = None, family_query_plan: str = 'per_family', wcvp_cache_dir: str = None):
     """
     Possible characteristics
     summary
@@ -35,14 +40,25 @@ def search_powo(search_terms: List[str], accepted_output_file: str, filters: Lis
     :param filters:
     :param characteristics_to_search:
     :param families_of_interest:
+    :param session: RateLimitedSession to make requests with, e.g. to use a ResponseCache. If not given a new
+    session is created limited to requests_per_second
+    :param api_url: base url of the POWO api, see powo_api.powo_api_url
+    :param max_workers: number of queries to run at once
+    :param requests_per_second: maximum rate of requests to POWO when session isn't given, see
+    powo_api.powo_requests_per_second
+    :param journal_file: file to store the raw results of each query in as it completes. Queries already in the
+    journal aren't searched again, so interrupted searches can be resumed. Use a new file to get up to date results.
+    :param family_query_plan: how to search families_of_interest. 'per_family' runs a query for each family, 'fused'
+    runs each query once without a family restriction and keeps results whose family is of interest, and 'auto'
+    fuses queries where this needs fewer requests, see powo_api.choose_queries_to_fuse
+    :param wcvp_cache_dir: directory to save the WCVP taxa table to, see get_wcvp_taxa
     :return:
 
     """
-    from wcvpy.wcvp_download import get_all_taxa, wcvp_accepted_columns
-    from wcvpy.wcvp_name_matching import clean_urn_ids, get_accepted_wcvp_info_from_ipni_ids_in_column
-    import pykew.powo as powo
+    from wcvpy.wcvp_download import wcvp_accepted_columns
+    from wcvpy.wcvp_name_matching import clean_urn_ids
     from pykew import powo_terms
-    import time
+    from web_request_methods import RateLimitedSession
 
     if accepted_output_file is not None:
         out_dir = os.path.dirname(accepted_output_file)
@@ -63,47 +79,17 @@ def search_powo(search_terms: List[str], accepted_output_file: str, filters: Lis
         powofilters = None
     else:
         powofilters = [getattr(powo_terms.Filters, x) for x in filters]
-    all_results = []
-
-    for st in search_terms:
-        time.sleep(1)
-        for charac in powocharacteristics_to_search:
-            time.sleep(1)
-            if families_of_interest is not None:
-                for fam in families_of_interest:
-                    query = {charac: st, powo_terms.Name.family: fam}
-                    results = powo.search(query, filters=powofilters)
-                    try:
-                        # If results has multiple pages
-                        for r in results:
-                            try:
-                                all_results.append(r)
-                            except KeyError:
-                                pass
-                    except AttributeError:
-                        try:
-                            for result in results._response['results']:
-                                all_results.append(result)
-                        except KeyError:
-                            pass
-
-            else:
-                query = {charac: st}
-
-                results = powo.search(query, filters=powofilters)
-                try:
-                    # If results has multiple pages
-                    for r in results:
-                        try:
-                            all_results.append(r)
-                        except KeyError:
-                            pass
-                except AttributeError:
-                    try:
-                        for result in results._response['results']:
-                            all_results.append(result)
-                    except KeyError:
-                        pass
+    if session is None:
+        session = RateLimitedSession(requests_per_second=requests_per_second)
+    if families_of_interest is not None and family_query_plan != 'per_family':
+        all_results = run_family_powo_queries(search_terms, powocharacteristics_to_search, families_of_interest,
+                                              powofilters, plan=family_query_plan, session=session, api_url=api_url,
+                                              max_workers=max_workers, journal_file=journal_file)
+    else:
+        queries = plan_powo_queries(search_terms, powocharacteristics_to_search, families_of_interest)
+        query_results = run_powo_queries(queries, powofilters, session=session, api_url=api_url,
+                                         max_workers=max_workers, journal_file=journal_file)
+        all_results = [r for results in query_results for r in results]
     df = pd.DataFrame(all_results)
     df.rename(
         columns={'snippet': 'powo_Snippet',
@@ -114,8 +100,7 @@ def search_powo(search_terms: List[str], accepted_output_file: str, filters: Lis
         df['fqId'] = df['fqId'].apply(clean_urn_ids)
     else:
         df[single_source_col] = np.nan
-    all_taxa = get_all_taxa(version=wcvp_version)
-    acc_df = get_accepted_wcvp_info_from_ipni_ids_in_column(df, 'fqId', all_taxa)
+    acc_df = resolve_ipni_ids_in_column(df, 'fqId', wcvp_version=wcvp_version, cache_dir=wcvp_cache_dir)
     acc_df.sort_values(by=wcvp_accepted_columns['name']).to_csv(accepted_output_file)
 
 
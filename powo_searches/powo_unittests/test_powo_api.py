@@ -0,0 +1,166 @@
+import json
+import os
+import tempfile
+import threading
+import unittest
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from powo_searches.powo_api import plan_powo_queries, run_family_powo_queries, run_powo_queries
+from web_request_methods import RateLimitedSession
+
+# Families of the taxa the stub server finds for each query without a family restriction, with 2 results per page
+stub_records = {'use:poison': ['Apocynaceae', 'Rubiaceae', 'Apocynaceae', 'Poaceae', 'Apocynaceae'],
+                'summary:poison': ['Apocynaceae']}
+stub_page_size = 2
+# Queries which the stub server gives an error for, with the status code of the error
+failing_queries = {}
+
+
+class _StubPOWOHandler(BaseHTTPRequestHandler):
+    requests_made = []
+
+    def do_GET(self):
+        params = dict(urllib.parse.parse_qsl(urllib.parse.urlsplit(self.path).query))
+        self.requests_made.append(params)
+        if params['q'] in failing_queries:
+            # Errors have a json body, as from the POWO api, so they can't be told apart from results by parsing
+            self.send_response(failing_queries[params['q']])
+            self.send_header('Content-Type', 'application/json')
+            self.end_headers()
+            self.wfile.write(json.dumps({'message': 'error'}).encode())
+            return
+
+        page = 0 if params['cursor'] == '*' else int(params['cursor'])
+        terms = params['q'].split(',')
+        families = [t.split(':')[1] for t in terms if t.startswith('family:')]
+        records = [{'name': 'Taxon ' + str(i), 'fqId': 'urn:lsid:ipni.org:names:' + str(i),
+                    'url': '/taxon/urn:lsid:ipni.org:names:' + str(i), 'family': fam, 'snippet': 'poison'} for i, fam
+                   in enumerate(stub_records.get(','.join(t for t in terms if not t.startswith('family:')), []))
+                   if len(families) == 0 or fam in families]
+        results = records[page * stub_page_size:(page + 1) * stub_page_size]
+        body = {'totalResults': len(records), 'cursor': str(page + 1)}
+        if len(results) > 0:
+            body['results'] = results
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.end_headers()
+        self.wfile.write(json.dumps(body).encode())
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MyTestCase(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), _StubPOWOHandler)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.api_url = 'http://127.0.0.1:' + str(cls.server.server_port)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+
+    def setUp(self):
+        _StubPOWOHandler.requests_made.clear()
+
+    def test_paginated_results(self):
+        queries = plan_powo_queries(['poison'], ['use', 'summary'])
+        results = run_powo_queries(queries, session=RateLimitedSession(requests_per_second=100),
+                                   api_url=self.api_url)
+        self.assertEqual([r['name'] for r in results[0]], ['Taxon ' + str(i) for i in range(5)])
+        self.assertEqual([r['name'] for r in results[1]], ['Taxon 0'])
+        # Pages of 2, 2 and 1 results, then an empty page for use, and a page of 1 then an empty page for summary
+        self.assertEqual(len(_StubPOWOHandler.requests_made), 6)
+
+    def test_duplicate_queries(self):
+        queries = plan_powo_queries(['poison', 'poison'], ['use'], families=['Apocynaceae', 'Rubiaceae'])
+        self.assertEqual(len(queries), 4)
+        results = run_powo_queries(queries, filters=['accepted_names'],
+                                   session=RateLimitedSession(requests_per_second=100), api_url=self.api_url)
+
+        self.assertEqual(len(results), 4)
+        self.assertEqual(results[0], results[2])
+        self.assertEqual([r['name'] for r in results[0]], ['Taxon 0', 'Taxon 2', 'Taxon 4'])
+        self.assertEqual([r['name'] for r in results[1]], ['Taxon 1'])
+        # Duplicated queries are only requested once, 3 pages for Apocynaceae and 2 for Rubiaceae
+        self.assertEqual(len(_StubPOWOHandler.requests_made), 5)
+        self.assertTrue(all(r['f'] == 'accepted_names' for r in _StubPOWOHandler.requests_made))
+
+    def test_journal(self):
+        queries = plan_powo_queries(['poison'], ['use', 'summary'])
+        session = RateLimitedSession(requests_per_second=100, max_retries=0)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            journal_file = os.path.join(tmpdir, 'journal.jsonl')
+            failing_queries['summary:poison'] = 429
+            try:
+                with self.assertRaises(ValueError):
+                    run_powo_queries(queries, session=session, api_url=self.api_url, journal_file=journal_file)
+            finally:
+                failing_queries.clear()
+            # The failed query isn't journalled
+            with open(journal_file) as f:
+                self.assertEqual([json.loads(line)['query'] for line in f], ['use:poison'])
+
+            # Only the failed query is searched again
+            _StubPOWOHandler.requests_made.clear()
+            results = run_powo_queries(queries, session=session, api_url=self.api_url, journal_file=journal_file)
+            self.assertEqual([r['q'] for r in _StubPOWOHandler.requests_made], ['summary:poison'] * 2)
+            self.assertEqual(len(results[0]), 5)
+            self.assertEqual(len(results[1]), 1)
+
+            _StubPOWOHandler.requests_made.clear()
+            self.assertEqual(run_powo_queries(queries, session=session, api_url=self.api_url,
+                                              journal_file=journal_file), results)
+            self.assertEqual(len(_StubPOWOHandler.requests_made), 0)
+
+    def test_errors_after_retries(self):
+        import requests
+
+        queries = plan_powo_queries(['poison'], ['use', 'summary'])
+        session = RateLimitedSession(requests_per_second=100, max_retries=1, backoff=0.01)
+        for status_code in [429, 503]:
+            _StubPOWOHandler.requests_made.clear()
+            failing_queries['use:poison'] = status_code
+            try:
+                # Errors left after retries fail the query rather than giving no results
+                with self.assertRaises(ValueError):
+                    run_powo_queries(queries, session=session, api_url=self.api_url)
+                self.assertEqual([r['q'] for r in _StubPOWOHandler.requests_made].count('use:poison'), 2)
+                with self.assertRaises(requests.HTTPError):
+                    run_family_powo_queries(['poison'], ['use'], ['Rubiaceae'], plan='auto', session=session,
+                                            api_url=self.api_url)
+            finally:
+                failing_queries.clear()
+
+    def test_fused_family_queries(self):
+        session = RateLimitedSession(requests_per_second=100)
+        families = ['Rubiaceae', 'Apocynaceae', 'Fabaceae']
+        per_family_results = run_family_powo_queries(['poison'], ['use', 'summary'], families, plan='per_family',
+                                                     session=session, api_url=self.api_url)
+        per_family_requests = len(_StubPOWOHandler.requests_made)
+        self.assertEqual([r['name'] for r in per_family_results],
+                         ['Taxon 1', 'Taxon 0', 'Taxon 2', 'Taxon 4', 'Taxon 0'])
+
+        for plan in ['fused', 'auto']:
+            _StubPOWOHandler.requests_made.clear()
+            results = run_family_powo_queries(['poison'], ['use', 'summary'], families, plan=plan,
+                                              session=session, api_url=self.api_url)
+            self.assertEqual(results, per_family_results)
+            # 4 pages for use and 2 for summary
+            self.assertEqual(len(_StubPOWOHandler.requests_made), 6)
+            self.assertLess(len(_StubPOWOHandler.requests_made), per_family_requests)
+
+        # With a single family the family query needs fewer requests
+        _StubPOWOHandler.requests_made.clear()
+        results = run_family_powo_queries(['poison'], ['use'], ['Rubiaceae'], plan='auto', session=session,
+                                          api_url=self.api_url)
+        self.assertEqual([r['name'] for r in results], ['Taxon 1'])
+        self.assertEqual([r['q'] for r in _StubPOWOHandler.requests_made],
+                         ['use:poison', 'use:poison,family:Rubiaceae', 'use:poison,family:Rubiaceae'])
+
+
+if __name__ == '__main__':
+    unittest.main()
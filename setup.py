@@ -8,10 +8,11 @@ setup(
     # Needed to actually package something
     packages=find_packages(include=['clean_plant_occurrences', 'data_compilation_methods',
                                     'powo_searches',
-                                    'wikipedia_searches'], exclude=['unit_test_methods']),
+                                    'wikipedia_searches', 'web_request_methods'], exclude=['unit_test_methods']),
 
     package_data={
-        "clean_plant_occurrences": ["inputs/wgsrpd-master/level3/*"],
+        "clean_plant_occurrences": ["inputs/wgsrpd-master/level1/*", "inputs/wgsrpd-master/level2/*",
+                                    "inputs/wgsrpd-master/level3/*", "inputs/wgsrpd-master/level4/*"],
     },
     install_requires=[
         "wcvpy >= 1.3.2",
@@ -0,0 +1,2 @@
+from .rate_limiting import *
+from .response_cache import *
@@ -0,0 +1,120 @@
+import threading
+import time
+import urllib.parse
+
+_default_user_agent = 'TraitBot/0.0 (a.richard-bollans@kew.org)'
+
+# Status codes which are worth retrying. 249 is used by POWO for too many requests
+_retry_status_codes = {249, 429, 500, 502, 503, 504}
+
+
+class TokenBucket:
+    """
+    Thread safe token bucket rate limiter. Allows bursts of up to `capacity` requests and on average `rate`
+    requests per second.
+    """
+
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self._tokens = self.capacity
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Block until a token is available and take it.
+        """
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+                self._last = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+class RateLimitedSession:
+    """
+    Wrapper around a pooled requests.Session which limits the rate of requests to each host with a shared
+    TokenBucket and retries failed requests with exponential backoff. Safe to share between threads.
+    If given a ResponseCache, responses are looked up there before any request is made.
+    """
+
+    def __init__(self, requests_per_second: float = 10.0, max_retries: int = 5, backoff: float = 1.0,
+                 pool_size: int = 20, timeout: float = 30, user_agent: str = _default_user_agent, cache=None):
+        """
+        :param requests_per_second: maximum average rate of requests to any one host
+        :param max_retries: number of times to retry a request after connection errors or retryable status codes
+        :param backoff: seconds to wait before the first retry, doubled for each subsequent retry
+        :param pool_size: number of connections to keep open to each host
+        :param timeout: seconds to wait for a response
+        :param user_agent:
+        :param cache: ResponseCache to store responses in and return them from
+        """
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        self.requests_per_second = requests_per_second
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.cache = cache
+        self._session = requests.Session()
+        self._session.headers.update({'User-Agent': user_agent})
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
+        self._buckets = {}
+        self._buckets_lock = threading.Lock()
+
+    def _bucket_for_url(self, url: str) -> TokenBucket:
+        host = urllib.parse.urlsplit(url).netloc
+        with self._buckets_lock:
+            if host not in self._buckets:
+                self._buckets[host] = TokenBucket(self.requests_per_second)
+            return self._buckets[host]
+
+    def get(self, url: str, params: dict = None, **kwargs):
+        """
+        Rate limited GET request, retrying on connection errors and retryable status codes.
+        Cached responses are returned without making a request. Responses other than server errors and rate limiting
+        are added to the cache.
+        :return: requests.Response or CachedResponse. Raises the last error if all retries fail.
+        """
+        import requests
+
+        if self.cache is not None:
+            cached_response = self.cache.get(url, params)
+            if cached_response is not None:
+                return cached_response
+            if self.cache.offline:
+                raise ValueError(f'No cached response for {url} with params {params} and the cache is offline')
+
+        bucket = self._bucket_for_url(url)
+        kwargs.setdefault('timeout', self.timeout)
+        for attempt in range(self.max_retries + 1):
+            bucket.acquire()
+            try:
+                response = self._session.get(url, params=params, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt == self.max_retries:
+                    raise
+                time.sleep(self.backoff * 2 ** attempt)
+                continue
+
+            if response.status_code in _retry_status_codes and attempt < self.max_retries:
+                retry_after = response.headers.get('Retry-After')
+                try:
+                    wait = float(retry_after)
+                except (TypeError, ValueError):
+                    wait = self.backoff * 2 ** attempt
+                time.sleep(wait)
+                continue
+            if self.cache is not None and response.status_code < 500 and \
+                    response.status_code not in _retry_status_codes:
+                self.cache.put(url, params, response)
+            return response
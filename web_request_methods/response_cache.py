@@ -0,0 +1,155 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+import urllib.parse
+from typing import Dict
+
+
+def normalise_url(url: str, params: dict = None) -> str:
+    """
+    Normalise a url and its parameters so that equivalent requests have the same cache key i.e. lower case scheme and
+    host, no default port or fragment and sorted query parameters.
+    """
+    split = urllib.parse.urlsplit(url)
+    scheme = split.scheme.lower()
+    netloc = split.netloc.lower()
+    if (scheme == 'http' and netloc.endswith(':80')) or (scheme == 'https' and netloc.endswith(':443')):
+        netloc = netloc.rsplit(':', 1)[0]
+    query = urllib.parse.parse_qsl(split.query, keep_blank_values=True)
+    if params is not None:
+        query += [(str(k), str(v)) for k, v in params.items() if v is not None]
+    return urllib.parse.urlunsplit((scheme, netloc, split.path, urllib.parse.urlencode(sorted(query)), ''))
+
+
+class CachedResponse:
+    """
+    Response loaded from a ResponseCache, with the parts of the requests.Response interface used in this package.
+    """
+
+    def __init__(self, url: str, status_code: int, content: bytes, headers: dict):
+        self.url = url
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers
+        self.from_cache = True
+
+    @property
+    def text(self) -> str:
+        return self.content.decode('utf-8')
+
+    def json(self):
+        return json.loads(self.content)
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            import requests
+            raise requests.HTTPError(f'{self.status_code} Error for url: {self.url}', response=self)
+
+
+class ResponseCache:
+    """
+    On-disk cache of http responses in a SQLite database, keyed by normalised url and parameters.
+    Entries expire after a time to live which can be set per endpoint, and the least recently used entries are
+    evicted when the cache grows beyond max_size_bytes. In offline mode only cached responses are returned.
+    Safe to share between threads.
+    """
+
+    def __init__(self, db_file: str, ttls: Dict[str, float] = None, default_ttl: float = None,
+                 max_size_bytes: int = 2 * 1024 ** 3, offline: bool = False):
+        """
+        :param db_file: SQLite file to store responses in
+        :param ttls: dict of url prefix (without scheme, e.g. 'en.wikipedia.org/w/api.php') to time to live in
+        seconds. The longest matching prefix is used.
+        :param default_ttl: time to live in seconds for urls not matching any prefix in ttls. None means responses
+        never expire
+        :param max_size_bytes: maximum total size of cached response bodies
+        :param offline: if True, requests which aren't cached raise an error rather than going to the network
+        """
+        self.db_file = db_file
+        self.ttls = ttls if ttls is not None else {}
+        self.default_ttl = default_ttl
+        self.max_size_bytes = max_size_bytes
+        self.offline = offline
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(db_file, check_same_thread=False)
+        with self._lock, self._connection:
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, url TEXT, status_code INTEGER, '
+                'content BLOB, headers TEXT, created REAL, last_access REAL, size INTEGER)')
+            self._connection.execute('CREATE INDEX IF NOT EXISTS last_access_index ON responses (last_access)')
+            # Running total of the size of cached responses, so that it isn't summed on every put
+            self._total_size = self._connection.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+
+    def _ttl_for_url(self, normalised_url: str) -> float:
+        url_without_scheme = normalised_url.split('://', 1)[-1]
+        matching_prefixes = [p for p in self.ttls if url_without_scheme.startswith(p)]
+        if len(matching_prefixes) == 0:
+            return self.default_ttl
+        return self.ttls[max(matching_prefixes, key=len)]
+
+    @staticmethod
+    def _key(normalised_url: str) -> str:
+        return hashlib.sha256(normalised_url.encode()).hexdigest()
+
+    def get(self, url: str, params: dict = None):
+        """
+        :return: CachedResponse, or None if there is no unexpired cached response
+        """
+        normalised_url = normalise_url(url, params)
+        key = self._key(normalised_url)
+        with self._lock, self._connection:
+            row = self._connection.execute('SELECT status_code, content, headers, created FROM responses WHERE key = ?',
+                                           (key,)).fetchone()
+            if row is None:
+                return None
+            status_code, content, headers, created = row
+            ttl = self._ttl_for_url(normalised_url)
+            if ttl is not None and time.time() - created > ttl and not self.offline:
+                self._connection.execute('DELETE FROM responses WHERE key = ?', (key,))
+                self._total_size -= len(content)
+                return None
+            self._connection.execute('UPDATE responses SET last_access = ? WHERE key = ?', (time.time(), key))
+        return CachedResponse(normalised_url, status_code, content, json.loads(headers))
+
+    def put(self, url: str, params: dict, response):
+        """
+        Store a response, evicting least recently used responses if the cache is too large. Responses larger than
+        max_size_bytes aren't stored.
+        """
+        normalised_url = normalise_url(url, params)
+        content = response.content
+        now = time.time()
+        key = self._key(normalised_url)
+        with self._lock, self._connection:
+            replaced = self._connection.execute('SELECT size FROM responses WHERE key = ?', (key,)).fetchone()
+            if replaced is not None:
+                self._total_size -= replaced[0]
+            if len(content) > self.max_size_bytes:
+                # Storing the response would evict every other response and then the response itself. Any earlier
+                # response is removed so that it isn't returned in place of this one
+                self._connection.execute('DELETE FROM responses WHERE key = ?', (key,))
+                return
+            self._connection.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                                     (key, normalised_url, response.status_code, content,
+                                      json.dumps(dict(response.headers)), now, now, len(content)))
+            self._total_size += len(content)
+            if self._total_size > self.max_size_bytes:
+                # Count the least recently used responses to remove, reading sizes only as far as needed. The new
+                # response fits in the cache so is never removed
+                n_to_remove = 0
+                for (size,) in self._connection.execute(
+                        'SELECT size FROM responses WHERE key != ? ORDER BY last_access', (key,)):
+                    if self._total_size <= self.max_size_bytes:
+                        break
+                    n_to_remove += 1
+                    self._total_size -= size
+                self._connection.execute(
+                    'DELETE FROM responses WHERE key IN '
+                    '(SELECT key FROM responses WHERE key != ? ORDER BY last_access LIMIT ?)', (key, n_to_remove))
+
+    def clear(self):
+        with self._lock, self._connection:
+            self._connection.execute('DELETE FROM responses')
+            self._total_size = 0
@@ -1,2 +1,5 @@
 from .search_pages import *
-from .get_page_views import *
\ No newline at end of file
+from .get_page_views import *
+from .mediawiki_api import *
+from .multi_pattern_search import *
+from .page_corpus import *
@@ -1,12 +1,34 @@
-from typing import List
+from typing import List, Tuple, Dict
 import pandas as pd
 from tqdm import tqdm
 
+from wikipedia_searches.mediawiki_api import get_langlink_titles
+
+languages_to_check = ['es', 'en', 'fr', 'it', 'pt', 'zh']
+# Base of the wikimedia REST api pageview urls, can be changed to point to a local server in tests
+pageview_api_url = 'https://wikimedia.org/api/rest_v1/metrics/pageviews/per-article/'
+
 
 def get_project_from_language(lan: str):
     return lan + '.wikipedia.org'
 
 
+def get_pageview_url_for_title(title: str, lan: str) -> str:
+    """
+    Gets the url to request to wikimedia api.
+    Currently set to get USER views for range 2017-04-01 -> 2022-04-01
+    :param title: title of page in given language
+    :param lan:
+    :return:
+    """
+    import urllib.parse
+
+    formatted_title = urllib.parse.quote(title)
+    project = get_project_from_language(lan)
+    req_url = pageview_api_url + project + '/all-access/user/' + formatted_title + '/monthly/20170401/20220401'
+    return req_url
+
+
 def get_request_url_for_taxon(taxon: str, lan: str) -> str:
     """
     Gets the url to request to wikimedia api.
@@ -18,37 +40,50 @@ def get_request_url_for_taxon(taxon: str, lan: str) -> str:
 
     import wikipediaapi
     import time
-    import urllib.parse
 
     if lan == 'zh':
         wiki_lan = wikipediaapi.Wikipedia('en')
         time.sleep(.01)
         page_py = wiki_lan.page(taxon)
         try:
-            formatted_title = urllib.parse.quote(page_py.langlinks['zh'].title)
+            title = page_py.langlinks['zh'].title
         except KeyError:
             return ''
     else:
         wiki_lan = wikipediaapi.Wikipedia(lan)
         time.sleep(.01)
         page_py = wiki_lan.page(taxon)
-        formatted_title = urllib.parse.quote(page_py.title)
-    project = get_project_from_language(lan)
-    req_url = 'https://wikimedia.org/api/rest_v1/metrics/pageviews/per-article/' + project + '/all-access/user/' + formatted_title + '/monthly/20170401/20220401'
-    return req_url
+        title = page_py.title
+    return get_pageview_url_for_title(title, lan)
 
 
-def get_page_views_for_taxon_in_lan(taxon: str, lan: str):
+def get_page_views_from_url(taxon_url: str, session=None):
+    """
+    Total views and number of months of data from a pageview api url.
+    :param taxon_url:
+    :param session: RateLimitedSession to make the request with. If not given a single request is made and
+    followed by a short wait to avoid rate limiting
+    :return: total views and number of months, which are 0 for pages without views. Raises requests.HTTPError for
+    other unsuccessful responses
+    """
     import time
     import requests
 
-    taxon_url = get_request_url_for_taxon(taxon, lan)
     if taxon_url == '':
         return 0, 0
-    headers = {'User-Agent': 'TraitBot/0.0 (a.richard-bollans@kew.org)'}
-    resp = requests.get(taxon_url, headers=headers)
-    # Avoid rate limiting (100 req/s)
-    time.sleep(.01)
+    if session is None:
+        headers = {'User-Agent': 'TraitBot/0.0 (a.richard-bollans@kew.org)'}
+        resp = requests.get(taxon_url, headers=headers)
+        # Avoid rate limiting (100 req/s)
+        time.sleep(.01)
+    else:
+        resp = session.get(taxon_url)
+    if resp.status_code == 404:
+        # The api gives a 404 for pages without any views, e.g. which don't exist
+        return 0.0, 0
+    if resp.status_code != 200:
+        # Otherwise errors, e.g. rate limiting after retries, would be counted as no views
+        raise requests.HTTPError(f'{resp.status_code} Error for url: {taxon_url}', response=resp)
     data = resp.json()
 
     total_views = 0
@@ -64,13 +99,15 @@ def get_page_views_for_taxon_in_lan(taxon: str, lan: str):
     return float(total_views), num_months
 
 
-def get_all_page_views_for_taxon(taxon: str):
-    languages_to_check = ['es', 'en', 'fr', 'it', 'pt', 'zh']
+def get_page_views_for_taxon_in_lan(taxon: str, lan: str):
+    return get_page_views_from_url(get_request_url_for_taxon(taxon, lan))
+
+
+def _average_monthly_views(views_and_months: List[Tuple[float, int]]) -> float:
     count = 0
 
     total_num_months = 0
-    for lan in languages_to_check:
-        lan_count, num_months = get_page_views_for_taxon_in_lan(taxon, lan)
+    for lan_count, num_months in views_and_months:
         count += lan_count
         total_num_months += num_months
     if total_num_months == 0:
@@ -81,19 +118,120 @@ def get_all_page_views_for_taxon(taxon: str):
     return avg_month_count
 
 
-def make_pageview_df(taxa_list: List[str], output_csv: str):
-    from wcvpy.wcvp_name_matching import get_accepted_info_from_names_in_column
+def get_all_page_views_for_taxon(taxon: str):
+    return _average_monthly_views([get_page_views_for_taxon_in_lan(taxon, lan) for lan in languages_to_check])
 
-    out_dict = {'name': [], 'Wikipedia_PageViews': []}
 
-    for i in tqdm(range(len(taxa_list)), desc="Getting pageviews", ascii=False, ncols=72):
-        sp = taxa_list[i]
-        out_dict['name'].append(sp)
-        x = get_all_page_views_for_taxon(sp)
-        out_dict['Wikipedia_PageViews'].append(x)
+def _get_zh_titles(taxa: List[str], session, api_url: str, n_attempts: int = 2) -> Dict[str, str]:
+    """
+    Titles of the zh pages linked from the en pages of the taxa. Batches of titles which fail are left out of the
+    output of get_langlink_titles, so the lookup of these titles is retried.
+    :return: dict of taxon to zh title, or None where there is no zh page. Taxa which couldn't be looked up are
+    left out.
+    """
+    zh_titles = {}
+    to_lookup = taxa
+    for _ in range(n_attempts):
+        zh_titles.update(get_langlink_titles(to_lookup, 'en', 'zh', session=session, api_url=api_url))
+        to_lookup = [t for t in to_lookup if t not in zh_titles]
+        if len(to_lookup) == 0:
+            break
+    if len(to_lookup) > 0:
+        print(f'Warning: failed to look up zh titles of {len(to_lookup)} taxa, their pageviews are set to nan')
+    return zh_titles
+
+
+def get_average_page_views_for_taxa(taxa_list: List[str], session=None, api_url: str = None,
+                                    max_workers: int = 16) -> Dict[str, float]:
+    """
+    Average monthly views of each taxon across languages_to_check, as in get_all_page_views_for_taxon.
+    Pageview requests are made concurrently through a shared rate limited session. The zh titles are found from
+    batched en langlink queries, which run alongside the pageview requests for other languages.
+    Where the zh title or a pageview request of a taxon fails after retries, the views of the taxon are set to nan
+    rather than undercounted, and the failures are reported.
+    :param taxa_list:
+    :param session: RateLimitedSession, by default limited to 50 requests per second (the pageview api allows 100)
+    :param api_url: template for the MediaWiki api url, see mediawiki_api.wikipedia_api_url
+    :param max_workers: number of concurrent requests
+    :return: dict of taxon to average monthly views, or nan where requests for the taxon failed
+    """
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+    from web_request_methods import RateLimitedSession
+
+    if session is None:
+        session = RateLimitedSession(requests_per_second=50)
+    unique_taxa = list(dict.fromkeys(taxa_list))
+    views = {taxon: {} for taxon in unique_taxa}
+    failed_taxa = set()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor, tqdm(
+            total=len(unique_taxa) * len(languages_to_check), desc="Getting pageviews", ascii=False,
+            ncols=72) as progress:
+        zh_titles_future = executor.submit(_get_zh_titles, unique_taxa, session, api_url)
+        futures = {}
+        for taxon in unique_taxa:
+            for lan in languages_to_check:
+                if lan != 'zh':
+                    url = get_pageview_url_for_title(taxon, lan)
+                    futures[executor.submit(get_page_views_from_url, url, session)] = (taxon, lan)
+
+        zh_titles = zh_titles_future.result()
+        for taxon in unique_taxa:
+            if taxon not in zh_titles:
+                failed_taxa.add(taxon)
+                progress.update(1)
+            elif zh_titles[taxon] is None:
+                views[taxon]['zh'] = (0, 0)
+                progress.update(1)
+            else:
+                url = get_pageview_url_for_title(zh_titles[taxon], 'zh')
+                futures[executor.submit(get_page_views_from_url, url, session)] = (taxon, 'zh')
+
+        failed_requests = []
+        for future in as_completed(futures):
+            taxon, lan = futures[future]
+            try:
+                views[taxon][lan] = future.result()
+            except Exception as e:
+                failed_requests.append((taxon, lan, e))
+                failed_taxa.add(taxon)
+            progress.update(1)
+    if len(failed_requests) > 0:
+        taxon, lan, e = failed_requests[0]
+        print(f'Warning: {len(failed_requests)} pageview requests failed, their taxa are set to nan. '
+              f'First failure for {lan} {taxon}: {e}')
+
+    return {taxon: float('nan') if taxon in failed_taxa else _average_monthly_views(
+        [views[taxon][lan] for lan in languages_to_check]) for taxon in unique_taxa}
+
+
+def make_pageview_df(taxa_list: List[str], output_csv: str, api_url: str = None, max_workers: int = 16,
+                     requests_per_second: float = 50, session=None, wcvp_version: str = None,
+                     wcvp_cache_dir: str = None):
+    """
+    :param taxa_list:
+    :param output_csv:
+    :param api_url: template for the MediaWiki api url, see mediawiki_api.wikipedia_api_url
+    :param max_workers: number of concurrent requests
+    :param requests_per_second:
+    :param session: RateLimitedSession to make requests with, e.g. to use a ResponseCache. If not given a new
+    session is created limited to requests_per_second
+    :param wcvp_version:
+    :param wcvp_cache_dir: directory to save the WCVP taxa table to, see get_wcvp_taxa
+    :return:
+    """
+    from wcvpy.wcvp_name_matching import get_accepted_info_from_names_in_column
+    from data_compilation_methods import get_wcvp_taxa
+    from web_request_methods import RateLimitedSession
+
+    if session is None:
+        session = RateLimitedSession(requests_per_second=requests_per_second, pool_size=max_workers)
+    page_views = get_average_page_views_for_taxa(taxa_list, session=session, api_url=api_url,
+                                                 max_workers=max_workers)
+    out_dict = {'name': list(taxa_list), 'Wikipedia_PageViews': [page_views[sp] for sp in taxa_list]}
 
     df = pd.DataFrame(out_dict)
-    acc_df = get_accepted_info_from_names_in_column(df, 'name')
+    acc_df = get_accepted_info_from_names_in_column(df, 'name', wcvp_version=wcvp_version,
+                                                    all_taxa=get_wcvp_taxa(wcvp_version, wcvp_cache_dir))
 
     acc_df.to_csv(output_csv)
 
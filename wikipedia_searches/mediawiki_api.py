@@ -0,0 +1,228 @@
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Tuple
+
+from tqdm import tqdm
+
+# Template for the MediaWiki action API of each language, can be changed to point to a local server in tests
+wikipedia_api_url = 'https://{lang}.wikipedia.org/w/api.php'
+
+# Maximum number of titles the API accepts in a single query (without bot rights)
+max_titles_per_query = 50
+
+
+def get_api_url(lang: str, api_url: str = None) -> str:
+    if api_url is None:
+        api_url = wikipedia_api_url
+    return api_url.format(lang=lang)
+
+
+def _batches(values: List, batch_size: int = max_titles_per_query) -> List[List]:
+    return [values[i:i + batch_size] for i in range(0, len(values), batch_size)]
+
+
+def query_pages(session, lang: str, titles: List[str], api_url: str = None, langlinks_to: str = None,
+                follow_redirects: bool = False, revision_ids: bool = False) -> Dict[str, dict]:
+    """
+    Look up up to max_titles_per_query titles with a single query (plus any continuation queries for langlinks).
+    :param session: RateLimitedSession
+    :param lang:
+    :param titles:
+    :param api_url: template for the api url, see wikipedia_api_url
+    :param langlinks_to: if given, also find the title of the linked page in this language
+    :param follow_redirects: whether to resolve redirects to their target pages. Otherwise, as in wikipediaapi,
+    redirect pages count as existing pages in their own right.
+    :param revision_ids: whether to also find the id of the latest revision of each page
+    :return: dict of each given title to a dict with keys 'exists', 'title' (the normalised title, or redirect target
+    if following redirects), 'redirected_from' (the normalised title if it was redirected, else None), 'langlink'
+    (the linked title in langlinks_to, or None) and 'revid' (the latest revision id if revision_ids, or None)
+    """
+    # Titles containing | can't be queried as this is the separator for titles
+    queryable = [t for t in titles if '|' not in t]
+    out = {t: {'exists': False, 'title': t, 'redirected_from': None, 'langlink': None, 'revid': None} for t in
+           titles}
+    if len(queryable) == 0:
+        return out
+
+    params = {'action': 'query', 'format': 'json', 'formatversion': 2, 'titles': '|'.join(queryable)}
+    props = []
+    if langlinks_to is not None:
+        props.append('langlinks')
+        params.update({'lllang': langlinks_to, 'lllimit': 'max'})
+    if revision_ids:
+        props.append('revisions')
+        params['rvprop'] = 'ids'
+    if len(props) > 0:
+        params['prop'] = '|'.join(props)
+    if follow_redirects:
+        params['redirects'] = 1
+
+    normalised = {}
+    redirects = {}
+    pages = {}
+    langlinks = {}
+    revids = {}
+    while True:
+        response = session.get(get_api_url(lang, api_url), params=params)
+        response.raise_for_status()
+        response_json = response.json()
+        query = response_json['query']
+        # The api returns normalised titles e.g. with the first letter capitalised
+        normalised.update({n['from']: n['to'] for n in query.get('normalized', [])})
+        redirects.update({r['from']: r['to'] for r in query.get('redirects', [])})
+        for p in query.get('pages', []):
+            pages[p['title']] = p
+            for link in p.get('langlinks', []):
+                langlinks[p['title']] = link['title']
+            for revision in p.get('revisions', []):
+                revids[p['title']] = revision['revid']
+        # Langlinks may be split across multiple responses
+        if 'continue' not in response_json:
+            break
+        params.update(response_json['continue'])
+
+    for t in queryable:
+        normalised_title = normalised.get(t, t)
+        page_title = redirects.get(normalised_title, normalised_title)
+        page = pages.get(page_title, {'missing': True})
+        out[t] = {'exists': not page.get('missing', False) and not page.get('invalid', False),
+                  'title': page_title,
+                  'redirected_from': normalised_title if page_title != normalised_title else None,
+                  'langlink': langlinks.get(page_title),
+                  'revid': revids.get(page_title)}
+    return out
+
+
+def lookup_pages(titles: List[str], languages: List[str], session=None, api_url: str = None,
+                 max_workers: int = 8, langlinks_to: str = None, follow_redirects: bool = False,
+                 revision_ids: bool = False) -> Dict[str, Dict[str, dict]]:
+    """
+    Look up titles in each language, see query_pages. Titles are batched into queries of max_titles_per_query titles
+    and queries are run concurrently in a thread pool, with requests to each host rate limited by the session.
+    Titles in batches which fail after retries are left out of the output.
+    :param titles:
+    :param languages:
+    :param session: RateLimitedSession, a new one is created if not given
+    :param api_url: template for the api url, see wikipedia_api_url
+    :param max_workers: number of concurrent requests
+    :param langlinks_to:
+    :param follow_redirects:
+    :param revision_ids:
+    :return: dict of language to dict of title to page info
+    """
+    from web_request_methods import RateLimitedSession
+
+    if session is None:
+        session = RateLimitedSession()
+    unique_titles = list(dict.fromkeys(titles))
+    jobs = [(lang, batch) for lang in languages for batch in _batches(unique_titles)]
+
+    def _run(job):
+        lang, batch = job
+        try:
+            return lang, query_pages(session, lang, batch, api_url, langlinks_to=langlinks_to,
+                                     follow_redirects=follow_redirects, revision_ids=revision_ids)
+        except Exception as e:
+            print(f'Warning: failed to look up {len(batch)} {lang} titles: {e}')
+            return lang, {}
+
+    out = {lang: {} for lang in languages}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for lang, result in tqdm(executor.map(_run, jobs), total=len(jobs), desc="Looking up Wiki Pages…",
+                                 ascii=False, ncols=72):
+            out[lang].update(result)
+    return out
+
+
+def check_pages_exist(titles: List[str], languages: List[str], session=None, api_url: str = None,
+                      max_workers: int = 8) -> Dict[str, Dict[str, bool]]:
+    """
+    Check which titles have pages in each language, see lookup_pages. As in wikipediaapi, redirect pages count as
+    existing.
+    Titles in batches which fail after retries are left out of the output.
+    :return: dict of language to dict of title to whether the page exists
+    """
+    pages = lookup_pages(titles, languages, session=session, api_url=api_url, max_workers=max_workers)
+    return {lang: {t: info['exists'] for t, info in pages[lang].items()} for lang in languages}
+
+
+def get_langlink_titles(titles: List[str], from_lang: str, to_lang: str, session=None, api_url: str = None,
+                        max_workers: int = 8) -> Dict[str, str]:
+    """
+    Titles of the pages in to_lang linked from the from_lang pages of the given titles.
+    :return: dict of title to linked title, or None where there is no linked page
+    """
+    pages = lookup_pages(titles, [from_lang], session=session, api_url=api_url, max_workers=max_workers,
+                         langlinks_to=to_lang)
+    return {t: info['langlink'] for t, info in pages[from_lang].items()}
+
+
+def get_revision_ids(titles: List[str], lang: str, session=None, api_url: str = None,
+                     max_workers: int = 8) -> Dict[str, int]:
+    """
+    Ids of the latest revisions of the given pages.
+    :return: dict of title to revision id, or None where the page doesn't exist
+    """
+    pages = lookup_pages(titles, [lang], session=session, api_url=api_url, max_workers=max_workers,
+                         revision_ids=True)
+    return {t: info['revid'] for t, info in pages[lang].items()}
+
+
+def get_parsed_page(lang: str, pagename: str, session=None, api_url: str = None) -> Tuple[str, int]:
+    """
+    Get the html of a page parsed by the MediaWiki api, along with the id of the parsed revision.
+    :param lang:
+    :param pagename:
+    :param session: RateLimitedSession to make the request with. If not given a single request is made with requests
+    :param api_url: template for the api url, see wikipedia_api_url
+    :return: html of the page, or an empty string if the api gives an error for the page, and the revision id, or
+    None
+    """
+    import requests
+
+    params = {
+        'action': 'parse',
+        'format': 'json',
+        'page': pagename
+    }
+    if session is None:
+        response = requests.get(get_api_url(lang, api_url), params=params)
+    else:
+        response = session.get(get_api_url(lang, api_url), params=params)
+    response.raise_for_status()
+    response_json = response.json()
+    # The api reports pages which can't be parsed, e.g. missing pages, in an error rather than an http error status
+    if 'error' in response_json:
+        error = response_json['error']
+        print(f'Warning: failed to parse {lang} page {pagename}: {error.get("code")}: {error.get("info")}')
+        return "", None
+
+    return next(iter(response_json['parse']['text'].values())), response_json['parse'].get('revid')
+
+
+def get_all_langlinks(title: str, lang: str, session=None, api_url: str = None) -> Dict[str, str]:
+    """
+    Titles of the pages in all languages linked from a page.
+    :param title:
+    :param lang: language of the page
+    :param session: RateLimitedSession, a new one is created if not given
+    :param api_url: template for the api url, see wikipedia_api_url
+    :return: dict of language to linked title, in the order given by the api
+    """
+    from web_request_methods import RateLimitedSession
+
+    if session is None:
+        session = RateLimitedSession()
+    params = {'action': 'query', 'format': 'json', 'formatversion': 2, 'titles': title, 'prop': 'langlinks',
+              'lllimit': 'max'}
+    langlinks = {}
+    while True:
+        response = session.get(get_api_url(lang, api_url), params=params)
+        response.raise_for_status()
+        response_json = response.json()
+        for p in response_json['query'].get('pages', []):
+            for link in p.get('langlinks', []):
+                langlinks[link['lang']] = link['title']
+        if 'continue' not in response_json:
+            break
+        params.update(response_json['continue'])
+    return langlinks
@@ -0,0 +1,122 @@
+from collections import deque
+from typing import Dict, Iterable, List
+
+
+def _pyahocorasick_installed() -> bool:
+    try:
+        import ahocorasick
+        return True
+    except ImportError:
+        return False
+
+
+class MultiPatternMatcher:
+    """
+    Finds occurrences of many patterns (e.g. taxon names) in a text with a single pass over the text, using an
+    Aho–Corasick automaton built once over all the patterns. Matches are the same as checking each pattern with `in`
+    and str.index, including overlapping matches.
+    The automaton from pyahocorasick is used when it is installed, otherwise a pure python automaton is built.
+    """
+
+    def __init__(self, patterns: Iterable[str], use_pyahocorasick: bool = None):
+        """
+        :param patterns:
+        :param use_pyahocorasick: whether to use pyahocorasick. By default it is used if installed
+        """
+        unique_patterns = list(dict.fromkeys(patterns))
+        # The empty string is in every text, at index 0, but can't be added to an automaton
+        self._has_empty_pattern = '' in unique_patterns
+        self.patterns = [p for p in unique_patterns if p != '']
+
+        if use_pyahocorasick is None:
+            use_pyahocorasick = _pyahocorasick_installed()
+        self._automaton = None
+        if use_pyahocorasick:
+            self._build_pyahocorasick_automaton()
+        else:
+            self._build_automaton()
+
+    def _build_pyahocorasick_automaton(self):
+        import ahocorasick
+
+        self._automaton = ahocorasick.Automaton()
+        for p in self.patterns:
+            self._automaton.add_word(p, p)
+        self._automaton.make_automaton()
+
+    def _build_automaton(self):
+        # Trie of the patterns, with a dict of transitions for each node
+        self._goto = [{}]
+        # The pattern ending at each node, or None
+        self._pattern_at_node = [None]
+        for p in self.patterns:
+            node = 0
+            for char in p:
+                next_node = self._goto[node].get(char)
+                if next_node is None:
+                    next_node = len(self._goto)
+                    self._goto[node][char] = next_node
+                    self._goto.append({})
+                    self._pattern_at_node.append(None)
+                node = next_node
+            self._pattern_at_node[node] = p
+
+        # Failure links point to the node of the longest proper suffix which is in the trie, and output links to the
+        # nearest node along the failure links at which a pattern ends
+        self._fail = [0] * len(self._goto)
+        self._output_link = [-1] * len(self._goto)
+        queue = deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, child in self._goto[node].items():
+                if node != 0:
+                    fail = self._fail[node]
+                    while fail != 0 and char not in self._goto[fail]:
+                        fail = self._fail[fail]
+                    self._fail[child] = self._goto[fail].get(char, 0)
+                suffix = self._fail[child]
+                self._output_link[child] = suffix if self._pattern_at_node[suffix] is not None else \
+                    self._output_link[suffix]
+                queue.append(child)
+
+    def _iter_matches(self, text: str):
+        """
+        Yield (end index, pattern) for every occurrence of every pattern in the text, in order of end index.
+        """
+        if self._automaton is not None:
+            if len(self.patterns) > 0:
+                yield from self._automaton.iter(text)
+            return
+
+        goto = self._goto
+        fail = self._fail
+        pattern_at_node = self._pattern_at_node
+        output_link = self._output_link
+        node = 0
+        for i, char in enumerate(text):
+            while node != 0 and char not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(char, 0)
+            match_node = node if pattern_at_node[node] is not None else output_link[node]
+            while match_node > 0:
+                yield i, pattern_at_node[match_node]
+                match_node = output_link[match_node]
+
+    def find(self, text: str, all_occurrences: bool = False) -> Dict[str, List[int]]:
+        """
+        Start offsets of the patterns found in the text.
+        :param text:
+        :param all_occurrences: whether to give the offsets of every occurrence of each pattern, otherwise only the
+        first occurrence (as given by str.index) is given
+        :return: dict of each pattern found in the text to a list of offsets
+        """
+        found = {}
+        if self._has_empty_pattern:
+            found[''] = [0]
+        for end, pattern in self._iter_matches(text):
+            start = end - len(pattern) + 1
+            if pattern not in found:
+                found[pattern] = [start]
+            elif all_occurrences:
+                found[pattern].append(start)
+        return found
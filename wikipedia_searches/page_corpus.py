@@ -0,0 +1,116 @@
+import hashlib
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Tuple
+
+from tqdm import tqdm
+
+from wikipedia_searches.mediawiki_api import get_parsed_page, get_revision_ids
+
+_corpus_index_file = 'corpus_index.json'
+
+
+def _read_corpus_index(corpus_dir: str) -> dict:
+    index_file = os.path.join(corpus_dir, _corpus_index_file)
+    if not os.path.isfile(index_file):
+        return {'corpus_file': None, 'pages': {}}
+    with open(index_file, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def load_page_corpus(corpus_dir: str) -> Dict[str, Tuple[str, int]]:
+    """
+    Load page texts saved by get_page_texts. The corpus file is read at once and each page is decoded from its slice.
+    :param corpus_dir:
+    :return: dict of source to page text and revision id
+    """
+    index = _read_corpus_index(corpus_dir)
+    if index['corpus_file'] is None or not os.path.isfile(os.path.join(corpus_dir, index['corpus_file'])):
+        return {}
+    with open(os.path.join(corpus_dir, index['corpus_file']), 'rb') as f:
+        corpus = f.read()
+    return {source: (corpus[info['offset']:info['offset'] + info['length']].decode('utf-8'), info['revid'])
+            for source, info in index['pages'].items()}
+
+
+def _save_page_corpus(corpus_dir: str, pages: Dict[str, Tuple[str, str]], texts: Dict[str, Tuple[str, int]]):
+    """
+    Save page texts as a new version of the corpus, named from the revision ids of the pages, and remove the previous
+    version.
+    """
+    if not os.path.isdir(corpus_dir):
+        os.mkdir(corpus_dir)
+    previous_corpus_file = _read_corpus_index(corpus_dir)['corpus_file']
+
+    version = hashlib.md5(str(sorted((source, texts[source][1]) for source in texts)).encode()).hexdigest()
+    corpus_file = 'corpus_' + version + '.txt'
+    index = {'corpus_file': corpus_file, 'pages': {}}
+    offset = 0
+    # Write the corpus to a temporary file first, as the current version has the same name if no revisions changed
+    corpus_path = os.path.join(corpus_dir, corpus_file)
+    with open(corpus_path + '.tmp', 'wb') as f:
+        for source, (text, revid) in texts.items():
+            encoded = text.encode('utf-8')
+            f.write(encoded)
+            lang, page = pages[source]
+            index['pages'][source] = {'lang': lang, 'page': page, 'revid': revid, 'offset': offset,
+                                      'length': len(encoded)}
+            offset += len(encoded)
+    os.replace(corpus_path + '.tmp', corpus_path)
+
+    # Write the index to a temporary file and replace the old one, so an interrupted save leaves the old version
+    index_file = os.path.join(corpus_dir, _corpus_index_file)
+    with open(index_file + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(index, f, ensure_ascii=False)
+    os.replace(index_file + '.tmp', index_file)
+    if previous_corpus_file is not None and previous_corpus_file != corpus_file:
+        previous_corpus_path = os.path.join(corpus_dir, previous_corpus_file)
+        if os.path.isfile(previous_corpus_path):
+            os.remove(previous_corpus_path)
+
+
+def get_page_texts(pages: Dict[str, Tuple[str, str]], corpus_dir: str = None, session=None, api_url: str = None,
+                   max_workers: int = 8, check_for_updates: bool = False) -> Dict[str, str]:
+    """
+    Get the parsed html of the given pages. Pages are fetched concurrently, and if corpus_dir is given they are saved
+    there with their revision ids and later calls load them from disk rather than fetching them again.
+    :param pages: dict of source name to (language, page title)
+    :param corpus_dir: directory to save page texts to
+    :param session: RateLimitedSession, a new one is created if not given
+    :param api_url: template for the api url, see mediawiki_api.wikipedia_api_url
+    :param max_workers: maximum number of pages to fetch at once
+    :param check_for_updates: whether to check the latest revision ids of saved pages and fetch any which have
+    changed. Otherwise saved pages are used without any requests.
+    :return: dict of source name to page text, in the order of pages
+    """
+    from web_request_methods import RateLimitedSession
+
+    saved = {} if corpus_dir is None else load_page_corpus(corpus_dir)
+    # Pages which couldn't be parsed have no revision id and are always fetched again
+    saved = {source: saved[source] for source in pages if source in saved and saved[source][1] is not None}
+
+    if session is None:
+        session = RateLimitedSession()
+    if check_for_updates and len(saved) > 0:
+        for lang in set(pages[source][0] for source in saved):
+            titles = [pages[source][1] for source in saved if pages[source][0] == lang]
+            latest_revids = get_revision_ids(titles, lang, session=session, api_url=api_url)
+            for source in list(saved):
+                if pages[source][0] == lang and latest_revids.get(pages[source][1]) != saved[source][1]:
+                    del saved[source]
+
+    to_fetch = [source for source in pages if source not in saved]
+    if len(to_fetch) > 0:
+        def _fetch(source):
+            lang, page = pages[source]
+            return source, get_parsed_page(lang, page, session=session, api_url=api_url)
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for source, text_and_revid in tqdm(executor.map(_fetch, to_fetch), total=len(to_fetch),
+                                               desc="Fetching pages…", ascii=False, ncols=72):
+                saved[source] = text_and_revid
+        if corpus_dir is not None:
+            _save_page_corpus(corpus_dir, pages, {source: saved[source] for source in pages})
+
+    return {source: saved[source][0] for source in pages}
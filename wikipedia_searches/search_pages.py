@@ -1,27 +1,26 @@
 import os
 import string
-from typing import List
+from typing import List, Dict
 
+import numpy as np
 import pandas as pd
 
 from tqdm import tqdm
 
+from wikipedia_searches.mediawiki_api import check_pages_exist, get_all_langlinks, get_parsed_page
+from wikipedia_searches.multi_pattern_search import MultiPatternMatcher
+from wikipedia_searches.page_corpus import get_page_texts
 
-def get_all_page_text(lang, pagename):
-    import requests
-    response = requests.get('https://' + lang + '.wikipedia.org/w/api.php',
-                            params={
-                                'action': 'parse',
-                                'format': 'json',
-                                'page': pagename
-                            }).json()
-    try:
-        # TODO: better catch this error, i.e. if response contains error
-        text = next(iter(response['parse']['text'].values()))
-    except KeyError:
-        text = ""
 
-    return text
+def get_all_page_text(lang, pagename, session=None, api_url: str = None):
+    """
+    :param lang:
+    :param pagename:
+    :param session: RateLimitedSession to make the request with, e.g. to use a ResponseCache
+    :param api_url: template for the api url, see mediawiki_api.wikipedia_api_url
+    :return: html of the parsed page, or an empty string if it couldn't be parsed
+    """
+    return get_parsed_page(lang, pagename, session=session, api_url=api_url)[0]
 
 
 def get_page_url_from_title(lang: str, title: str):
@@ -30,48 +29,91 @@ def get_page_url_from_title(lang: str, title: str):
     return 'https://' + lang + '.wikipedia.org/wiki/' + t
 
 
-def search_for_poisons(output_csv: str) -> pd.DataFrame:
-    import requests
-    import wikipediaapi
-
-    # First get english data
-    en_tables = pd.read_html('https://en.wikipedia.org/wiki/List_of_poisonous_plants')
+# Info on which tables from each language's list of poisonous plants to use and the column name of the scientific name
+# Not this misses some pages which aren't easily parsed
+poison_table_info = {'en': [[0, 'Scientific name'], [1, 'Scientific name']],
+                     'an': [[0, 'বৈজ্ঞানিক নাম']], 'bn': [[0, 'বৈজ্ঞানিক নাম']], 'cs': [[0, 'Český název']],
+                     'de': [[0, 'Wissenschaftlicher Name']], 'fr': [[0, 'Nom scientifique']],
+                     'hr': [[0, 'Znanstveni naziv']], 'hu': [[2, 'Latin név']]}
+
+
+def _read_table_columns(html: str, tables_and_columns: List[List]) -> List[List]:
+    """
+    Parse the html tables of a page and get the values of the given columns.
+    :param html:
+    :param tables_and_columns: list of [table index, column name] pairs
+    :return: list of the values in each column
+    """
+    from io import StringIO
+
+    tables = pd.read_html(StringIO(html), encoding='utf-8')
+    return [tables[table][column].values.tolist() for table, column in tables_and_columns]
+
+
+def search_for_poisons(output_csv: str, session=None, max_workers: int = 8, n_jobs: int = 4,
+                       api_url: str = None) -> pd.DataFrame:
+    """
+    Find scientific names in the tables of wikipedia lists of poisonous plants, see poison_table_info.
+    Pages are fetched concurrently and their html tables are parsed in a process pool as each page arrives.
+    :param output_csv:
+    :param session: RateLimitedSession to make requests with, e.g. to use a ResponseCache
+    :param max_workers: maximum number of pages to fetch at once
+    :param n_jobs: number of processes to parse pages with. If 1, pages are parsed in this process
+    :param api_url: template for the api url, see mediawiki_api.wikipedia_api_url
+    :return:
+    """
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+    from web_request_methods import RateLimitedSession
+
+    if session is None:
+        session = RateLimitedSession()
+
+    # Check linked languages, in the order given by the api
+    langlinks = get_all_langlinks('List_of_poisonous_plants', 'en', session=session, api_url=api_url)
+    page_titles = {'en': 'List_of_poisonous_plants'}
+    page_titles.update({l: langlinks[l] for l in langlinks if l in poison_table_info and l != 'en'})
+
+    def _fetch(l):
+        return l, session.get(get_page_url_from_title(l, page_titles[l])).text
+
+    page_columns = {}
+    if n_jobs > 1:
+        # Parsing processes are spawned rather than forked, as forking while the fetching threads hold locks (e.g. in
+        # the session) can deadlock the child processes
+        with ProcessPoolExecutor(max_workers=n_jobs, mp_context=multiprocessing.get_context('spawn')) as parser, \
+                ThreadPoolExecutor(max_workers=max_workers) as fetcher:
+            fetches = [fetcher.submit(_fetch, l) for l in page_titles]
+            parses = {}
+            for fetch in as_completed(fetches):
+                l, html = fetch.result()
+                parses[l] = parser.submit(_read_table_columns, html, poison_table_info[l])
+            for l in tqdm(page_titles, desc="Parsing pages…", ascii=False, ncols=72):
+                page_columns[l] = parses[l].result()
+    else:
+        with ThreadPoolExecutor(max_workers=max_workers) as fetcher:
+            fetches = [fetcher.submit(_fetch, l) for l in page_titles]
+            for fetch in tqdm(as_completed(fetches), total=len(fetches), desc="Parsing pages…", ascii=False,
+                              ncols=72):
+                l, html = fetch.result()
+                page_columns[l] = _read_table_columns(html, poison_table_info[l])
+
+    # Index of each name in scientific_names so names from each page are merged in linear time
     scientific_names = {'name': [], 'Source': []}
-
-    def append_to_scientific_names(values: List[str], source: str):
-        for x in values:
-            if x not in scientific_names['name']:
-                scientific_names['name'].append(x)
-                scientific_names['Source'].append(source)
-            else:
-                i = scientific_names['name'].index(x)
-                scientific_names['Source'][i] += ':' + source
-
-    append_to_scientific_names(en_tables[0]['Scientific name'].values.tolist(), 'en_wiki')
-    append_to_scientific_names(en_tables[1]['Scientific name'].values.tolist(), 'en_wiki')
-
-    en_wiki = wikipediaapi.Wikipedia('en')
-    p = en_wiki.page('List_of_poisonous_plants')
-
-    # Then check linked languages
-    langs_to_check = p.langlinks
-
-    # Info on which tables from the page to use and the column name of the scientific name
-    # Not this misses some pages which aren't easily parsed
-    table_info = {'an': [[0, 'বৈজ্ঞানিক নাম']], 'bn': [[0, 'বৈজ্ঞানিক নাম']], 'cs': [[0, 'Český název']],
-                  'de': [[0, 'Wissenschaftlicher Name']], 'fr': [[0, 'Nom scientifique']],
-                  'hr': [[0, 'Znanstveni naziv']], 'hu': [[2, 'Latin név']]}
-
-    for l in langs_to_check:
-        if l in table_info:
-
-            url = get_page_url_from_title(l, langs_to_check[l].title)
-
-            r = requests.get(url)
-            website = r.text
-            tables = pd.read_html(website, encoding='utf-8')
-            for pair in table_info[l]:
-                append_to_scientific_names(tables[pair[0]][pair[1]].values.tolist(), l + '_wiki')
+    name_index = {}
+    for l in page_titles:
+        source = l + '_wiki'
+        for values in page_columns[l]:
+            for x in values:
+                # Use a single nan object so that missing names from all pages are merged
+                if isinstance(x, float) and np.isnan(x):
+                    x = np.nan
+                if x not in name_index:
+                    name_index[x] = len(scientific_names['name'])
+                    scientific_names['name'].append(x)
+                    scientific_names['Source'].append(source)
+                else:
+                    scientific_names['Source'][name_index[x]] += ':' + source
 
     wiki_poisons_df = pd.DataFrame(scientific_names)
     dup_names = wiki_poisons_df[wiki_poisons_df.duplicated(subset=['name'])]
@@ -82,7 +124,23 @@ def search_for_poisons(output_csv: str) -> pd.DataFrame:
     return wiki_poisons_df
 
 
-def search_for_common_names(taxa_list: List[str], output_csv: str) -> pd.DataFrame:
+def search_for_common_names(taxa_list: List[str], output_csv: str, session=None, all_occurrences: bool = False,
+                            corpus_dir: str = None, check_for_updates: bool = False, max_workers: int = 8,
+                            api_url: str = None) -> pd.DataFrame:
+    """
+    Find taxa which appear in wikipedia lists of common plant names. Pages are searched for all taxa at once with a
+    MultiPatternMatcher.
+    :param taxa_list:
+    :param output_csv:
+    :param session: RateLimitedSession to make requests with, e.g. to use a ResponseCache
+    :param all_occurrences: whether to give snippets and offsets of every occurrence of each taxon in each page,
+    rather than only the first
+    :param corpus_dir: directory to save the list pages to, so that later searches don't need to fetch them
+    :param check_for_updates: whether to fetch saved pages again if they have been edited since they were saved
+    :param max_workers: maximum number of pages to fetch at once
+    :param api_url: template for the api url, see mediawiki_api.wikipedia_api_url
+    :return: dataframe with the snippets and offsets of the hits in each source page
+    """
     if output_csv is not None:
         if not os.path.isdir(os.path.dirname(output_csv)):
             os.mkdir(os.path.dirname(output_csv))
@@ -103,32 +161,37 @@ def search_for_common_names(taxa_list: List[str], output_csv: str) -> pd.DataFra
                  'chr': ['ᏗᎦᎪᏗ_ᏚᎾᏙᎥ_ᏙᎪᏪᎸ']
                  }
 
-    page_texts = {}
-    for lan in pagenames:
-        for page in pagenames[lan]:
-            source = lan + ": " + page
+    pages = {lan + ": " + page: (lan, page) for lan in pagenames for page in pagenames[lan]}
+    page_texts = get_page_texts(pages, corpus_dir=corpus_dir, session=session, api_url=api_url,
+                                max_workers=max_workers, check_for_updates=check_for_updates)
 
-            page_texts[source] = get_all_page_text(lan, page)
+    # Find all taxa in each page with a single pass over the page text
+    matcher = MultiPatternMatcher([sp for sp in taxa_list if isinstance(sp, str)])
+    offsets_in_pages = {source: matcher.find(page_texts[source], all_occurrences=all_occurrences) for source in
+                        tqdm(page_texts, desc="Searching pages…", ascii=False, ncols=72)}
 
-    out_dict = {'Name': [], 'Wiki_Snippet': [], 'Source': []}
+    out_dict = {'Name': [], 'Wiki_Snippet': [], 'Wiki_Offsets': [], 'Source': []}
     for sp in taxa_list:
-
-        try:
-            hits = []
-            snippets = []
-            for source in page_texts:
-                if sp in page_texts[source]:
-                    hits.append(source)
-                    i = page_texts[source].index(sp)
-                    snippet = page_texts[source][i - 1:i + len(sp) + 1]
-                    snippets.append(snippet)
-            if len(hits) > 0:
-                out_dict['Source'].append("Wiki (" + str(hits) + ")")
-                out_dict['Wiki_Snippet'].append(str(snippets))
-                out_dict['Name'].append(sp)
-
-        except TypeError:
-            pass
+        if not isinstance(sp, str):
+            continue
+        hits = []
+        snippets = []
+        offsets = []
+        for source in page_texts:
+            if sp in offsets_in_pages[source]:
+                hits.append(source)
+                page_snippets = [page_texts[source][i - 1:i + len(sp) + 1] for i in offsets_in_pages[source][sp]]
+                if all_occurrences:
+                    snippets.append(page_snippets)
+                    offsets.append(offsets_in_pages[source][sp])
+                else:
+                    snippets.append(page_snippets[0])
+                    offsets.append(offsets_in_pages[source][sp][0])
+        if len(hits) > 0:
+            out_dict['Source'].append("Wiki (" + str(hits) + ")")
+            out_dict['Wiki_Snippet'].append(str(snippets))
+            out_dict['Wiki_Offsets'].append(str(offsets))
+            out_dict['Name'].append(sp)
 
     df = pd.DataFrame(out_dict)
     df.to_csv(output_csv)
@@ -143,62 +206,111 @@ def check_page_exists(taxon: str, wiki_lan) -> bool:
         return False
 
 
-def make_wiki_hit_df(taxa_list: List[str], output_csv: str = None, force_new_search=False) -> pd.DataFrame:
+def _read_wiki_page_store(store_csv: str) -> Dict[str, Dict[str, bool]]:
+    """
+    Read results appended by _append_to_wiki_page_store. Where a taxon has been checked more than once in a language
+    the latest result is used.
+    :return: dict of language to dict of taxon to whether the page exists
+    """
+    store = {}
+    if store_csv is None or not os.path.isfile(store_csv):
+        return store
+    store_df = pd.read_csv(store_csv, dtype={'language': str, 'taxon': str}, keep_default_na=False, na_values=[''],
+                           on_bad_lines='skip')
+    # Rows which were only partly written when a run was interrupted are missing the result
+    store_df = store_df.dropna(subset=['language', 'taxon', 'page_exists'])
+    for lan, taxon, page_exists in zip(store_df['language'].values, store_df['taxon'].values,
+                                       store_df['page_exists'].values):
+        store.setdefault(lan, {})[taxon] = bool(page_exists)
+    return store
+
+
+def _append_to_wiki_page_store(store_csv: str, lan: str, pages_exist: Dict[str, bool]):
+    if len(pages_exist) == 0:
+        return
+    store_df = pd.DataFrame({'language': lan, 'taxon': list(pages_exist.keys()),
+                             'page_exists': [int(e) for e in pages_exist.values()]})
+    store_df.to_csv(store_csv, mode='a', header=not os.path.isfile(store_csv), index=False)
+
+
+def make_wiki_hit_df(taxa_list: List[str], output_csv: str = None, force_new_search=False, max_workers: int = 8,
+                     requests_per_second: float = 10.0, api_url: str = None, session=None, store_csv: str = None,
+                     taxa_per_checkpoint: int = 5000, max_attempts: int = 3, wcvp_version: str = None,
+                     wcvp_cache_dir: str = None) -> pd.DataFrame:
+    """
+    Find which taxa have wikipedia pages in each of the checked languages.
+    Titles are checked in batches through the MediaWiki api, with batches run concurrently and requests to each
+    language rate limited.
+    Results for each taxon and language are appended to store_csv as the search runs, and only taxa missing from the
+    store are searched. So a search can be resumed after it is interrupted, and adding taxa to the list only
+    searches the new taxa. Taxa which fail to be checked are retried up to max_attempts times, and are retried on
+    the next run if they still fail.
+    :param taxa_list:
+    :param output_csv:
+    :param force_new_search: search all taxa again, replacing their results in the store
+    :param max_workers: number of concurrent requests
+    :param requests_per_second: maximum rate of requests to each language's wikipedia
+    :param api_url: template for the api url, see mediawiki_api.wikipedia_api_url
+    :param session: RateLimitedSession to make requests with, e.g. to use a ResponseCache. If not given a new
+    session is created limited to requests_per_second
+    :param store_csv: file to store results in, by default wiki_page_search_store.csv in the output directory
+    :param taxa_per_checkpoint: number of taxa to search in each language before appending results to the store
+    :param max_attempts: number of times to try checking each taxon in each run
+    :param wcvp_version:
+    :param wcvp_cache_dir: directory to save the WCVP taxa table to, see get_wcvp_taxa
+    :return:
+    """
     from wcvpy.wcvp_name_matching import get_accepted_info_from_names_in_column
-
-    import hashlib
-    import time
-    import wikipediaapi
+    from data_compilation_methods import get_wcvp_taxa
+    from web_request_methods import RateLimitedSession
 
     if output_csv is not None:
         if not os.path.isdir(os.path.dirname(output_csv)):
             os.mkdir(os.path.dirname(output_csv))
+    if store_csv is None:
+        store_csv = os.path.join(os.path.dirname(output_csv), 'wiki_page_search_store.csv')
     name_col = 'Name'
     out_dict = {name_col: [], 'Language': []}
     languages_to_check = ['es', 'en', 'fr', 'it', 'pt', 'zh']
-    wikis_to_check = [wikipediaapi.Wikipedia(lan) for lan in languages_to_check]
-    # Save previous searches using a hash of names to avoid repeating searches
-    names = list(taxa_list)
-    str_to_hash = str(names).encode()
-    temp_csv = "wiki_page_search_" + str(hashlib.md5(str_to_hash).hexdigest()) + ".csv"
-    _temp_outputs_path = os.path.dirname(output_csv)
-    temp_output_wiki_page_csv = os.path.join(_temp_outputs_path, temp_csv)
-    unchecked_taxa_due_to_timeout = []
-    if os.path.isfile(temp_output_wiki_page_csv) and not force_new_search:
-
-        df = pd.read_csv(temp_output_wiki_page_csv, index_col=0)
-    else:
 
-        for i in tqdm(range(len(taxa_list)), desc="Searching for Wiki Pages…", ascii=False, ncols=72):
-            sp = taxa_list[i]
-            language_hits = []
-            try:
-                for wiki in wikis_to_check:
-                    time.sleep(.05)
-                    if check_page_exists(sp, wiki):
-                        language_hits.append(wiki.language)
-
-                if len(language_hits) > 0:
-                    out_dict['Language'].append(str(language_hits))
-                    out_dict[name_col].append(sp)
-
-            except:
-                unchecked_taxa_due_to_timeout.append(sp)
-
-        df = pd.DataFrame(out_dict)
-
-    if len(unchecked_taxa_due_to_timeout) > 0:
-        taxa_to_check_dict = {'taxa': unchecked_taxa_due_to_timeout}
-        check_df = pd.DataFrame(taxa_to_check_dict)
-        check_filename = 'taxa_to_recheck_' + temp_csv
-        check_csv = os.path.join(_temp_outputs_path, check_filename)
-        check_df.to_csv(check_csv)
-        print(
-            f'Warning {str(len(unchecked_taxa_due_to_timeout))} taxa were unchecked due to server timeouts. Rerun search for taxa in {check_csv}')
+    taxa_to_search = list(dict.fromkeys(sp for sp in taxa_list if isinstance(sp, str)))
+    store = {} if force_new_search else _read_wiki_page_store(store_csv)
+    searched = {lan: {} for lan in languages_to_check}
+    for attempt in range(max_attempts):
+        missing = {lan: [sp for sp in taxa_to_search if sp not in store.get(lan, {}) and sp not in searched[lan]]
+                   for lan in languages_to_check}
+        if all(len(missing[lan]) == 0 for lan in languages_to_check):
+            break
+        if session is None:
+            session = RateLimitedSession(requests_per_second=requests_per_second)
+        for lan in languages_to_check:
+            for i in range(0, len(missing[lan]), taxa_per_checkpoint):
+                pages_exist = check_pages_exist(missing[lan][i:i + taxa_per_checkpoint], [lan], session=session,
+                                                api_url=api_url, max_workers=max_workers)[lan]
+                _append_to_wiki_page_store(store_csv, lan, pages_exist)
+                searched[lan].update(pages_exist)
+    for lan in languages_to_check:
+        store.setdefault(lan, {}).update(searched[lan])
+
+    unchecked_taxa = []
+    for sp in taxa_list:
+        if not isinstance(sp, str) or any(sp not in store[lan] for lan in languages_to_check):
+            unchecked_taxa.append(sp)
+            continue
+        language_hits = [lan for lan in languages_to_check if store[lan][sp]]
+
+        if len(language_hits) > 0:
+            out_dict['Language'].append(str(language_hits))
+            out_dict[name_col].append(sp)
 
-    df.to_csv(temp_output_wiki_page_csv)
+    if len(unchecked_taxa) > 0:
+        print(
+            f'Warning {str(len(unchecked_taxa))} taxa were unchecked due to server timeouts or invalid names. '
+            f'Rerun the search to retry them.')
 
-    acc_df = get_accepted_info_from_names_in_column(df, name_col)
+    df = pd.DataFrame(out_dict)
+    acc_df = get_accepted_info_from_names_in_column(df, name_col, wcvp_version=wcvp_version,
+                                                    all_taxa=get_wcvp_taxa(wcvp_version, wcvp_cache_dir))
 
     acc_df.to_csv(output_csv)
     return acc_df
@@ -0,0 +1,2 @@
+from .test_mediawiki_api import *
+from .test_multi_pattern_search import *
@@ -0,0 +1,221 @@
+import json
+import os
+import tempfile
+import threading
+import unittest
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pandas as pd
+
+from web_request_methods import CachedResponse, RateLimitedSession, ResponseCache
+from wikipedia_searches.mediawiki_api import check_pages_exist, get_langlink_titles, get_parsed_page, lookup_pages
+from wikipedia_searches.search_pages import make_wiki_hit_df
+
+# Pages which exist on the stub server for each language
+stub_pages = {'en': ['Catharanthus roseus', 'Rauvolfia serpentina', 'Madagascar periwinkle'],
+              'fr': ['Catharanthus roseus']}
+stub_redirects = {'en': {'Madagascar periwinkle': 'Catharanthus roseus'}}
+stub_langlinks = {'en': {'Catharanthus roseus': {'zh': '长春花'}}}
+
+
+class _StubMediaWikiHandler(BaseHTTPRequestHandler):
+    requests_made = []
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        lang = url.path.split('/')[1]
+        params = dict(urllib.parse.parse_qsl(url.query))
+        self.requests_made.append((lang, params))
+
+        if params['action'] == 'parse':
+            if params['page'] in stub_pages.get(lang, []):
+                response = {'parse': {'title': params['page'], 'revid': 1,
+                                      'text': {'*': '<p>' + params['page'] + '</p>'}}}
+            else:
+                response = {'error': {'code': 'missingtitle', 'info': "The page you specified doesn't exist."}}
+            self._send_json(response)
+            return
+
+        titles = params['titles'].split('|')
+        normalized = []
+        redirects = []
+        pages = []
+        for t in titles:
+            page_title = (t[:1].upper() + t[1:]).replace('_', ' ')
+            if page_title != t:
+                normalized.append({'from': t, 'to': page_title})
+            if 'redirects' in params and page_title in stub_redirects.get(lang, {}):
+                redirects.append({'from': page_title, 'to': stub_redirects[lang][page_title]})
+                page_title = stub_redirects[lang][page_title]
+            if page_title in stub_pages.get(lang, []):
+                page = {'pageid': 1, 'ns': 0, 'title': page_title}
+                if params.get('prop') == 'langlinks':
+                    linked = stub_langlinks.get(lang, {}).get(page_title, {})
+                    page['langlinks'] = []
+                    if params['lllang'] in linked:
+                        page['langlinks'].append({'lang': params['lllang'], 'title': linked[params['lllang']]})
+                pages.append(page)
+            else:
+                pages.append({'ns': 0, 'title': page_title, 'missing': True})
+
+        self._send_json({'batchcomplete': True,
+                         'query': {'normalized': normalized, 'redirects': redirects, 'pages': pages}})
+
+    def _send_json(self, response: dict):
+        body = json.dumps(response).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _Interrupted(BaseException):
+    pass
+
+
+class _InterruptedSession(RateLimitedSession):
+    # Session which is interrupted, as by a KeyboardInterrupt, after a number of requests
+    def __init__(self, requests_before_interrupt: int, **kwargs):
+        super().__init__(**kwargs)
+        self.requests_before_interrupt = requests_before_interrupt
+
+    def get(self, url, params=None, **kwargs):
+        if self.requests_before_interrupt == 0:
+            raise _Interrupted()
+        self.requests_before_interrupt -= 1
+        return super().get(url, params=params, **kwargs)
+
+
+class MyTestCase(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), _StubMediaWikiHandler)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.api_url = 'http://127.0.0.1:' + str(cls.server.server_port) + '/{lang}/w/api.php'
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+
+    def setUp(self):
+        _StubMediaWikiHandler.requests_made.clear()
+
+    def test_pages_exist(self):
+        titles = ['Catharanthus roseus', 'catharanthus_roseus', 'Rauvolfia serpentina', 'Not a plant', 'a|b']
+        pages_exist = check_pages_exist(titles, ['en', 'fr'], api_url=self.api_url)
+
+        self.assertDictEqual(pages_exist['en'], {'Catharanthus roseus': True, 'catharanthus_roseus': True,
+                                                 'Rauvolfia serpentina': True, 'Not a plant': False,
+                                                 'a|b': False})
+        self.assertDictEqual(pages_exist['fr'], {'Catharanthus roseus': True, 'catharanthus_roseus': True,
+                                                 'Rauvolfia serpentina': False, 'Not a plant': False,
+                                                 'a|b': False})
+
+    def test_titles_are_batched(self):
+        titles = ['Taxon ' + str(i) for i in range(120)]
+        session = RateLimitedSession(requests_per_second=100)
+        pages_exist = check_pages_exist(titles, ['en', 'fr'], session=session, api_url=self.api_url)
+
+        self.assertEqual(len(_StubMediaWikiHandler.requests_made), 6)
+        self.assertEqual(len(pages_exist['en']), 120)
+        self.assertFalse(any(pages_exist['fr'].values()))
+
+    def test_langlinks_and_redirects(self):
+        zh_titles = get_langlink_titles(['Catharanthus roseus', 'Rauvolfia serpentina', 'Not a plant'], 'en', 'zh',
+                                        api_url=self.api_url)
+        self.assertDictEqual(zh_titles, {'Catharanthus roseus': '长春花', 'Rauvolfia serpentina': None,
+                                         'Not a plant': None})
+
+        pages = lookup_pages(['Madagascar periwinkle'], ['en'], api_url=self.api_url, follow_redirects=True)
+        self.assertEqual(pages['en']['Madagascar periwinkle']['title'], 'Catharanthus roseus')
+        self.assertEqual(pages['en']['Madagascar periwinkle']['redirected_from'], 'Madagascar periwinkle')
+
+        pages = lookup_pages(['Madagascar periwinkle'], ['en'], api_url=self.api_url)
+        self.assertTrue(pages['en']['Madagascar periwinkle']['exists'])
+        self.assertIsNone(pages['en']['Madagascar periwinkle']['redirected_from'])
+
+    def test_parsed_pages(self):
+        self.assertEqual(get_parsed_page('en', 'Catharanthus roseus', api_url=self.api_url),
+                         ('<p>Catharanthus roseus</p>', 1))
+        # Errors for pages which can't be parsed give an empty page without a revision
+        self.assertEqual(get_parsed_page('fr', 'Rauvolfia serpentina', api_url=self.api_url), ('', None))
+
+    def test_response_cache(self):
+        titles = ['Catharanthus roseus', 'Not a plant']
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cache_file = os.path.join(tmpdir, 'responses.sqlite')
+            session = RateLimitedSession(cache=ResponseCache(cache_file))
+            pages_exist = check_pages_exist(titles, ['en', 'fr'], session=session, api_url=self.api_url)
+            self.assertEqual(len(_StubMediaWikiHandler.requests_made), 2)
+
+            # Reruns, including offline, are answered from the cache
+            offline_session = RateLimitedSession(cache=ResponseCache(cache_file, offline=True))
+            cached_pages_exist = check_pages_exist(titles, ['en', 'fr'], session=offline_session,
+                                                   api_url=self.api_url)
+            self.assertEqual(len(_StubMediaWikiHandler.requests_made), 2)
+            self.assertDictEqual(pages_exist, cached_pages_exist)
+
+            # Uncached requests fail when offline
+            uncached_pages_exist = check_pages_exist(['Rauvolfia serpentina'], ['en'], session=offline_session,
+                                                     api_url=self.api_url)
+            self.assertEqual(len(_StubMediaWikiHandler.requests_made), 2)
+            self.assertDictEqual(uncached_pages_exist, {'en': {}})
+
+            # Expired responses are requested again
+            expiring_session = RateLimitedSession(cache=ResponseCache(cache_file, ttls={'127.0.0.1': 0}))
+            check_pages_exist(titles, ['en'], session=expiring_session, api_url=self.api_url)
+            self.assertEqual(len(_StubMediaWikiHandler.requests_made), 3)
+
+            # The least recently used responses are evicted when the cache is too large
+            small_cache = ResponseCache(os.path.join(tmpdir, 'small.sqlite'), max_size_bytes=10)
+            small_cache.put('http://example.org/a', None, CachedResponse('http://example.org/a', 200, b'aaaaa', {}))
+            small_cache.put('http://example.org/b', None, CachedResponse('http://example.org/b', 200, b'bbbbb', {}))
+            small_cache.get('http://example.org/a')
+            small_cache.put('http://example.org/c', None, CachedResponse('http://example.org/c', 200, b'ccccc', {}))
+            self.assertEqual(small_cache.get('http://example.org/a').text, 'aaaaa')
+            self.assertIsNone(small_cache.get('http://example.org/b'))
+            self.assertEqual(small_cache.get('HTTP://EXAMPLE.ORG:80/c#fragment').text, 'ccccc')
+
+            # Responses larger than the cache aren't stored and don't evict others
+            small_cache.put('http://example.org/c', None,
+                            CachedResponse('http://example.org/c', 200, b'c' * 11, {}))
+            self.assertIsNone(small_cache.get('http://example.org/c'))
+            self.assertEqual(small_cache.get('http://example.org/a').text, 'aaaaa')
+
+    def test_resuming_wiki_hit_search(self):
+        taxa = ['Catharanthus roseus', 'Rauvolfia serpentina', 'Not a plant', 'Taxon 1']
+        with tempfile.TemporaryDirectory() as tmpdir:
+            full_csv = os.path.join(tmpdir, 'full', 'wiki_hits.csv')
+            full_hits = make_wiki_hit_df(taxa, full_csv, api_url=self.api_url, taxa_per_checkpoint=2, max_workers=1)
+            # Two checkpoints of one request in each of the six languages
+            self.assertEqual(len(_StubMediaWikiHandler.requests_made), 12)
+            _StubMediaWikiHandler.requests_made.clear()
+
+            resumed_csv = os.path.join(tmpdir, 'resumed', 'wiki_hits.csv')
+            with self.assertRaises(_Interrupted):
+                make_wiki_hit_df(taxa, resumed_csv, api_url=self.api_url, taxa_per_checkpoint=2, max_workers=1,
+                                 session=_InterruptedSession(5))
+            self.assertFalse(os.path.isfile(resumed_csv))
+
+            interrupted_requests = [(lang, params['titles']) for lang, params in _StubMediaWikiHandler.requests_made]
+            self.assertEqual(len(interrupted_requests), 5)
+            _StubMediaWikiHandler.requests_made.clear()
+
+            # Only the checkpoints which weren't completed are searched again
+            resumed_hits = make_wiki_hit_df(taxa, resumed_csv, api_url=self.api_url, taxa_per_checkpoint=2,
+                                            max_workers=1)
+            resumed_requests = [(lang, params['titles']) for lang, params in _StubMediaWikiHandler.requests_made]
+            self.assertEqual(len(resumed_requests), 7)
+            self.assertFalse(set(interrupted_requests) & set(resumed_requests))
+            pd.testing.assert_frame_equal(full_hits, resumed_hits)
+            with open(full_csv) as full_output, open(resumed_csv) as resumed_output:
+                self.assertEqual(full_output.read(), resumed_output.read())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,31 @@
+import unittest
+
+from wikipedia_searches.multi_pattern_search import MultiPatternMatcher, _pyahocorasick_installed
+
+taxa = ['Rosa', 'Rosa canina', 'canina', 'Acer campestre', 'Acer', 'Not in text', 'aa']
+text = 'Dog rose (Rosa canina), Field maple (Acer campestre) and Rosa rubiginosa. aaa'
+
+
+class MultiPatternSearchTestCase(unittest.TestCase):
+    def check_matcher(self, use_pyahocorasick: bool):
+        matcher = MultiPatternMatcher(taxa, use_pyahocorasick=use_pyahocorasick)
+
+        first_offsets = matcher.find(text)
+        self.assertDictEqual(first_offsets, {t: [text.index(t)] for t in taxa if t in text})
+
+        all_offsets = matcher.find(text, all_occurrences=True)
+        self.assertDictEqual(all_offsets,
+                             {t: [i for i in range(len(text)) if text.startswith(t, i)] for t in taxa if t in text})
+        self.assertEqual(all_offsets['Rosa'], [10, 57])
+        self.assertEqual(all_offsets['aa'], [74, 75])
+
+    def test_pure_python_matcher(self):
+        self.check_matcher(False)
+
+    @unittest.skipUnless(_pyahocorasick_installed(), 'pyahocorasick not installed')
+    def test_pyahocorasick_matcher(self):
+        self.check_matcher(True)
+
+
+if __name__ == '__main__':
+    unittest.main()